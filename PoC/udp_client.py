@@ -1,85 +1,61 @@
-import socket
-import threading
+import asyncio
+import os
+import sys
 
+# The chat client library lives in the repository root, alongside the chat server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-class Client:
-    BUFFER_SIZE = 4096
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+import chatclient
 
-    NEW_CLIENT_MESSAGE = '{NEW CLIENT REQUEST}'
-    QUIT_MESSAGE = '{QUIT}'
-    NICKNAME_ALREADY_EXISTS_MESSAGE = '{NICKNAME ALREADY EXISTS}'
+QUIT_MESSAGE = '{QUIT}'
 
-    def __init__(self, address, port):
-        self.addr = address
-        self.port = port
 
-        self.client = (self.addr, self.port)
+async def read_line(prompt):
+    """Reads a line from the terminal without holding up the event loop"""
 
-        self.nickname = self.obtain_nickname(self.client)
+    return await asyncio.get_running_loop().run_in_executor(None, input, prompt)
 
-        threading.Thread(target=self.receive_message, args=(self.client_socket,)).start()
 
-        self.send_message()
+async def show(client):
+    async for message in client:
+        text = chatclient.text(message)
+        if text is not None:
+            print(text)
 
-    def obtain_nickname(self, client):
-        while 1:
-            print('[!] Please enter your nickname: ')
-            nickname = input('> ')
-            payload = Client.encode(nickname, self.NEW_CLIENT_MESSAGE)
-            self.client_socket.sendto(payload, client)
 
-            message, server_addr = self.client_socket.recvfrom(self.BUFFER_SIZE)
+async def main(server, legacy=False, compress=True, use_multicast=True):
+    while 1:
+        print('[!] Please enter your nickname: ')
+        nickname = await read_line('> ')
 
-            message = message.decode('utf-8')
+        try:
+            client = await chatclient.connect(server, nickname, legacy, compress, use_multicast=use_multicast)
+            break
+        except chatclient.NicknameTaken:
+            print("[!] ('%s'): is already taken." % nickname)
+        except TimeoutError:
+            print('[!] The chat server is not answering.')
 
-            if message == self.NICKNAME_ALREADY_EXISTS_MESSAGE:
-                print("[!] ('%s'): is already taken." % nickname)
-                continue
-            else:
-                break
+    printer = asyncio.create_task(show(client))
 
-        return nickname
+    while not client.closed:
+        message = await read_line('%s > ' % nickname)
 
-    def send_message(self):
-        while 1:
-            message = input('%s > ' % self.nickname)
+        if message.lower() == QUIT_MESSAGE.lower():
+            break
 
-            payload = Client.encode(self.nickname, message)
+        try:
+            client.send(message)
+        except ValueError as e:
+            print('[!] %s' % e)
 
-            try:
-                self.client_socket.sendto(payload, self.client)
-            except socket.error:
-                pass
+    await client.close()
+    await printer
 
-            if message.lower() == self.QUIT_MESSAGE.lower():
-                self.client_socket.close()
-
-                break
-
-    @staticmethod
-    def encode(nickname, message):
-        """Encodes a message as a comma separated list to be sent to the chat server"""
-
-        # Construct the payload
-        payload = '%s,%s' % (nickname, message)
-
-        # Encode the payload as utf-8 byte stream, so it can be sent to the chat server
-        return str.encode(payload, 'utf-8')
-
-    def receive_message(self, client_socket):
-        while 1:
-            try:
-                message, server_addr = client_socket.recvfrom(self.BUFFER_SIZE)
-
-                if message:
-                    message = message.decode('utf-8')
-
-                    if message.lower() != self.NICKNAME_ALREADY_EXISTS_MESSAGE.lower():
-                        print('%s' % message)
-            except socket.error:
-                break
+    if client.channel is not None and client.channel.codec is not None:
+        print('[*] Compression saved %d bytes' % client.bytes_saved)
 
 
 if __name__ == '__main__':
-    Client('127.0.0.1', 4096)
+    asyncio.run(main(('127.0.0.1', 4096), legacy='--legacy' in sys.argv, compress='--no-compression' not in sys.argv,
+                     use_multicast='--no-multicast' not in sys.argv))
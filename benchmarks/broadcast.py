@@ -0,0 +1,77 @@
+import argparse
+import os
+import socket
+import sys
+import time
+
+# The fan-out engine lives in the repository root, alongside the chat server
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fanout import FanOut
+
+
+def loop_broadcast(server_socket, addresses, message):
+    """The per-recipient broadcast loop the fan-out engine replaces"""
+
+    for client in addresses:
+        if type(message) is not bytes:
+            message = str.encode(message, 'utf-8')
+
+        server_socket.sendto(message, client)
+
+
+def fanout_broadcast(server_socket, recipients, message):
+    """An encode-once, batched broadcast, as legacy clients are sent. Clients
+    speaking the binary protocol are sent broadcasts through their channels"""
+
+    message = str.encode(message, 'utf-8')
+    recipients.legacy_clients.send(server_socket, message)
+
+
+def measure(broadcast, server_socket, recipients, message, duration):
+    """Broadcasts message for duration seconds, returning the messages/sec"""
+
+    count = 0
+    start = time.perf_counter()
+    end = start + duration
+
+    while time.perf_counter() < end:
+        broadcast(server_socket, recipients, message)
+        count = count + 1
+
+    return count / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Broadcast messages/sec versus room size')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1, 10, 100, 1000, 5000],
+                        help='the room sizes to measure')
+    parser.add_argument('--message-size', type=int, default=64, help='the size of each chat message')
+    parser.add_argument('--duration', type=float, default=2.0, help='the seconds spent on each measurement')
+    args = parser.parse_args()
+
+    # The recipients are sinks bound on loopback, which are never read from,
+    # so sends are cheap drops into a full receive buffer
+    sinks = []
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    message = 'x' * args.message_size
+
+    print('%10s %16s %16s %8s' % ('room size', 'loop msgs/sec', 'fanout msgs/sec', 'speedup'))
+
+    for size in args.sizes:
+        while len(sinks) < size:
+            sink = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sink.bind(('127.0.0.1', 0))
+            sinks.append(sink)
+
+        addresses = [sink.getsockname() for sink in sinks[:size]]
+        recipients = FanOut((address, True) for address in addresses)
+
+        loop_rate = measure(loop_broadcast, server_socket, addresses, message, args.duration)
+        fanout_rate = measure(fanout_broadcast, server_socket, recipients, message, args.duration)
+
+        print('%10d %16.1f %16.1f %7.2fx' % (size, loop_rate, fanout_rate, fanout_rate / loop_rate))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+import argparse
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import time
+
+# The chat server lives in the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import protocol
+from reliability import Channel
+
+
+class BenchClient:
+    """A headless chat client, which acknowledges everything it receives and
+    records when each benchmark message arrives"""
+
+    def __init__(self, server, nickname):
+        self.server = server
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.channel = Channel(server, nickname=nickname)
+        self.welcomed = False
+
+        # The number of datagrams received, and the latency of each benchmark message
+        self.datagrams = 0
+        self.latencies = []
+
+    def join(self):
+        self.socket.sendto(protocol.encode(protocol.JOIN, nickname=self.channel.nickname), self.server)
+
+    def send(self, text):
+        message_type, payload = protocol.parse_command(text)
+        datagram = self.channel.send(message_type, payload, time.monotonic())
+        if datagram is not None:
+            self.socket.sendto(datagram, self.server)
+
+    def receive(self):
+        """Handles every datagram waiting on the socket"""
+
+        while 1:
+            try:
+                data, address = self.socket.recvfrom(65536)
+            except BlockingIOError:
+                break
+
+            now = time.monotonic()
+            self.datagrams = self.datagrams + 1
+
+            delivered, replies = self.channel.process_batch(protocol.unbatch(protocol.decode(data)), now)
+            for reply in replies:
+                self.socket.sendto(reply, self.server)
+
+            for message in delivered:
+                if message.type == protocol.WELCOME:
+                    self.channel.session_id = message.session_id
+                    self.welcomed = True
+                elif message.type == protocol.TEXT and b' > bench ' in message.payload:
+                    self.latencies.append(now - float(message.payload.rsplit(b' ', 1)[1]))
+
+    def poll(self):
+        for datagram in self.channel.poll(time.monotonic()):
+            self.socket.sendto(datagram, self.server)
+
+
+def pump(clients, selector, duration):
+    """Receives and retransmits for all the clients, for duration seconds"""
+
+    end = time.monotonic() + duration
+
+    while 1:
+        remaining = end - time.monotonic()
+        if remaining <= 0:
+            break
+
+        for key, events in selector.select(min(remaining, 0.01)):
+            key.data.receive()
+
+        for client in clients:
+            client.poll()
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(int(fraction * len(values)), len(values) - 1)] if values else float('nan')
+
+
+def run(args, delay, port):
+    """Runs the chat server with the given coalescing delay, returning the
+    (deliveries/sec, datagrams per delivery, p50 latency, p99 latency)"""
+
+    server = subprocess.Popen([sys.executable, 'server.py', '--port', str(port), '--mtu', str(args.mtu),
+                               '--coalesce-delay', str(delay)],
+                              cwd=ROOT, stdout=subprocess.DEVNULL)
+
+    try:
+        time.sleep(0.5)
+
+        address = ('127.0.0.1', port)
+        sender = BenchClient(address, 'sender')
+        listeners = [BenchClient(address, 'listener%d' % index) for index in range(args.clients)]
+        clients = [sender] + listeners
+
+        selector = selectors.DefaultSelector()
+        for client in clients:
+            selector.register(client.socket, selectors.EVENT_READ, client)
+            client.join()
+
+        pump(clients, selector, 0.5)
+        if not all(client.welcomed for client in clients):
+            raise RuntimeError('not every client was welcomed by the chat server')
+
+        # Send the messages in bursts, as bursty chat would
+        start = time.monotonic()
+        for index in range(0, args.messages, args.burst):
+            for _ in range(min(args.burst, args.messages - index)):
+                sender.send('bench %d %.6f' % (index, time.monotonic()))
+
+            pump(clients, selector, args.interval)
+
+        # Wait for the stragglers
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and any(len(client.latencies) < args.messages for client in listeners):
+            pump(clients, selector, 0.05)
+
+        elapsed = time.monotonic() - start
+
+        for client in clients:
+            client.send('{quit}')
+        pump(clients, selector, 0.2)
+    finally:
+        server.kill()
+        server.wait()
+
+    latencies = [latency for client in listeners for latency in client.latencies]
+    datagrams = sum(client.datagrams for client in listeners)
+
+    return (len(latencies) / elapsed, datagrams / max(len(latencies), 1),
+            percentile(latencies, 0.5), percentile(latencies, 0.99))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Broadcast throughput versus added latency, by coalescing delay')
+    parser.add_argument('--delays', type=float, nargs='+', default=[0, 0.001, 0.005, 0.02],
+                        help='the coalescing delays to measure, in seconds (0 turns coalescing off)')
+    parser.add_argument('--mtu', type=int, default=1472, help='the largest datagram messages are packed into')
+    parser.add_argument('--clients', type=int, default=20, help='the number of clients receiving the messages')
+    parser.add_argument('--messages', type=int, default=2000, help='the number of messages broadcast')
+    parser.add_argument('--burst', type=int, default=20, help='the number of messages sent in each burst')
+    parser.add_argument('--interval', type=float, default=0.01, help='the seconds between bursts')
+    parser.add_argument('--port', type=int, default=5200, help='the first port to run the chat server on')
+    args = parser.parse_args()
+
+    print('%10s %18s %18s %12s %12s' % ('delay (s)', 'deliveries/sec', 'datagrams/message', 'p50 (ms)', 'p99 (ms)'))
+
+    for offset, delay in enumerate(args.delays):
+        rate, datagrams, p50, p99 = run(args, delay, args.port + offset)
+        print('%10g %18.1f %18.2f %12.2f %12.2f' % (delay, rate, datagrams, p50 * 1000, p99 * 1000))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,477 @@
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import selectors
+import socket
+import subprocess
+import sys
+import time
+from array import array
+
+# The chat server lives in the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import compression
+import protocol
+from reliability import Channel
+
+# Marks the chat messages sent by the load generator, followed by when each was sent
+TAG = b'lg '
+
+JOIN_RETRY = 1.0  # How long, in seconds, a simulated client waits to be welcomed before asking again
+POLL_INTERVAL = 0.02  # How often, in seconds, channels are checked for messages to retransmit
+HEARTBEAT_INTERVAL = 10.0  # How often, in seconds, each simulated client sends a heartbeat
+
+
+class SimulatedClient:
+    """A headless chat client speaking the binary protocol"""
+
+    def __init__(self, server, nickname, room):
+        self.server = server
+        self.nickname = nickname
+        self.room = room
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+        self.channel = Channel(server, nickname=nickname)
+
+        # Set once the chat server has welcomed the client, and once it is in its room
+        self.welcomed = False
+        self.joined_at = None
+        self.in_room = room == protocol.DEFAULT_ROOM
+
+    def join(self, now, codecs):
+        self.joined_at = now
+        self.socket.sendto(protocol.encode(protocol.JOIN, nickname=self.nickname, payload=codecs), self.server)
+
+    def send(self, message_type, payload, now):
+        message_type, payload = protocol.compress(message_type, payload, self.channel.codec)
+
+        datagram = self.channel.send(message_type, payload, now)
+        if datagram is not None:
+            self.sendto(datagram)
+
+    def sendto(self, datagram):
+        try:
+            self.socket.sendto(datagram, self.server)
+        except BlockingIOError:
+            # The channel retransmits whatever could not be sent
+            pass
+
+
+class Simulation:
+    """The simulated clients run by one process, all driven from one selector loop"""
+
+    def __init__(self, args, index, server):
+        self.args = args
+        self.server = server
+        self.codecs = b'zlib' if args.compression else b''
+
+        # Every process simulates its share of the clients, spread across the rooms
+        self.clients = []
+        for number in range(index, args.clients, args.processes):
+            room = room_name(number % args.rooms)
+            self.clients.append(SimulatedClient(server, 'lg%dn%d' % (index, number), room))
+
+        self.selector = selectors.DefaultSelector()
+        for client in self.clients:
+            self.selector.register(client.socket, selectors.EVENT_READ, client)
+
+        # What was measured: the messages sent to each room and the broadcasts
+        # received, within the measurement window, and the latency of each
+        self.sent = {}
+        self.received = 0
+        self.latencies = array('d')
+        self.window = (float('inf'), float('inf'))
+
+        # The padding which makes each message the requested size
+        self.padding = b'x' * max(args.message_size - len(TAG) - 18, 0)
+
+    def receive(self, client, now):
+        """Handles every datagram waiting for a client"""
+
+        while 1:
+            try:
+                data, address = client.socket.recvfrom(65536)
+            except (BlockingIOError, ConnectionRefusedError):
+                return
+
+            try:
+                messages = protocol.unbatch(protocol.decode(data))
+            except (protocol.ProtocolError, UnicodeDecodeError):
+                continue
+
+            delivered, replies = client.channel.process_batch(messages, now)
+            for reply in replies:
+                client.sendto(reply)
+
+            for message in delivered:
+                if message.type == protocol.TEXT:
+                    self.record(message.payload, now)
+                elif message.type == protocol.WELCOME:
+                    client.welcomed = True
+                    client.channel.session_id = message.session_id
+
+                    # Move into the client's room
+                    if not client.in_room:
+                        client.send(protocol.ROOM_JOIN, client.room.encode('ascii'), now)
+                        client.in_room = True
+                elif message.type == protocol.COMPRESSION:
+                    client.channel.codec = compression.NAMES.get(message.payload.decode('ascii'))
+
+    def record(self, payload, now):
+        """Records the latency of a broadcast sent by the load generator"""
+
+        position = payload.find(b' > ' + TAG)
+        if position < 0:
+            return
+
+        sent_at = float(payload[position + 3 + len(TAG):].split(b' ', 1)[0])
+
+        if self.window[0] <= sent_at < self.window[1]:
+            self.received = self.received + 1
+            self.latencies.append(now - sent_at)
+
+    def pump(self, until, sending=False):
+        """Runs the selector loop until the given time, sending chat messages
+        on each client's schedule if sending is set"""
+
+        schedule = []
+        if sending and self.args.rate > 0:
+            interval = 1.0 / self.args.rate
+            now = time.monotonic()
+            schedule = [(now + random.random() * interval, position) for position in range(len(self.clients))]
+            heapq.heapify(schedule)
+
+        next_poll = 0
+        next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+
+        while 1:
+            now = time.monotonic()
+            if now >= until:
+                return
+
+            # Send the chat messages which are due
+            while schedule and schedule[0][0] <= now:
+                due, position = heapq.heappop(schedule)
+                client = self.clients[position]
+
+                payload = b'%s%.6f %s' % (TAG, now, self.padding)
+                client.send(protocol.CHAT, payload, now)
+
+                if self.window[0] <= now < self.window[1]:
+                    self.sent[client.room] = self.sent.get(client.room, 0) + 1
+
+                heapq.heappush(schedule, (max(due + interval, now), position))
+
+            # Retransmit, and ask again to join, where needed
+            if now >= next_poll:
+                next_poll = now + POLL_INTERVAL
+
+                for client in self.clients:
+                    for datagram in client.channel.poll(now):
+                        client.sendto(datagram)
+
+                    if not client.welcomed and client.joined_at is not None and now - client.joined_at >= JOIN_RETRY:
+                        client.join(now, self.codecs)
+
+            if now >= next_heartbeat:
+                next_heartbeat = now + HEARTBEAT_INTERVAL
+
+                for client in self.clients:
+                    client.sendto(protocol.encode(protocol.HEARTBEAT, client.channel.session_id, client.nickname))
+
+            timeout = min(until, schedule[0][0] if schedule else until, next_poll) - time.monotonic()
+            for key, events in self.selector.select(max(timeout, 0)):
+                self.receive(key.data, time.monotonic())
+
+    def join(self, deadline):
+        """Joins every client, a few at a time, returning once all are welcomed"""
+
+        for position, client in enumerate(self.clients):
+            client.join(time.monotonic(), self.codecs)
+
+            if position % self.args.join_batch == self.args.join_batch - 1:
+                self.pump(time.monotonic() + 0.01)
+
+        while not all(client.welcomed for client in self.clients):
+            if time.monotonic() >= deadline:
+                raise RuntimeError('not every simulated client was welcomed by the chat server')
+
+            self.pump(time.monotonic() + 0.1)
+
+        # Let the room switches and join notices settle
+        self.pump(time.monotonic() + 1.0)
+
+    def quit(self):
+        now = time.monotonic()
+
+        for client in self.clients:
+            client.send(protocol.QUIT, b'', now)
+
+        self.pump(now + 0.5)
+
+
+def room_name(number):
+    """The room the clients numbered number (modulo the number of rooms) are put in"""
+
+    return protocol.DEFAULT_ROOM if number == 0 else 'room%d' % number
+
+
+def simulate(index, args, server, ready, start, results):
+    """Runs one process' share of the simulated clients through the benchmark"""
+
+    simulation = Simulation(args, index, server)
+
+    try:
+        simulation.join(time.monotonic() + args.join_timeout)
+        ready.put(index)
+    except RuntimeError as e:
+        ready.put(e)
+        return
+
+    # Wait for every process to be ready, then follow the coordinator's timeline
+    start.wait()
+    measure_from = start.value
+
+    simulation.window = (measure_from, measure_from + args.duration)
+    simulation.pump(measure_from + args.duration, sending=True)
+
+    # Stop sending, and wait for the broadcasts still on their way
+    simulation.pump(measure_from + args.duration + args.drain)
+    simulation.quit()
+
+    results.put(dict(sent=simulation.sent, received=simulation.received, latencies=simulation.latencies.tobytes()))
+
+
+class Start:
+    """The signal, shared by every process, to start sending, along with when
+    the measurement window begins"""
+
+    def __init__(self):
+        self.event = multiprocessing.Event()
+        self.shared = multiprocessing.Value('d', 0.0)
+
+    def set(self, value):
+        self.shared.value = value
+        self.event.set()
+
+    def wait(self):
+        self.event.wait()
+
+    @property
+    def value(self):
+        return self.shared.value
+
+
+def cpu_seconds(pid):
+    """The CPU time, in seconds, used by a process and its children so far"""
+
+    ticks = os.sysconf('SC_CLK_TCK')
+    pids = {pid}
+    total = 0
+
+    # Find the children (e.g. worker processes) through /proc
+    try:
+        stats = {}
+        for name in os.listdir('/proc'):
+            if name.isdigit():
+                try:
+                    with open('/proc/%s/stat' % name) as f:
+                        stats[int(name)] = f.read().rsplit(')', 1)[1].split()
+                except OSError:
+                    continue
+    except OSError:
+        return None
+
+    changed = True
+    while changed:
+        changed = False
+        for other, fields in stats.items():
+            if other not in pids and int(fields[1]) in pids:
+                pids.add(other)
+                changed = True
+
+    for other in pids:
+        if other in stats:
+            total = total + int(stats[other][11]) + int(stats[other][12])
+
+    return total / ticks
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+
+    return values[min(int(fraction * len(values)), len(values) - 1)]
+
+
+def run(args):
+    """Runs the benchmark, returning its results"""
+
+    address = (args.host, args.port)
+    server = None
+
+    if not args.external:
+        server = subprocess.Popen([sys.executable, 'server.py', '--host', args.host, '--port', str(args.port)]
+                                  + args.server_args, cwd=ROOT, stdout=subprocess.DEVNULL)
+        time.sleep(1.0)
+
+    ready = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    start = Start()
+
+    processes = [multiprocessing.Process(target=simulate, args=(index, args, address, ready, start, results))
+                 for index in range(args.processes)]
+
+    try:
+        for process in processes:
+            process.start()
+
+        for _ in processes:
+            outcome = ready.get(timeout=args.join_timeout + 10)
+            if isinstance(outcome, Exception):
+                raise outcome
+
+        # Start every process together, measuring once the warmup is over
+        measure_from = time.monotonic() + args.warmup
+        start.set(measure_from)
+
+        time.sleep(max(measure_from - time.monotonic(), 0))
+        cpu_before = cpu_seconds(server.pid) if server is not None else None
+
+        time.sleep(args.duration)
+        cpu_after = cpu_seconds(server.pid) if server is not None else None
+
+        outcomes = [results.get(timeout=args.warmup + args.drain + 10) for _ in processes]
+    finally:
+        for process in processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+
+        if server is not None:
+            try:
+                server.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                server.kill()
+                server.wait()
+
+    # Combine what each process measured
+    sent = {}
+    received = 0
+    latencies = array('d')
+    for outcome in outcomes:
+        for room, count in outcome['sent'].items():
+            sent[room] = sent.get(room, 0) + count
+        received = received + outcome['received']
+        latencies.frombytes(outcome['latencies'])
+
+    # Every message is broadcast to every member of the sender's room, including the sender
+    members = {}
+    for number in range(args.clients):
+        room = room_name(number % args.rooms)
+        members[room] = members.get(room, 0) + 1
+
+    expected = sum(count * members[room] for room, count in sent.items())
+    latencies = sorted(latencies)
+    cpu = cpu_after - cpu_before if cpu_before is not None and cpu_after is not None else None
+
+    def milliseconds(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return dict(
+        config=dict(clients=args.clients, processes=args.processes, rooms=args.rooms, rate=args.rate,
+                    message_size=args.message_size, duration=args.duration, compression=args.compression,
+                    server_args=args.server_args),
+        sent=sum(sent.values()),
+        sent_per_second=round(sum(sent.values()) / args.duration, 1),
+        deliveries_per_second=round(received / args.duration, 1),
+        expected_deliveries=expected,
+        received_deliveries=received,
+        loss_rate=round(1 - received / expected, 6) if expected else None,
+        latency_ms=dict(p50=milliseconds(percentile(latencies, 0.5)),
+                        p99=milliseconds(percentile(latencies, 0.99)),
+                        p999=milliseconds(percentile(latencies, 0.999)),
+                        max=milliseconds(latencies[-1] if latencies else None)),
+        server_cpu_seconds=round(cpu, 3) if cpu is not None else None,
+        server_cpu_utilisation=round(cpu / args.duration, 3) if cpu is not None else None,
+    )
+
+
+def compare(results, baseline, tolerance):
+    """The regressions of results against a baseline, as lines of text"""
+
+    checks = [('deliveries_per_second', results['deliveries_per_second'], baseline['deliveries_per_second'], 1),
+              ('latency p99 (ms)', results['latency_ms']['p99'], baseline['latency_ms']['p99'], -1),
+              ('server_cpu_seconds', results['server_cpu_seconds'], baseline['server_cpu_seconds'], -1)]
+
+    regressions = []
+    for name, value, expected, direction in checks:
+        if value is None or not expected:
+            continue
+
+        # Higher is better for throughput, lower is better for everything else
+        change = (value - expected) / expected * direction
+        if change < -tolerance:
+            regressions.append('%s: %s against a baseline of %s' % (name, value, expected))
+
+    if results['loss_rate'] and results['loss_rate'] > (baseline['loss_rate'] or 0) + tolerance / 100:
+        regressions.append('loss_rate: %s against a baseline of %s' % (results['loss_rate'], baseline['loss_rate']))
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the chat server with simulated clients')
+    parser.add_argument('--clients', type=int, default=200, help='the number of simulated clients')
+    parser.add_argument('--processes', type=int, default=max(multiprocessing.cpu_count() // 2, 1),
+                        help='the number of processes the simulated clients are spread across')
+    parser.add_argument('--rooms', type=int, default=10, help='the number of rooms the clients are spread across')
+    parser.add_argument('--rate', type=float, default=1.0, help='the chat messages each client sends per second')
+    parser.add_argument('--message-size', type=int, default=64, help='the size of each chat message, in bytes')
+    parser.add_argument('--duration', type=float, default=10.0, help='the seconds measured')
+    parser.add_argument('--warmup', type=float, default=2.0, help='the seconds of sending before measuring')
+    parser.add_argument('--drain', type=float, default=2.0,
+                        help='the seconds to wait for broadcasts still on their way once sending stops')
+    parser.add_argument('--join-batch', type=int, default=50, help='the clients each process joins at once')
+    parser.add_argument('--join-timeout', type=float, default=60.0,
+                        help='the seconds allowed for every client to be welcomed')
+    parser.add_argument('--compression', action='store_true', help='offer to compress payloads')
+    parser.add_argument('--host', default='127.0.0.1', help='the address of the chat server')
+    parser.add_argument('--port', type=int, default=5300, help='the port of the chat server')
+    parser.add_argument('--external', action='store_true',
+                        help='benchmark a chat server which is already running, rather than starting one')
+    parser.add_argument('--server-args', nargs=argparse.REMAINDER, default=[],
+                        help='the arguments the chat server is started with (must come last)')
+    parser.add_argument('--output', help='the file the results are saved to, as JSON')
+    parser.add_argument('--baseline', help='a file of earlier results to check these against for regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='the fraction worse than the baseline a result may be before it is a regression')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    print(json.dumps(results, indent=2))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+
+        for regression in regressions:
+            print('[!] Regression in %s' % regression)
+
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
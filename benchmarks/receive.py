@@ -0,0 +1,119 @@
+import argparse
+import os
+import socket
+import sys
+import time
+import tracemalloc
+
+# The chat server lives in the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import protocol
+from bufferpool import BufferPool
+
+BUFFER_SIZE = 4096
+CHUNK = 100  # The datagrams queued up before each round of receiving
+
+# The buffers the pooled receive path reuses, allocated once like the server's
+POOL = BufferPool(64, BUFFER_SIZE)
+
+
+def copying(receiver):
+    """Receives and decodes datagrams the old way: a new bytes for every
+    datagram, and another for its payload"""
+
+    while 1:
+        try:
+            data, address = receiver.recvfrom(BUFFER_SIZE)
+        except BlockingIOError:
+            return
+
+        yield protocol.decode(data)
+
+
+def pooled(receiver):
+    """Receives datagrams into preallocated buffers, and decodes them without copying"""
+
+    while 1:
+        received = False
+        for data, address in POOL.receive(receiver):
+            received = True
+            yield protocol.decode_view(data)
+
+        if not received:
+            return
+
+
+def run(receive, count, size, trace):
+    """Sends count chat messages to a socket, measuring what receiving and
+    decoding each of them costs"""
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.setblocking(False)
+    sender = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    datagram = protocol.encode(protocol.CHAT, 1, 'benchmark', b'x' * size, 1)
+
+    received = 0
+    elapsed = 0.0
+    peaks = 0
+
+    if trace:
+        tracemalloc.start()
+
+    while received < count:
+        # Queue a chunk of datagrams (no more than the socket buffer holds), so only receiving is measured
+        for _ in range(min(CHUNK, count - received)):
+            sender.sendto(datagram, receiver.getsockname())
+
+        started = time.perf_counter()
+        messages = receive(receiver)
+
+        while 1:
+            if trace:
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+
+            message = next(messages, None)
+            if message is None:
+                break
+
+            # Only receiving and decoding are measured, as forwarding is the same either way
+            if trace:
+                peaks = peaks + tracemalloc.get_traced_memory()[1] - before
+
+            # Forward the payload the way a broadcast does
+            b'%s > %s' % (b'benchmark', message.payload)
+            received = received + 1
+
+        elapsed = elapsed + time.perf_counter() - started
+
+    if trace:
+        tracemalloc.stop()
+
+    receiver.close()
+    sender.close()
+
+    return elapsed / received, peaks / received
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the cost of receiving and decoding each datagram')
+    parser.add_argument('--count', type=int, default=20000, help='the datagrams received by each receive path')
+    parser.add_argument('--size', type=int, default=512, help='the size of each chat message, in bytes')
+    args = parser.parse_args()
+
+    print('%-8s %16s %28s' % ('path', 'time/datagram', 'bytes allocated/datagram'))
+
+    for name, receive in (('copying', copying), ('pooled', pooled)):
+        # Time without tracing, which slows everything down, then measure allocations
+        elapsed, _ = run(receive, args.count, args.size, False)
+        _, allocated = run(receive, min(args.count, 2000), args.size, True)
+
+        print('%-8s %14.2fus %28.0f' % (name, elapsed * 1000000, allocated))
+
+
+if __name__ == '__main__':
+    main()
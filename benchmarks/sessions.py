@@ -0,0 +1,118 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+# The chat server lives in the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import protocol
+from reliability import Channel
+from sessions import SessionTable
+
+
+def addresses(count):
+    """The (address, port) of count clients, spread over a few hosts"""
+
+    return [('10.0.%d.%d' % (number >> 16 & 0xFF, number >> 8 & 0xFF), number & 0xFFFF) for number in range(count)]
+
+
+def original_table(clients):
+    """Fills in the table the server started out with, nickname -> [(address,
+    port), sequence number], which has no room, channel or last seen time,
+    and can only be looked up by nickname"""
+
+    table = {}
+
+    for nickname, address in clients:
+        table[nickname] = [address, 0]
+
+    return table
+
+
+def nickname_tables(clients):
+    """Fills in the tables sessions were kept in just before the session
+    table: the nickname -> channel, nickname -> last seen and nickname ->
+    (address, legacy, room, channel) tables, with an (address, port) ->
+    nickname index"""
+
+    channels, last_seen, table, nicknames = {}, {}, {}, {}
+    now = time.monotonic()
+
+    for nickname, address in clients:
+        channels[nickname] = None
+        last_seen[nickname] = now
+        table[nickname] = (address, False, protocol.DEFAULT_ROOM, None)
+        nicknames[address] = nickname
+
+    return channels, last_seen, table, nicknames
+
+
+def session_table(clients):
+    """Fills in a SessionTable"""
+
+    sessions = SessionTable()
+    now = time.monotonic()
+
+    for nickname, address in clients:
+        sessions.add(nickname, address, protocol.DEFAULT_ROOM, None, now)
+
+    return sessions
+
+
+def channels(clients):
+    """Makes the reliable channel each client speaking the binary protocol has"""
+
+    return [Channel(address, session_id=number + 1) for number, (nickname, address) in enumerate(clients)]
+
+
+def measure(build, clients):
+    """The bytes allocated building a table of clients, left out of which are
+    the nicknames and addresses, which every layout keeps"""
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    table = build(clients)
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    return table, allocated
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure the memory each way of keeping sessions takes')
+    parser.add_argument('--sessions', type=int, default=100000, help='the number of sessions in the table')
+    args = parser.parse_args()
+
+    clients = [('client%d' % number, address) for number, address in enumerate(addresses(args.sessions))]
+
+    print('%-10s %16s %20s' % ('table', 'bytes/session', 'lookup by address'))
+
+    # Finding a client by its address took a scan of the original table, so there is no lookup to time
+    _, allocated = measure(original_table, clients)
+    print('%-10s %16.0f %20s' % ('original', allocated / args.sessions, '-'))
+
+    tables, allocated = measure(nickname_tables, clients)
+    _, _, table, nicknames = tables
+    started = time.perf_counter()
+    for nickname, address in clients:
+        table[nicknames[address]]
+    elapsed = time.perf_counter() - started
+    print('%-10s %16.0f %18.3fus' % ('nickname', allocated / args.sessions, elapsed / args.sessions * 1000000))
+
+    sessions, allocated = measure(session_table, clients)
+    started = time.perf_counter()
+    for nickname, address in clients:
+        sessions.at(address)
+    elapsed = time.perf_counter() - started
+    print('%-10s %16.0f %18.3fus' % ('session', allocated / args.sessions, elapsed / args.sessions * 1000000))
+
+    # Binary clients each have a channel as well, whichever table they are kept in
+    _, allocated = measure(channels, clients)
+    print('%-10s %16.0f %20s' % ('channel', allocated / args.sessions, '-'))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import socket
+
+# Receives without waiting, where the platform allows it, so a socket can be drained
+# of every queued datagram after a single select()
+DONTWAIT = getattr(socket, 'MSG_DONTWAIT', 0)
+
+
+class BufferPool:
+    """Preallocated buffers which datagrams are received straight into, so the
+    receive loop allocates nothing for the datagram itself.
+
+    Each datagram is handed out as a memoryview into its buffer, which is only
+    valid until the pool comes back around to that buffer, so anything kept
+    beyond handling the datagram must be copied out of it"""
+
+    def __init__(self, count, size):
+        self.size = size
+        self.buffers = [bytearray(size) for _ in range(count)]
+        self.views = [memoryview(buffer) for buffer in self.buffers]
+
+    def receive(self, sock):
+        """Yields the (memoryview, (address, port)) of each datagram waiting on a
+        socket, up to one for each buffer"""
+
+        for view in self.views:
+            try:
+                length, address = sock.recvfrom_into(view, self.size, DONTWAIT)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionResetError:
+                # Windows reports an earlier send which was refused; carry on
+                continue
+
+            yield view[:length], address
+
+            # Without MSG_DONTWAIT, another receive could block, so stop at one
+            if not DONTWAIT:
+                return
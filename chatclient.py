@@ -0,0 +1,536 @@
+import asyncio
+import logging
+import random
+import socket
+import time
+from collections import deque
+
+import compression
+import multicast
+import protocol
+from fragments import Reassembler, ReassemblyError
+from reliability import Channel
+
+JOIN_TIMEOUT = 10.0  # How long, in seconds, to wait for the chat server to welcome a client or turn it away
+JOIN_RETRY = 0.5  # How long, in seconds, to wait for an answer before first asking to join again
+MAX_JOIN_RETRY = 4.0  # The longest, in seconds, to wait between asking to join, as the wait doubles each time
+HEARTBEAT_INTERVAL = 10.0  # How often, in seconds, a heartbeat is sent, so the chat server does not time the client out
+CLOSE_TIMEOUT = 1.0  # How long, in seconds, leaving waits for the chat server to acknowledge the client has quit
+MTU = 1472  # The largest datagram, in bytes, sent to the chat server, as larger messages are sent in pieces
+MAX_RECEIVED_SIZE = 0xFFFF  # The largest message from the chat server put back together from its pieces
+
+logger = logging.getLogger('chatclient')
+
+
+class NicknameTaken(Exception):
+    """Raised when the chat server turns a client away, as its nickname is already taken"""
+
+
+def text(message):
+    """The text a message from the chat server shows in the chat, or None if
+    it shows nothing"""
+
+    # Replayed messages carry their log sequence number ahead of the text
+    if message.type == protocol.HISTORY:
+        return str(message.payload[protocol.HISTORY_ENTRY.size:], 'utf-8', 'replace')
+
+    if message.type in (protocol.TEXT, protocol.WELCOME):
+        return str(message.payload, 'utf-8', 'replace')
+
+    return None
+
+
+class ChatClient(asyncio.DatagramProtocol):
+    """A client's session with a chat server, on an asyncio event loop.
+
+    Messages from the chat server are put in order and acknowledged as they
+    arrive, and are read with 'async for message in client'. Retransmissions
+    and heartbeats are timers on the loop, rather than a thread of their own,
+    so any number of clients (e.g. bots, or a bridge to another chat) can
+    share one loop. Use connect() to join the chat"""
+
+    def __init__(self, server, nickname, legacy=False, compress=True, use_multicast=True):
+        # The (address, port) tuple of the chat server
+        self.server = server
+
+        self.nickname = nickname
+
+        # Whether the client speaks the legacy comma separated text format,
+        # whether it offers to compress payloads, and whether it joins the
+        # multicast group the chat server may invite it to
+        self.legacy = legacy
+        self.compress = compress
+        self.use_multicast = use_multicast
+
+        # The reliable channel to the chat server (None for legacy clients)
+        self.channel = None if legacy else Channel(server, nickname=nickname)
+
+        # Messages too large for one datagram are sent in pieces of this many
+        # bytes, and those from the chat server are put back together
+        self.fragment_size = MTU - protocol.HEADER.size - protocol.FRAGMENT_HEADER.size - \
+            len(str.encode(nickname, 'utf-8'))
+        self.reassembler = Reassembler(MAX_RECEIVED_SIZE)
+
+        # The id every request to join carries, so the chat server can tell a
+        # retry from a new join (legacy clients are told apart by their nickname)
+        self.request_id = random.getrandbits(32) or 1
+
+        # The number of bytes compression has saved on the messages sent
+        self.bytes_saved = 0
+
+        # The log sequence number of the latest message replayed from the room's
+        # log, to catch up from with request_history(since=...) (0 for none)
+        self.last_logged = 0
+
+        # The transport of the client's own socket, once it has been made
+        self.transport = None
+
+        # Once invited to a multicast group, the transport of the socket which
+        # has joined it (and the task joining it), and the room's Stream of
+        # multicast messages, once the chat server has started publishing to it
+        self.multicast_transport = None
+        self.joining_group = None
+        self.stream = None
+
+        # The (arrived, sequence number, room, text) of the latest multicast messages
+        # for any other room, in case they are for the room the client is moving
+        # into, which the chat server's invitation to it has not named yet
+        self.early = deque(maxlen=multicast.MAX_HELD)
+
+        # Resolved once the chat server has welcomed the client, or turned it away
+        loop = asyncio.get_running_loop()
+        self.joined = loop.create_future()
+
+        # The messages delivered, waiting to be read, followed by None once the client has closed
+        self.incoming = asyncio.Queue()
+
+        # The loop's pending call to retransmit or send a heartbeat, and when it is due
+        self.timer = None
+        self.deadline = None
+        self.next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+
+        # Resolved once everything sent has been acknowledged, while leaving
+        self.drained = None
+
+        self.closed = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        message = await self.incoming.get()
+
+        if message is None:
+            # Leave the end marker for anyone else reading
+            self.incoming.put_nowait(None)
+            raise StopAsyncIteration
+
+        return message
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        try:
+            message = protocol.decode_reply(data)
+
+            # A batch carries several messages, which are put in order and acknowledged together
+            messages = [message] if self.channel is None else protocol.unbatch(message)
+        except (protocol.ProtocolError, UnicodeDecodeError):
+            # Skip datagrams which cannot be decoded
+            return
+
+        if message.type == protocol.NICKNAME_TAKEN:
+            if not self.joined.done():
+                self.joined.set_exception(NicknameTaken(self.nickname))
+            return
+
+        if self.channel is None:
+            delivered = messages
+        else:
+            delivered, replies = self.channel.process_batch(messages, time.monotonic())
+            for reply in replies:
+                self.transport.sendto(reply)
+
+            if self.drained is not None and not self.channel.in_flight and not self.drained.done():
+                self.drained.set_result(None)
+
+            self.schedule()
+
+        for message in delivered:
+            # Put messages sent in pieces back together, once every piece has arrived
+            if message.type == protocol.FRAGMENT:
+                try:
+                    message = self.reassembler.add(0, message, time.monotonic())
+                except ReassemblyError as e:
+                    logger.debug("[!] Dropped a fragmented message: %s", e, extra=dict(event='reassembly_dropped'))
+                    continue
+
+                if message is None:
+                    continue
+
+            if message.type == protocol.MULTICAST_INVITE:
+                self.on_invitation(message.payload)
+                continue
+
+            # The room's multicast messages which were missed, or too large for one datagram
+            if message.type == protocol.MULTICAST:
+                self.on_multicast(message.payload)
+                continue
+
+            if message.type == protocol.COMPRESSION:
+                # Compress what is sent from here on, if the chat server has agreed to it
+                self.channel.codec = compression.NAMES.get(str(message.payload, 'ascii', 'replace'))
+                continue
+
+            if message.type == protocol.WELCOME and self.channel is not None:
+                # Keep the session id the chat server issued to this client
+                self.channel.session_id = message.session_id
+
+            if message.type == protocol.HISTORY and len(message.payload) >= protocol.HISTORY_ENTRY.size:
+                (sequence,) = protocol.HISTORY_ENTRY.unpack_from(message.payload)
+                self.last_logged = max(self.last_logged, sequence)
+
+            self.incoming.put_nowait(message)
+
+            # Legacy clients are welcomed by any reply other than the nickname-taken message
+            if not self.joined.done() and (self.legacy or message.type == protocol.WELCOME):
+                self.joined.set_result(message)
+
+    def on_invitation(self, payload):
+        """Joins the multicast group the chat server has invited the client to,
+        or, once it is publishing to the client, starts putting the room's
+        multicast messages in order"""
+
+        invitation = protocol.MULTICAST_INVITATION
+        if len(payload) < invitation.size:
+            return
+
+        group, port, sequence, publishing, room_length = invitation.unpack_from(payload)
+        room = str(payload[invitation.size:invitation.size + room_length], 'utf-8', 'replace')
+
+        # The room's messages start with sequence, whether the client has just
+        # started receiving from the group or has moved into another room
+        if publishing:
+            self.stream = multicast.Stream(room, sequence)
+
+            # Put in order the room's messages which arrived ahead of the invitation
+            now = time.monotonic()
+            for arrived, early_sequence, early_room, early_text in self.early:
+                if early_room == room and now - arrived < multicast.GAP_TIMEOUT:
+                    for text in self.stream.receive(early_sequence, room, early_text, now):
+                        self.incoming.put_nowait(protocol.Message(protocol.TEXT, 0, 0, '', text))
+            self.early.clear()
+
+            self.schedule()
+            return
+
+        if self.use_multicast and self.joining_group is None:
+            self.joining_group = asyncio.get_running_loop().create_task(
+                self.join_group((socket.inet_ntoa(group), port)))
+
+    async def join_group(self, group):
+        """Joins a multicast group, and lets the chat server know, so it stops
+        sending the room's broadcasts through the client's channel"""
+
+        # Join through the interface the client reaches the chat server on
+        interface = self.transport.get_extra_info('sockname')[0]
+
+        try:
+            receiver = multicast.join(group, interface)
+            self.multicast_transport, _ = await asyncio.get_running_loop().create_datagram_endpoint(
+                lambda: MulticastProtocol(self), sock=receiver)
+        except OSError as e:
+            # Carry on receiving everything through the channel
+            logger.debug("[!] Could not join the multicast group %s: %s", group, e,
+                         extra=dict(event='multicast_unavailable'))
+            return
+
+        if self.closed:
+            self.multicast_transport.close()
+            return
+
+        self.send_message(protocol.MULTICAST_ACCEPT)
+
+    def multicast_received(self, data, address):
+        """Handles a datagram from the multicast group"""
+
+        # Only the chat server's own messages are taken from the group
+        if address != self.transport.get_extra_info('peername'):
+            return
+
+        try:
+            message = protocol.decode(data)
+        except (protocol.ProtocolError, UnicodeDecodeError):
+            return
+
+        if message.type == protocol.MULTICAST:
+            self.on_multicast(message.payload)
+
+    def on_multicast(self, payload):
+        """Puts one of the room's multicast messages in order, delivering those
+        which are ready. Any which were missed are asked for on the timer, in
+        case they are only running late"""
+
+        try:
+            sequence, room, text = multicast.decode_entry(payload)
+        except (protocol.ProtocolError, UnicodeDecodeError):
+            return
+
+        now = time.monotonic()
+
+        if self.stream is None or room != self.stream.room:
+            self.early.append((now, sequence, room, text))
+            return
+
+        for text in self.stream.receive(sequence, room, text, now):
+            self.incoming.put_nowait(protocol.Message(protocol.TEXT, 0, 0, '', text))
+
+        self.schedule()
+
+    def error_received(self, exc):
+        # e.g. the chat server is not running (yet); the channel retransmits, or gives up
+        logger.debug("[!] %s", exc, extra=dict(event='socket_error'))
+
+    def connection_lost(self, exc):
+        self.abort()
+
+    def join(self):
+        """Asks the chat server to let the client in, offering the compression
+        codecs it supports. Asking again is harmless, as the chat server only
+        lets the client in once"""
+
+        if self.legacy:
+            self.transport.sendto(protocol.encode_legacy(self.nickname, protocol.LEGACY_NEW_CLIENT_MESSAGE))
+        else:
+            codecs = ','.join(compression.available()) if self.compress else ''
+            self.transport.sendto(protocol.encode(protocol.JOIN, self.request_id, self.nickname, codecs))
+
+        self.schedule()
+
+    def send(self, line):
+        """Sends a line typed into the chat, which may be a command such as
+        '{join <room>}'. Leave the chat with close(), rather than '{quit}'.
+        Raises ValueError if the line is longer than protocol.MAX_MESSAGE_SIZE
+        bytes"""
+
+        if self.closed:
+            return
+
+        # Legacy clients send the text as it is
+        if self.channel is None:
+            self.transport.sendto(protocol.encode_legacy(self.nickname, line))
+            return
+
+        self.send_message(*protocol.parse_command(line))
+
+    def request_history(self, count=None, since=None):
+        """Asks the chat server to replay its log of the client's room: the last
+        count messages (as many as it replays at once, if None), or every
+        message logged after the log sequence number since (e.g. last_logged,
+        to catch up on what was missed while away). Legacy clients can only
+        ask for the last messages"""
+
+        if since is not None:
+            request = protocol.REPLAY_REQUEST.pack(protocol.REPLAY_SINCE, since)
+        else:
+            request = protocol.REPLAY_REQUEST.pack(protocol.REPLAY_LAST, protocol.REPLAY_ALL if count is None else count)
+
+        self.send_message(protocol.REPLAY, request)
+
+    def send_message(self, message_type, payload=b''):
+        """Sends a message through the channel, which numbers it and retransmits
+        it until it has been acknowledged. Messages too large for one datagram
+        are sent in pieces, up to protocol.MAX_MESSAGE_SIZE bytes. Legacy
+        clients send the message typed out instead, raising ProtocolError for
+        messages the legacy format has no way of sending"""
+
+        if self.closed:
+            return
+
+        if len(payload) > protocol.MAX_MESSAGE_SIZE:
+            raise ValueError('messages are limited to %d bytes' % protocol.MAX_MESSAGE_SIZE)
+
+        if self.channel is None:
+            self.transport.sendto(protocol.encode_legacy(self.nickname, protocol.format_legacy(message_type, payload)))
+            return
+
+        # Compress the payload, if the chat server has agreed to it
+        compressed_type, compressed = protocol.compress(message_type, payload, self.channel.codec)
+        self.bytes_saved = self.bytes_saved + len(payload) - len(compressed)
+
+        now = time.monotonic()
+        for fragment_type, fragment in protocol.fragment(compressed_type, compressed, self.fragment_size):
+            datagram = self.channel.send(fragment_type, fragment, now)
+            if datagram is not None:
+                self.transport.sendto(datagram)
+
+        self.schedule()
+
+    def schedule(self):
+        """Makes sure the loop calls back when the next retransmission or
+        heartbeat is due"""
+
+        if self.closed:
+            return
+
+        deadline = self.next_heartbeat
+        if self.channel is not None and self.channel.deadline is not None:
+            deadline = min(deadline, self.channel.deadline)
+        if self.stream is not None and self.stream.deadline is not None:
+            deadline = min(deadline, self.stream.deadline)
+
+        if deadline == self.deadline:
+            return
+
+        if self.timer is not None:
+            self.timer.cancel()
+
+        self.deadline = deadline
+        self.timer = asyncio.get_running_loop().call_later(max(deadline - time.monotonic(), 0), self.on_timer)
+
+    def on_timer(self):
+        """Retransmits the messages which have not been acknowledged in time, and
+        lets the chat server know the client is still there"""
+
+        self.timer = None
+        self.deadline = None
+        now = time.monotonic()
+
+        if self.channel is not None:
+            for datagram in self.channel.poll(now):
+                self.transport.sendto(datagram)
+
+            # Give up once the chat server has stopped acknowledging messages
+            if self.channel.lost:
+                logger.warning("[!] The chat server has stopped answering %s", self.nickname,
+                               extra=dict(event='lost', nickname=self.nickname))
+                self.abort()
+                return
+
+        # Ask for the room's multicast messages which are still missing, and skip
+        # those which were never sent again
+        if self.stream is not None:
+            delivered, missing = self.stream.poll(now)
+
+            for text in delivered:
+                self.incoming.put_nowait(protocol.Message(protocol.TEXT, 0, 0, '', text))
+
+            if missing is not None:
+                self.send_message(protocol.MULTICAST_REPAIR, protocol.MULTICAST_RANGE.pack(*missing))
+
+        if now >= self.next_heartbeat:
+            if self.channel is None:
+                self.transport.sendto(protocol.encode_legacy(self.nickname, protocol.LEGACY_HEARTBEAT_MESSAGE))
+            else:
+                self.transport.sendto(protocol.encode(protocol.HEARTBEAT, self.channel.session_id, self.nickname))
+
+            self.next_heartbeat = now + HEARTBEAT_INTERVAL
+
+        self.schedule()
+
+    async def close(self):
+        """Leaves the chat, waiting up to CLOSE_TIMEOUT for the chat server to
+        acknowledge it, then closes the client's socket and ends the messages"""
+
+        if self.closed:
+            return
+
+        if self.joined.done() and not self.joined.cancelled() and self.joined.exception() is None:
+            if self.channel is None:
+                self.transport.sendto(protocol.encode_legacy(self.nickname, protocol.LEGACY_QUIT_MESSAGE))
+            else:
+                self.send_message(protocol.QUIT)
+
+                self.drained = asyncio.get_running_loop().create_future()
+                if not self.channel.in_flight:
+                    self.drained.set_result(None)
+
+                try:
+                    await asyncio.wait_for(self.drained, CLOSE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    pass
+
+        self.abort()
+
+    def abort(self):
+        """Closes the client's socket, without leaving the chat"""
+
+        if self.closed:
+            return
+
+        self.closed = True
+
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if not self.joined.done():
+            self.joined.cancel()
+
+        if self.joining_group is not None:
+            self.joining_group.cancel()
+
+        if self.multicast_transport is not None:
+            self.multicast_transport.close()
+
+        if self.transport is not None:
+            self.transport.close()
+
+        self.incoming.put_nowait(None)
+
+
+class MulticastProtocol(asyncio.DatagramProtocol):
+    """Feeds the datagrams from a multicast group into a chat client"""
+
+    def __init__(self, client):
+        self.client = client
+
+    def datagram_received(self, data, address):
+        self.client.multicast_received(data, address)
+
+
+async def connect(server, nickname, legacy=False, compress=True, timeout=JOIN_TIMEOUT, use_multicast=True):
+    """Joins the chat on a chat server, returning the ChatClient once it has
+    been welcomed. Raises NicknameTaken if the nickname is already in use,
+    or TimeoutError if the chat server does not answer within timeout"""
+
+    loop = asyncio.get_running_loop()
+    deadline = time.monotonic() + timeout
+
+    # Each client has a socket of its own, as the chat server tells clients apart by their address
+    _, client = await loop.create_datagram_endpoint(
+        lambda: ChatClient(server, nickname, legacy, compress, use_multicast), remote_addr=server)
+
+    try:
+        retry = JOIN_RETRY
+
+        while 1:
+            client.join()
+
+            # Back off exponentially while the chat server does not answer, waiting a
+            # random half to all of the backoff, so clients joining at once (e.g. after
+            # the chat server restarts) spread their retries out
+            wait = min(random.uniform(retry / 2, retry), deadline - time.monotonic())
+            if wait <= 0:
+                raise TimeoutError('the chat server did not answer within %gs' % timeout)
+
+            await asyncio.wait([client.joined], timeout=wait)
+            if client.joined.done():
+                break
+
+            retry = min(retry * 2, MAX_JOIN_RETRY)
+
+        # Raises NicknameTaken, should the chat server have turned the client away
+        client.joined.result()
+    except BaseException:
+        client.abort()
+        raise
+
+    return client
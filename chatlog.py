@@ -0,0 +1,243 @@
+import bisect
+import mmap
+import os
+import struct
+from array import array
+
+# Each record: its sequence number and the length of the message which follows
+RECORD = struct.Struct('!QI')
+
+SEGMENT_SIZE = 4 * 1024 * 1024  # The size, in bytes, a segment grows to before the next one is started
+MAX_SEGMENTS = 16  # The most segments kept for each room, before the oldest is deleted
+INDEX_INTERVAL = 64  # How many records apart the entries of the sparse index are
+
+
+class Segment:
+    """One file of a room's log, holding the records numbered from first onwards.
+
+    Only the last segment of a log is appended to. Every segment is read
+    through a memory map, and a sparse index of the offset of every
+    INDEX_INTERVAL'th record finds a sequence number with one short scan"""
+
+    def __init__(self, path, first):
+        self.path = path
+        self.first = first
+
+        # Appends go straight to the file, so the memory map sees them at once
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        self.size = 0
+
+        # The sequence number -> offset entries of the sparse index
+        self.sequences = array('Q')
+        self.offsets = array('Q')
+
+        # The number of records in the segment
+        self.count = 0
+
+        # The read-only memory map of the segment, remapped as the segment grows
+        self.mapping = None
+
+        # The number of replays reading the segment, and whether it has been
+        # rotated out of its log, to be deleted once the last of them finishes
+        self.readers = 0
+        self.retired = False
+
+        # Index the records already in the file, dropping any torn record at its end
+        end = os.fstat(self.fd).st_size
+        if end:
+            mapping = mmap.mmap(self.fd, end, access=mmap.ACCESS_READ)
+            while self.size + RECORD.size <= end:
+                sequence, length = RECORD.unpack_from(mapping, self.size)
+                if self.size + RECORD.size + length > end:
+                    break
+
+                self.index(sequence, RECORD.size + length)
+            mapping.close()
+
+            if self.size < end:
+                os.truncate(self.fd, self.size)
+
+    @property
+    def last(self):
+        """The sequence number of the last record in the segment"""
+
+        return self.first + self.count - 1
+
+    def index(self, sequence, length):
+        """Accounts for a record of length bytes at the end of the segment"""
+
+        if self.count % INDEX_INTERVAL == 0:
+            self.sequences.append(sequence)
+            self.offsets.append(self.size)
+
+        self.count = self.count + 1
+        self.size = self.size + length
+
+    def append(self, sequence, message):
+        """Appends a record to the end of the segment"""
+
+        record = RECORD.pack(sequence, len(message)) + message
+        os.write(self.fd, record)
+        self.index(sequence, len(record))
+
+    def read(self, start, stop):
+        """Yields the (sequence number, message) of the records numbered from start
+        up to stop"""
+
+        start = max(start, self.first)
+        stop = min(stop, self.last + 1)
+        if start >= stop:
+            return
+
+        # Map in whatever has been appended since the segment was last read. The
+        # old map is left for any replay still reading from it to let go of
+        if self.mapping is None or len(self.mapping) < self.size:
+            self.mapping = mmap.mmap(self.fd, self.size, access=mmap.ACCESS_READ)
+
+        mapping = self.mapping
+
+        # Start from the closest indexed record, and scan forwards from there
+        offset = self.offsets[bisect.bisect_right(self.sequences, start) - 1]
+        end = self.size
+
+        while offset < end:
+            sequence, length = RECORD.unpack_from(mapping, offset)
+            if sequence >= stop:
+                return
+
+            if sequence >= start:
+                yield sequence, mapping[offset + RECORD.size:offset + RECORD.size + length]
+
+            offset = offset + RECORD.size + length
+
+    def release(self):
+        """Lets go of the segment once a replay has finished reading it"""
+
+        self.readers = self.readers - 1
+        if self.retired and not self.readers:
+            self.delete()
+
+    def retire(self):
+        """Deletes a segment rotated out of its log, or, while replays are still
+        reading it, leaves that to the last of them to finish"""
+
+        self.retired = True
+        if not self.readers:
+            self.delete()
+
+    def delete(self):
+        self.close()
+        os.remove(self.path)
+
+    def close(self):
+        if self.mapping is not None:
+            self.mapping.close()
+            self.mapping = None
+
+        os.close(self.fd)
+
+
+class RoomLog:
+    """The append-only, segment-rotated log of every message broadcast to a room"""
+
+    def __init__(self, directory):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+
+        # The segments of the log, oldest first, each named after its first sequence number
+        self.segments = [Segment(os.path.join(directory, name), int(name.split('.')[0]))
+                         for name in sorted(os.listdir(directory)) if name.endswith('.log')]
+        self.firsts = [segment.first for segment in self.segments]
+
+        if not self.segments:
+            self.rotate(1)
+
+    @property
+    def head(self):
+        """The sequence number of the last message logged"""
+
+        return self.segments[-1].last
+
+    def append(self, message):
+        """Logs a message, returning its sequence number"""
+
+        segment = self.segments[-1]
+        if segment.size >= SEGMENT_SIZE:
+            segment = self.rotate(segment.last + 1)
+
+        sequence = segment.last + 1
+        segment.append(sequence, message)
+
+        return sequence
+
+    def rotate(self, first):
+        """Starts a new segment, deleting the oldest once there are too many"""
+
+        segment = Segment(os.path.join(self.directory, '%020d.log' % first), first)
+        self.segments.append(segment)
+        self.firsts.append(first)
+
+        while len(self.segments) > MAX_SEGMENTS:
+            oldest = self.segments.pop(0)
+            self.firsts.pop(0)
+            oldest.retire()
+
+        return segment
+
+    def read(self, start, stop=None):
+        """Yields the (sequence number, message) of the messages numbered from
+        start up to stop (or the current head)"""
+
+        if stop is None:
+            stop = self.head + 1
+
+        position = max(bisect.bisect_right(self.firsts, start) - 1, 0)
+
+        # Hold on to the segments being read, so rotation does not delete them
+        # from under a replay which is still going
+        segments = [segment for segment in self.segments[position:] if segment.first < stop]
+        for segment in segments:
+            segment.readers = segment.readers + 1
+
+        try:
+            for segment in segments:
+                yield from segment.read(start, stop)
+        finally:
+            for segment in segments:
+                segment.release()
+
+    def last(self, count):
+        """Yields the last count messages"""
+
+        head = self.head
+        return self.read(head - count + 1, head + 1)
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+
+
+class ChatLog:
+    """The logs of every room, each in a directory of its own"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.rooms = {}
+
+    def room(self, room):
+        """The log of a room, opening it on first use"""
+
+        log = self.rooms.get(room)
+        if log is None:
+            log = self.rooms[room] = RoomLog(os.path.join(self.directory, room))
+
+        return log
+
+    def append(self, room, message):
+        """Logs a message broadcast to a room, returning its sequence number"""
+
+        return self.room(room).append(message)
+
+    def close(self):
+        for log in self.rooms.values():
+            log.close()
@@ -1,22 +1,63 @@
 from tkinter import *
 from tkinter import messagebox
+from tkinter import simpledialog
 
-import socket
+import asyncio
+import logging
+import os
+import queue
 import threading
 import re
+from collections import deque
+
+import chatclient
+import logs
+import protocol
+from chatclient import NicknameTaken
+from history import History
+from logs import Sampler
 
 # Types of messages sent by the client
-NEW_CLIENT_MESSAGE = '{NEW CLIENT REQUEST}'  # Used to indicated a new client is connecting to the server
 QUIT_MESSAGE = '{QUIT}'  # Used to indicate a client is leaving the chat
-NICKNAME_ALREADY_EXISTS_MESSAGE = '{NICKNAME ALREADY EXISTS}'  # Used to indicate that the nickname already exists
 BLANK_MESSAGE = ''  # Used to indicate a totally blank message
 
+# Speak the legacy comma separated text format, instead of the binary protocol
+LEGACY_PROTOCOL = False
 
-class Login(Tk):
-    BUFFER_SIZE = 4096
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+# Offer to compress payloads, which the chat server may agree to
+COMPRESSION = True
+
+# How many of the room's latest messages to ask the chat server to replay on joining
+REPLAY_ON_JOIN = 20
+
+# How often, in milliseconds, the window adds received messages to the feed, and
+# the most lines added at once, so the window stays responsive under a flood
+FEED_INTERVAL = 50
+MAX_FEED_LINES = 200
+
+# The most lines the feed holds at once, and how many are read back from the
+# history at a time as the client scrolls beyond them
+FEED_SIZE = 500
+FEED_PAGE = 100
+
+# Where the history of each nickname's chat feed is kept
+HISTORY_DIRECTORY = os.path.join(os.path.expanduser('~'), '.udp-chat')
 
-    def __init__(self, server):
+# The least severe level logged, whether it is logged as JSON lines, and one in
+# how many of the messages sent and received are logged, at the debug level
+LOG_LEVEL = 'info'
+LOG_JSON = False
+LOG_SAMPLE = 1
+
+logger = logging.getLogger('client')
+
+# Decide which of the messages sent and received are logged
+sample_sent = Sampler(logger, logging.DEBUG, LOG_SAMPLE)
+sample_received = Sampler(logger, logging.DEBUG, LOG_SAMPLE)
+
+
+class Login(Tk):
+    def __init__(self, server, loop):
         super().__init__()
 
         # The (address, port) tuple of the server
@@ -25,6 +66,11 @@ class Login(Tk):
         # Demuxify the server (address, port) tuple
         self.server_addr, self.server_port = self.server
 
+        # The event loop the chat client runs on, in a thread of its own, and
+        # the chat client, once the nickname has been accepted
+        self.loop = loop
+        self.client = None
+
         # Set the title of the window
         self.title('Chat Client Login')
 
@@ -83,67 +129,48 @@ class Login(Tk):
             self.connect()
 
     def connect(self):
-        """Connects to the chat server"""
+        """Connects to the chat server, without holding up the window while
+        waiting for the chat server to answer"""
 
         # Choose a unique nickname
         nickname = self.nickname_entry.get()
 
-        # Determine if the nickname does not already exist
-        if not self.does_nickname_already_exist(nickname):
-            # Show that the client has successfully connected
-            print("[+] 🖥️ Client (%s, '%s', %s): has connected" % (nickname, self.server_addr, self.server_port))
-
-            # Close the login window
-            self.on_window_close()
-
-            # Open the Chat Client window
-            Client(nickname, self.client_socket, self.server).mainloop()
-        else:
-            # If the nickname is not unique, then:
-
-            # Close the login window
-            self.on_window_close()
-
-            # Create & open a new client login application window to try again
-            Login(('127.0.0.1', 4096)).mainloop()
-
-    def on_window_close(self):
-        """Closes and terminates the root window of this application"""
-
-        self.destroy()
-
-    def does_nickname_already_exist(self, nickname):
-        """Determines if the client's chosen nickname already exists within the
-        chat server's connected client list"""
+        # Join the chat on the event loop's thread, and check back for the answer
+        self.connect_button.config(state='disabled')
+        joining = asyncio.run_coroutine_threadsafe(
+            chatclient.connect(self.server, nickname, LEGACY_PROTOCOL, COMPRESSION), self.loop)
+        self.after(FEED_INTERVAL, self.await_join, nickname, joining)
 
-        # Construct the client payload to be sent to the chat server
-        payload = encode(nickname, NEW_CLIENT_MESSAGE)
+    def await_join(self, nickname, joining):
+        """Opens the chat once the chat server has welcomed the client, or lets
+        the client try again"""
 
-        # Send the payload to the chat server
-        self.client_socket.sendto(payload, self.server)
+        if not joining.done():
+            self.after(FEED_INTERVAL, self.await_join, nickname, joining)
+            return
 
-        # Obtain the response message from the chat server
-        response, server_addr = self.client_socket.recvfrom(self.BUFFER_SIZE)
+        self.connect_button.config(state='normal')
 
-        # Decode the response byte-stream
-        response = response.decode('utf-8')
-
-        # Check if the response indicates that the nickname already exists
-        if response == NICKNAME_ALREADY_EXISTS_MESSAGE:
+        try:
+            self.client = joining.result()
+        except NicknameTaken:
             # Show that the nickname already exists
             messagebox.showerror('Error', 'Nickname is already taken.')
-            print("[!] ('%s'): is already taken." % nickname)
+            logger.warning("[!] ('%s'): is already taken.", nickname, extra=dict(event='nickname_taken'))
 
-            # Clear the nickname entry field
+            # Clear the nickname entry field, to try again
             self.nickname.set('')
+            return
+        except (TimeoutError, OSError):
+            messagebox.showerror('Error', 'The chat server is not answering.')
+            return
 
-            # Nickname is not unique and exists within the server's
-            # connected client list
-            return True
-        else:
-            # Nickname is unique and does not exist within the server's
-            # connected client list
-            return False
+        # Show that the client has successfully connected
+        logger.info("[+] 🖥️ Client (%s, '%s', %s): has connected", nickname, self.server_addr, self.server_port,
+                    extra=dict(event='connected', nickname=nickname))
+
+        # Close the login window, for the Chat Client window to open
+        self.on_window_close()
 
     @staticmethod
     def is_valid_nickname(nickname):
@@ -158,20 +185,19 @@ class Login(Tk):
 # -----------------------------------------
 
 class Client(Tk):
-    # The size of the buffer to receive data from chat server
-    BUFFER_SIZE = 4096
-
-    def __init__(self, nickname, client_socket, server):
+    def __init__(self, client, loop):
         super().__init__()
 
         # The nickname of the client
-        self.nickname = nickname
+        nickname = self.nickname = client.nickname
 
-        # The connection between the client and the chat server
-        self.client_socket = client_socket
+        # The chat client, which only the event loop's thread may touch, so the
+        # window hands it work through the loop
+        self.client = client
+        self.loop = loop
 
         # The (address, port) tuple of the server
-        self.server = server
+        self.server = client.server
 
         # Demuxify the server (address, port) tuple
         self.server_addr, self.server_port = self.server
@@ -198,10 +224,33 @@ class Client(Tk):
         self.scrollbar.place(relx=1, rely=0.85)
 
         # The feed where messages are displayed
-        self.feed = Text(self, yscrollcommand=self.scrollbar.set, font=('Operator Mono', 14))
+        self.feed = Text(self, yscrollcommand=self.on_feed_scroll, font=('Operator Mono', 14))
         self.feed.pack()
         self.feed.place(relheight=0.85, relwidth=1, relx=0, rely=0)
 
+        # Highlight the line found by a search
+        self.feed.tag_config('match', background='yellow')
+
+        # Every line shown in the feed is kept in the history, while the feed only
+        # holds the lines from start up to end. The most recent lines are also
+        # kept in memory, to jump back to them without reading the history
+        self.history = History(os.path.join(HISTORY_DIRECTORY, '%s.history' % nickname))
+        self.feed_start = self.feed_end = len(self.history)
+        self.recent = deque(maxlen=FEED_SIZE)
+
+        # Set while a page of history is waiting to be read into the feed
+        self.paging = False
+
+        # The history lines matching the last search, and the one being shown
+        self.matches = []
+        self.match = 0
+
+        # Bind 'control-f' to search the history, 'F3' to find the next match,
+        # and 'control-end' to jump back to the latest messages
+        self.bind('<Control-f>', self.on_search)
+        self.bind('<F3>', self.on_next_match)
+        self.bind('<Control-End>', self.on_latest)
+
         # Configure the scrollbar to use the message feed
         self.scrollbar.config(command=self.feed.yview)
 
@@ -222,23 +271,48 @@ class Client(Tk):
         self.message_button.pack()
         self.message_button.place(relx=0.75, rely=0.89)
 
-        # Start the thread to handle receiving of messages
-        threading.Thread(target=self.receive_message, args=(self.client_socket,)).start()
+        # The lines of text waiting to be added to the feed. Only the thread
+        # running the window may touch its widgets, so the event loop's thread
+        # hands lines over through this queue
+        self.incoming = queue.SimpleQueue()
+
+        # Start adding received messages to the feed
+        self.after(FEED_INTERVAL, self.update_feed)
+
+        # Start handing the messages received over to the window, beginning with
+        # those received while joining the chat
+        asyncio.run_coroutine_threadsafe(self.receive_messages(), self.loop)
+
+        # Catch up on what was said in the room before joining
+        if not client.legacy and REPLAY_ON_JOIN:
+            self.loop.call_soon_threadsafe(client.request_history, REPLAY_ON_JOIN)
 
     def on_window_close(self):
-        """Closes and terminates the root window of this application"""
+        """Leaves the chat, and closes the root window of this application"""
+
+        # Wait for the chat server to acknowledge the client leaving, though not for long
+        try:
+            asyncio.run_coroutine_threadsafe(self.client.close(), self.loop).result(chatclient.CLOSE_TIMEOUT * 2)
+        except Exception:
+            pass
+
+        logger.info("[-] 🖥️ Client (%s, '%s', %s): has disconnected", self.nickname, self.server_addr,
+                    self.server_port, extra=dict(event='disconnected', nickname=self.nickname))
 
-        self.message.set('{quit}')
-        self.send_message(self.client_socket)
+        # Show how much bandwidth compression has saved
+        if self.client.channel is not None and self.client.channel.codec is not None:
+            logger.info("[*] Compression saved %d bytes", self.client.bytes_saved,
+                        extra=dict(event='compression', bytes_saved=self.client.bytes_saved))
+
+        self.history.close()
         self.destroy()
-        sys.exit(0)
 
     def on_submit(self):
         """Handles the 'on submit' event"""
 
-        self.send_message(self.client_socket)
+        self.send_message()
 
-    def send_message(self, client_socket):
+    def send_message(self):
         """Handles sending messages to the chat server"""
 
         # Client entered a new message
@@ -247,69 +321,201 @@ class Client(Tk):
         # Clear input field
         self.message.set('')
 
-        # Construct a the client payload
-        payload = encode(self.nickname, message)
+        # Check if the message to be sent is the same as the quit message ('{quit}')
+        if message.lower() == QUIT_MESSAGE.lower():
+            # If message is '{quit}', then leave the chat and close the window
+            self.on_window_close()
+            return
 
-        # Attempt to send a message to the chat server
-        try:
-            client_socket.sendto(payload, self.server)
-        except socket.error:
-            # If there is an error with the socket, then pass
-            pass
+        # Large messages (e.g. pasted logs) are sent in pieces, up to a limit
+        if len(str.encode(message, 'utf-8')) > protocol.MAX_MESSAGE_SIZE:
+            messagebox.showwarning('Warning', 'Messages are limited to %d bytes.' % protocol.MAX_MESSAGE_SIZE)
+            self.message.set(message)
+            return
 
-        # Show the message
-        print("[*] [SENT] %s > %s" % (self.nickname, message))
+        # Hand the message to the chat client, which sends it from the event loop's thread
+        self.loop.call_soon_threadsafe(self.client.send, message)
 
-        # Check if the message to be sent is the same as the quit message ('{quit}')
-        if message.lower() == QUIT_MESSAGE.lower():
-            # If message is '{quit}', then close the client connection and quit
-            print("[-] 🖥️ Client (%s, '%s', %s): has disconnected" % (self.nickname, self.server_addr, self.server_port))
-            client_socket.close()
-            sys.exit(0)
+        # Log the message
+        if sample_sent():
+            logger.debug("[*] [SENT] %s > %s", self.nickname, message,
+                         extra=dict(event='sent', sampled=sample_sent.every))
+
+    async def receive_messages(self):
+        """Hands each message the chat client receives over to the window, on the
+        event loop's thread"""
+
+        async for message in self.client:
+            self.show(message)
+
+        # The chat client closes itself once the chat server stops answering
+        if self.client.channel is not None and self.client.channel.lost:
+            self.incoming.put('[!] The chat server has stopped answering.')
 
-    def receive_message(self, server_socket):
-        """Handles receiving a message from the chat server"""
+    def show(self, message):
+        """Queues a message from the chat server to be shown in the feed"""
 
-        while 1:
-            # Attempt to receive a message from the chat server
+        # Only print text to the feed, and not the nickname-taken message
+        message = chatclient.text(message)
+        if message is None:
+            return
+
+        # Hand the message over to the thread running the window
+        self.incoming.put(message)
+
+        # Log the received message
+        if sample_received():
+            logger.debug("[*] [RECEIVED] %s", message, extra=dict(event='received', sampled=sample_received.every))
+
+    def update_feed(self):
+        """Adds the queued messages to the feed, in batches, from the thread
+        running the window"""
+
+        lines = []
+        while len(lines) < MAX_FEED_LINES:
             try:
-                # Obtain the message and address sent by the chat server
-                message, address = server_socket.recvfrom(self.BUFFER_SIZE)
-
-                # Check if the message exists
-                if message:
-                    # Decode the byte-stream message into a utf-8 string
-                    message = message.decode('utf-8')
-
-                    # Do not print the NICKNAME_ALREADY_EXISTS_MESSAGE message to the feed
-                    if message.lower() != NICKNAME_ALREADY_EXISTS_MESSAGE.lower():
-                        # Set the state of the feed to 'normal' so it can insert the
-                        # received message from the chat server
-                        self.feed.config(state='normal')
-                        # Insert recent message to the END of the message feed
-                        self.feed.insert(END, message + '\n')
-                        # Disable the feed after inserting the message into the feed
-                        # so that the client cannot insert text or manipulate the
-                        # text within it
-                        self.feed.config(state='disabled')
-
-                        # Show the received message
-                        print("[*] [RECEIVED] %s" % message)
-            except socket.error:
-                # If there is an error with the socket, then break
+                # Each message takes a single line, as it does in the history, so
+                # that the feed's lines stay in step with the history's line numbers
+                lines.append(self.incoming.get_nowait().replace('\n', ' '))
+            except queue.Empty:
                 break
 
-# -----------------------------------------
+        if lines:
+            # Only add the messages to the feed if it is showing the latest lines,
+            # rather than lines the client has scrolled or searched back to
+            following = self.feed_end == len(self.history)
+
+            self.history.append(lines)
+            self.recent.extend(lines)
+
+            if following:
+                # Set the state of the feed to 'normal' so it can insert the
+                # received messages from the chat server
+                self.feed.config(state='normal')
+                # Insert the recent messages to the END of the message feed, all at once
+                self.feed.insert(END, '\n'.join(lines) + '\n')
+                self.feed_end = len(self.history)
+                # Drop the oldest lines, which are kept in the history
+                self.trim_feed(top=True)
+                # Disable the feed after inserting the messages into the feed
+                # so that the client cannot insert text or manipulate the
+                # text within it
+                self.feed.config(state='disabled')
+
+        # Come straight back if messages are still waiting, letting the window
+        # redraw and handle input in between
+        self.after(1 if len(lines) == MAX_FEED_LINES else FEED_INTERVAL, self.update_feed)
+
+    def trim_feed(self, top):
+        """Removes the lines beyond FEED_SIZE from the top or bottom of the feed"""
+
+        excess = (self.feed_end - self.feed_start) - FEED_SIZE
+        if excess <= 0:
+            return
+
+        if top:
+            self.feed.delete('1.0', '%d.0' % (excess + 1))
+            self.feed_start = self.feed_start + excess
+        else:
+            self.feed.delete('%d.0' % (FEED_SIZE + 1), END)
+            self.feed_end = self.feed_end - excess
+
+    def on_feed_scroll(self, first, last):
+        """Moves the scrollbar along with the feed, reading lines back from the
+        history once the client scrolls to either end of the feed"""
+
+        self.scrollbar.set(first, last)
+
+        if self.paging:
+            return
+
+        if float(first) <= 0 and self.feed_start > 0:
+            self.paging = True
+            self.after_idle(self.page_feed, -1)
+        elif float(last) >= 1 and self.feed_end < len(self.history):
+            self.paging = True
+            self.after_idle(self.page_feed, 1)
 
+    def page_feed(self, direction):
+        """Reads the page of history before (-1) or after (1) the feed into it"""
 
-def encode(nickname, message):
-    """Encodes a message as a comma separated list to be sent to the chat server"""
+        self.paging = False
+        self.feed.config(state='normal')
 
-    # Construct the payload
-    payload = '%s,%s' % (nickname, message)
+        if direction < 0 and self.feed_start > 0:
+            count = min(FEED_PAGE, self.feed_start)
+            lines = self.history.read(self.feed_start - count, self.feed_start)
 
-    # Encode the payload as utf-8 byte stream, so it can be sent to the chat server
-    return str.encode(payload, 'utf-8')
+            self.feed.insert('1.0', '\n'.join(lines) + '\n')
+            self.feed_start = self.feed_start - count
+            self.trim_feed(top=False)
+
+            # Keep the line the client was looking at in the same place
+            self.feed.yview('%d.0' % (count + 1))
+        elif direction > 0 and self.feed_end < len(self.history):
+            count = min(FEED_PAGE, len(self.history) - self.feed_end)
+            lines = self.history.read(self.feed_end, self.feed_end + count)
+
+            self.feed.insert(END, '\n'.join(lines) + '\n')
+            self.feed_end = self.feed_end + count
+            self.trim_feed(top=True)
+
+        self.feed.config(state='disabled')
+
+    def load_feed(self, start, lines):
+        """Replaces the contents of the feed with lines, starting from the history line start"""
+
+        self.feed.config(state='normal')
+        self.feed.delete('1.0', END)
+        if lines:
+            self.feed.insert(END, '\n'.join(lines) + '\n')
+        self.feed.config(state='disabled')
+
+        self.feed_start = start
+        self.feed_end = start + len(lines)
+
+    def on_latest(self, event=None):
+        """Jumps the feed back to the latest lines"""
+
+        self.load_feed(len(self.history) - len(self.recent), list(self.recent))
+        self.feed.see(END)
+
+    def on_search(self, event=None):
+        """Searches the history for the lines containing every word entered"""
+
+        query = simpledialog.askstring('Search', 'Find messages containing:', parent=self)
+        if not query:
+            return
+
+        self.matches = self.history.search(query)
+        self.match = 0
+
+        if not self.matches:
+            messagebox.showinfo('Search', 'No messages contain \'%s\'.' % query)
+            return
+
+        self.show_match()
+
+    def on_next_match(self, event=None):
+        """Shows the next older line matching the last search"""
+
+        if self.matches:
+            self.match = (self.match + 1) % len(self.matches)
+            self.show_match()
+
+    def show_match(self):
+        """Loads the history around the current match into the feed, and highlights it"""
+
+        number = self.matches[self.match]
+        start = max(number - FEED_PAGE, 0)
+
+        self.load_feed(start, self.history.read(start, start + FEED_PAGE * 2))
+
+        line = '%d.0' % (number - start + 1)
+        self.feed.tag_add('match', line, '%s lineend' % line)
+        self.feed.see(line)
+
+# -----------------------------------------
 
 
 def center_window(parent, width, height):
@@ -332,5 +538,21 @@ def center_window(parent, width, height):
 # -----------------------------------------
 
 if __name__ == '__main__':
-    # Create & open the client login application window
-    Login(('127.0.0.1', 4096)).mainloop()
+    # Log through a background thread, so sending and receiving never wait on the terminal
+    listener = logs.setup(LOG_LEVEL, LOG_JSON)
+
+    # The chat client runs on an event loop in a thread of its own, as the windows need the main thread
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    try:
+        # Create & open the client login application window
+        login = Login(('127.0.0.1', 4096), loop)
+        login.mainloop()
+
+        # Open the Chat Client window, once the chat server has welcomed the client
+        if login.client is not None:
+            Client(login.client, loop).mainloop()
+    finally:
+        loop.call_soon_threadsafe(loop.stop)
+        listener.stop()
@@ -0,0 +1,94 @@
+from collections import OrderedDict
+
+import protocol
+
+
+class Coalescer:
+    """Holds back the datagrams headed for each client for a short while, so
+    several of them can be packed into a single BATCH datagram of at most
+    budget bytes.
+
+    Every client's batch is held for the same delay, so batches are due in the
+    order they were started, which is the order they are kept in"""
+
+    def __init__(self, budget, delay):
+        # The largest datagram a batch may grow to, in bytes
+        self.budget = budget
+
+        # The longest a datagram is held back, in seconds
+        self.delay = delay
+
+        # The (address, port) -> [datagrams, batch size, deadline] of each pending batch
+        self.pending = OrderedDict()
+
+    def __len__(self):
+        return len(self.pending)
+
+    @property
+    def deadline(self):
+        """When the oldest pending batch is due, or None if nothing is pending"""
+
+        if not self.pending:
+            return None
+
+        return next(iter(self.pending.values()))[2]
+
+    def add(self, address, datagram, now):
+        """Adds a datagram to its client's batch, returning any datagrams which
+        need sending straight away"""
+
+        size = protocol.BATCH_ITEM.size + len(datagram)
+        batch = self.pending.get(address)
+
+        # Datagrams too large to share a batch are sent on their own
+        if protocol.HEADER.size + size > self.budget:
+            if batch is None:
+                return [datagram]
+
+            del self.pending[address]
+            return [self.pack(batch[0]), datagram]
+
+        if batch is None:
+            self.pending[address] = [[datagram], protocol.HEADER.size + size, now + self.delay]
+            return []
+
+        if batch[1] + size <= self.budget:
+            batch[0].append(datagram)
+            batch[1] = batch[1] + size
+            return []
+
+        # The batch is full, so send it, and start the next one at the back of the queue
+        del self.pending[address]
+        self.pending[address] = [[datagram], protocol.HEADER.size + size, now + self.delay]
+
+        return [self.pack(batch[0])]
+
+    def flush(self, now=None):
+        """Removes the batches which are due (or every batch, if now is None),
+        returning their ((address, port), datagram) tuples"""
+
+        due = []
+
+        while self.pending:
+            address, batch = next(iter(self.pending.items()))
+            if now is not None and batch[2] > now:
+                break
+
+            del self.pending[address]
+            due.append((address, self.pack(batch[0])))
+
+        return due
+
+    def discard(self, address):
+        """Forgets the pending batch of a client which has left"""
+
+        self.pending.pop(address, None)
+
+    @staticmethod
+    def pack(datagrams):
+        """A single datagram is sent as it is, rather than in a batch of one"""
+
+        if len(datagrams) == 1:
+            return datagrams[0]
+
+        return protocol.encode_batch(datagrams)
@@ -0,0 +1,119 @@
+import zlib
+
+try:
+    # Use zstd, when it has been installed
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# The codecs a compressed message may use, kept in the top two bits of its message type
+ZLIB = 1
+ZSTD = 2
+CODEC_SHIFT = 6
+TYPE_MASK = (1 << CODEC_SHIFT) - 1
+
+# The names codecs are negotiated by
+NAMES = {'zlib': ZLIB, 'zstd': ZSTD}
+
+# Payloads shorter than this are never worth compressing
+MIN_SIZE = 24
+
+# The largest payload a compressed message may expand into
+MAX_SIZE = 65535
+
+# zlib's window, in bits. Chat messages are short, and a small window is
+# much quicker to set up, so the preset dictionary must fit within it
+WINDOW_BITS = 11
+MEM_LEVEL = 4
+
+# The preset dictionary both ends share. Chat messages are short, so there is
+# little within a message to refer back to, but much which has been seen
+# before in other messages: the server's notices, and common words. The most
+# common strings go last, as they are cheapest to refer to there
+DICTIONARY = (
+    b"Room names must only contain letters and numbers. Rooms: "
+    b"If you ever want to quit, type '{quit}' within the chat client to exit. "
+    b"Type '{join <room>}' to switch rooms, '{leave}' to return here, '{rooms}' to list them "
+    b"and '{history <n>}' to see the last messages. "
+    b"Welcome ! You are in the 'lobby' room. "
+    b"what when where which would could should about there their they this with have from your "
+    b"just like know think good going really yeah okay thanks sorry hello hey lol "
+    b"has joined the room ' has left the room. has joined the chat! "
+    b"the and you that is are for not it to of in on a I "
+    b" > "
+)[-(1 << WINDOW_BITS):]
+
+if zstandard is not None:
+    # zstd shares the same dictionary, as raw content
+    zstd_dictionary = zstandard.ZstdCompressionDict(DICTIONARY, dict_type=zstandard.DICT_TYPE_RAWCONTENT)
+    zstd_compressor = zstandard.ZstdCompressor(level=3, dict_data=zstd_dictionary, write_checksum=False,
+                                               write_content_size=True, write_dict_id=False)
+    zstd_decompressor = zstandard.ZstdDecompressor(dict_data=zstd_dictionary)
+
+
+def available():
+    """The names of the codecs supported here, most preferred first"""
+
+    if zstandard is not None:
+        return ['zstd', 'zlib']
+
+    return ['zlib']
+
+
+def negotiate(offered):
+    """Chooses the most preferred codec out of a comma separated list offered by
+    the other end, returning its name, or None if there are none in common"""
+
+    offered = str(offered, 'ascii', 'replace').split(',')
+
+    for name in available():
+        if name in offered:
+            return name
+
+    return None
+
+
+def compress(codec, payload):
+    """Compresses a payload, returning None if that would not make it any smaller"""
+
+    if len(payload) < MIN_SIZE:
+        return None
+
+    if codec == ZSTD:
+        compressed = zstd_compressor.compress(payload)
+    else:
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -WINDOW_BITS, MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY, DICTIONARY)
+        compressed = compressor.compress(payload) + compressor.flush()
+
+    if len(compressed) >= len(payload):
+        return None
+
+    return compressed
+
+
+def decompress(codec, data):
+    """Decompresses a payload, raising ValueError if it is not valid"""
+
+    if codec == ZSTD:
+        if zstandard is None:
+            raise ValueError('zstd is not available')
+
+        try:
+            return zstd_decompressor.decompress(data, max_output_size=MAX_SIZE)
+        except zstandard.ZstdError as e:
+            raise ValueError(str(e))
+
+    if codec != ZLIB:
+        raise ValueError('unknown codec %d' % codec)
+
+    try:
+        decompressor = zlib.decompressobj(-WINDOW_BITS, DICTIONARY)
+        payload = decompressor.decompress(data, MAX_SIZE)
+    except zlib.error as e:
+        raise ValueError(str(e))
+
+    # Refuse payloads which would expand beyond any message
+    if decompressor.unconsumed_tail:
+        raise ValueError('compressed payload is too large')
+
+    return payload
@@ -0,0 +1,280 @@
+import ctypes
+import socket
+import struct
+
+# The most messages handed to a single sendmmsg() call (the kernel's UIO_MAXIOV)
+BATCH_SIZE = 1024
+
+# The fewest recipients worth the overhead of calling sendmmsg() through ctypes
+MIN_BATCH_SIZE = 8
+
+
+class iovec(ctypes.Structure):
+    _fields_ = [('iov_base', ctypes.c_void_p),
+                ('iov_len', ctypes.c_size_t)]
+
+
+class msghdr(ctypes.Structure):
+    _fields_ = [('msg_name', ctypes.c_void_p),
+                ('msg_namelen', ctypes.c_uint32),
+                ('msg_iov', ctypes.POINTER(iovec)),
+                ('msg_iovlen', ctypes.c_size_t),
+                ('msg_control', ctypes.c_void_p),
+                ('msg_controllen', ctypes.c_size_t),
+                ('msg_flags', ctypes.c_int)]
+
+
+class mmsghdr(ctypes.Structure):
+    _fields_ = [('msg_hdr', msghdr),
+                ('msg_len', ctypes.c_uint)]
+
+
+try:
+    # sendmmsg() is only provided by Linux
+    libc = ctypes.CDLL(None, use_errno=True)
+    sendmmsg = libc.sendmmsg
+    sendmmsg.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_uint, ctypes.c_int]
+    sendmmsg.restype = ctypes.c_int
+except (OSError, AttributeError):
+    sendmmsg = None
+
+
+def sockaddr_in(address):
+    """Packs an (address, port) tuple into a struct sockaddr_in"""
+
+    host, port = address
+
+    return ctypes.create_string_buffer(
+        struct.pack('=H', socket.AF_INET) + struct.pack('!H', port) + socket.inet_aton(host) + bytes(8), 16)
+
+
+class RecipientList:
+    """An incrementally maintained list of recipient addresses, along with
+    anything kept alongside each one, which recipients are removed from by
+    moving the last recipient into their place"""
+
+    def __init__(self):
+        # The (address, port) tuples of the recipients, and their positions
+        self.addresses = []
+        self.positions = {}
+
+        # Anything kept alongside each recipient (e.g. its reliable channel)
+        self.peers = []
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def __contains__(self, address):
+        return address in self.positions
+
+    def __iter__(self):
+        return iter(self.addresses)
+
+    def add(self, address, peer=None):
+        """Adds a recipient to the end of the list, returning False if it was already there"""
+
+        if address in self.positions:
+            return False
+
+        self.positions[address] = len(self.addresses)
+        self.addresses.append(address)
+        self.peers.append(peer)
+
+        return True
+
+    def remove(self, address):
+        """Removes a recipient, returning the position the last recipient was
+        moved into, or None"""
+
+        position = self.positions.pop(address, None)
+        if position is None:
+            return None
+
+        last_address = self.addresses.pop()
+        last_peer = self.peers.pop()
+
+        if position < len(self.addresses):
+            self.addresses[position] = last_address
+            self.peers[position] = last_peer
+            self.positions[last_address] = position
+            return position
+
+        return None
+
+
+class AddressArray(RecipientList):
+    """A RecipientList along with the sockaddr_in and mmsghdr structures needed
+    to send the same data to every recipient at once"""
+
+    def __init__(self):
+        super().__init__()
+
+        # The sockaddr_in of each recipient, in the same order as the addresses
+        self.names = []
+
+        # The number of recipients without a sockaddr_in (i.e. not IPv4)
+        self.unbatchable = 0
+
+        # The single buffer every message in a batch points at
+        self.iov = iovec()
+
+        # The mmsghdr of each recipient, grown as recipients are added
+        self.headers = (mmsghdr * 0)()
+
+    def add(self, address, peer=None):
+        """Adds a recipient to the end of the array"""
+
+        if address in self.positions:
+            return False
+
+        # Only IPv4 recipients can be sent to in batches
+        try:
+            name = sockaddr_in(address)
+        except (OSError, ValueError, struct.error):
+            name = None
+            self.unbatchable = self.unbatchable + 1
+
+        super().add(address, peer)
+        self.names.append(name)
+
+        # Double the headers, whenever they have run out
+        if len(self.headers) < len(self.addresses):
+            self.grow(max(2 * len(self.headers), 16))
+        else:
+            self.point(len(self.addresses) - 1)
+
+        return True
+
+    def remove(self, address):
+        """Removes a recipient, moving the last recipient into its place"""
+
+        position = self.positions.get(address)
+        if position is None:
+            return None
+
+        if self.names[position] is None:
+            self.unbatchable = self.unbatchable - 1
+
+        last_name = self.names.pop()
+
+        moved = super().remove(address)
+        if moved is not None:
+            self.names[moved] = last_name
+            self.point(moved)
+
+        return moved
+
+    def grow(self, capacity):
+        """Reallocates the headers with room for capacity recipients"""
+
+        self.headers = (mmsghdr * capacity)()
+
+        for position in range(capacity):
+            header = self.headers[position].msg_hdr
+            header.msg_iov = ctypes.pointer(self.iov)
+            header.msg_iovlen = 1
+
+        for position in range(len(self.addresses)):
+            self.point(position)
+
+    def point(self, position):
+        """Points the header at position to its recipient's sockaddr_in"""
+
+        name = self.names[position]
+        header = self.headers[position].msg_hdr
+        header.msg_name = ctypes.addressof(name) if name is not None else None
+        header.msg_namelen = ctypes.sizeof(name) if name is not None else 0
+
+    def send(self, target, data):
+        """Sends data to every recipient, through either a socket or an asyncio
+        datagram transport"""
+
+        count = len(self.addresses)
+        fd = self.fileno(target) if count >= MIN_BATCH_SIZE else None
+
+        # Without sendmmsg(), or a descriptor to use it on, loop over the recipients
+        if fd is None or self.unbatchable:
+            sendto = target.sendto
+            for address in self.addresses:
+                sendto(data, address)
+            return
+
+        # Every header shares the one buffer, which now holds data
+        buffer = ctypes.c_char_p(data)
+        self.iov.iov_base = ctypes.cast(buffer, ctypes.c_void_p)
+        self.iov.iov_len = len(data)
+
+        headers = ctypes.addressof(self.headers)
+        position = 0
+
+        while position < count:
+            sent = sendmmsg(fd, headers + position * ctypes.sizeof(mmsghdr),
+                            min(count - position, BATCH_SIZE), 0)
+
+            if sent > 0:
+                position = position + sent
+                continue
+
+            # The batch stopped at this recipient (e.g. a full non-blocking socket).
+            # Hand it to the target, which raises or buffers as it normally would
+            target.sendto(data, self.addresses[position])
+            position = position + 1
+
+    @staticmethod
+    def fileno(target):
+        """The file descriptor behind a socket or transport, if sendmmsg() can be used"""
+
+        if sendmmsg is None:
+            return None
+
+        # Check if the target is an asyncio transport
+        if not isinstance(target, socket.socket):
+            # Only go around the transport when nothing is waiting in its
+            # own buffer, so messages are not reordered
+            if target.get_write_buffer_size():
+                return None
+
+            target = target.get_extra_info('socket')
+
+        if target is None or target.family != socket.AF_INET:
+            return None
+
+        return target.fileno()
+
+
+class FanOut:
+    """The recipients of a broadcast, split by the format each one speaks.
+    Legacy recipients are all sent the same plain text, encoded once and sent
+    in batches. Recipients speaking the binary protocol are each sent the
+    message through their own channel, which numbers it, so they are only
+    listed along with their channels. Recipients receiving the broadcast from
+    a multicast group are only counted, as the message is published to the
+    group once, however many there are"""
+
+    def __init__(self, recipients=()):
+        self.clients = RecipientList()  # Recipients speaking the binary protocol, with their channels
+        self.legacy_clients = AddressArray()  # Recipients speaking the legacy text format
+        self.multicast_clients = set()  # The (address, port) of the recipients receiving from the multicast group
+
+        for address, legacy in recipients:
+            self.add(address, legacy)
+
+    def __len__(self):
+        return len(self.clients) + len(self.legacy_clients) + len(self.multicast_clients)
+
+    def add(self, address, legacy=False, peer=None, multicast=False):
+        """Adds a recipient"""
+
+        if multicast:
+            self.multicast_clients.add(address)
+        elif legacy:
+            self.legacy_clients.add(address, peer)
+        else:
+            self.clients.add(address, peer)
+
+    def remove(self, address):
+        """Removes a recipient"""
+
+        self.clients.remove(address)
+        self.legacy_clients.remove(address)
+        self.multicast_clients.discard(address)
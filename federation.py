@@ -0,0 +1,379 @@
+import logging
+import random
+import socket
+import struct
+import time
+from collections import Counter
+
+import protocol
+from reliability import Channel
+
+HELLO_INTERVAL = 1.0  # How often, in seconds, each server says hello to its peers
+PEER_TIMEOUT = 5.0  # How long, in seconds, a peer may go without saying hello before it is taken to be down
+
+logger = logging.getLogger('federation')
+
+
+def new_epoch():
+    """A random, non-zero number naming one run of messages sent to a peer"""
+
+    return random.getrandbits(32) | 1
+
+
+class Peer:
+    """Another server in the federation, and the two halves of the reliable
+    channel to it.
+
+    Each direction has an epoch of its own, stamped on its messages, which
+    changes whenever the sender starts its sequence numbers over (on first
+    hearing from the peer, after the peer has been down, or when the peer
+    says it has lost track), so messages from an earlier run are dropped"""
+
+    def __init__(self, address, name):
+        # The (address, port) of the peer's federation socket
+        self.address = address
+
+        # The name the peer introduces itself by
+        self.name = None
+
+        # Whether the peer has said hello within the last PEER_TIMEOUT, and when it last did
+        self.up = False
+        self.last_heard = None
+
+        # The epoch of the messages sent to the peer, and when it last started over
+        self.epoch = 0
+        self.started = None
+        self.sending = Channel(address, nickname=name)
+
+        # The epoch of the messages received from the peer, and the last one before
+        # the peer went down, which is never picked up again
+        self.remote_epoch = 0
+        self.retired_epoch = 0
+        self.receiving = Channel(address, nickname=name)
+
+    def restart_sending(self, now):
+        """Starts the messages sent to the peer over, at sequence number 1"""
+
+        self.epoch = new_epoch()
+        self.started = now
+        self.sending = Channel(self.address, nickname=self.sending.nickname.decode('utf-8'), session_id=self.epoch)
+
+    def restart_receiving(self, epoch):
+        """Starts receiving the peer's messages afresh, from a new epoch"""
+
+        self.remote_epoch = epoch
+        self.receiving = Channel(self.address, nickname=self.receiving.nickname.decode('utf-8'), session_id=epoch)
+
+
+class Federation:
+    """Joins several chat servers, on any number of hosts, into one chat.
+
+    Each server relays the broadcasts of its own clients to every peer over a
+    reliable channel, so each reaches every server exactly once and is never
+    relayed on again. Servers also tell each other which clients they have,
+    so the federation stands in for the registry the Membership table checks
+    nicknames against. Should two servers let in the same nickname at once,
+    the earliest claim wins everywhere, and the other server turns its
+    client away"""
+
+    def __init__(self, federation_socket, name, peers, now=None):
+        # The socket the federation is spoken on
+        self.socket = federation_socket
+
+        # The name the server introduces itself by, which must be unique
+        self.name = name
+
+        # The peers, by (address, port), leaving out the server itself
+        own = federation_socket.getsockname()
+        self.peers = {address: Peer(address, name) for address in peers if address != own}
+
+        # The nickname -> (room, owner, claimed at) table of every client across
+        # the federation, where the owner is the name of the client's server
+        self.table = {}
+
+        # The nicknames of this server's clients which lost out to a claim on another server
+        self.collisions = []
+
+        # When the next hello is due
+        self.next_hello = time.monotonic() if now is None else now
+
+    def __len__(self):
+        return len(self.table)
+
+    def __contains__(self, nickname):
+        return nickname in self.table
+
+    # The registry interface, used by Membership
+
+    def claim(self, nickname, room):
+        """Claims a nickname for one of this server's clients, returning False if
+        it is already taken anywhere in the federation"""
+
+        if nickname in self.table:
+            return False
+
+        claimed_at = time.time()
+        self.table[nickname] = (room, self.name, claimed_at)
+        self.announce(protocol.MEMBER_JOINED, nickname, room, claimed_at)
+
+        return True
+
+    def release(self, nickname):
+        """Gives up a nickname claimed by one of this server's clients"""
+
+        entry = self.table.get(nickname)
+        if entry is None or entry[1] != self.name:
+            return
+
+        del self.table[nickname]
+        self.announce(protocol.MEMBER_LEFT, nickname, entry[0], entry[2])
+
+    def move(self, nickname, room):
+        """Moves one of this server's clients into another room"""
+
+        entry = self.table.get(nickname)
+        if entry is None or entry[1] != self.name:
+            return
+
+        self.table[nickname] = (room, entry[1], entry[2])
+        self.announce(protocol.MEMBER_MOVED, nickname, room, entry[2])
+
+    def rooms(self):
+        """The room -> number of clients table of every room in use, across the federation"""
+
+        return dict(Counter(room for room, owner, claimed_at in self.table.values()))
+
+    # Sending to peers
+
+    def publish(self, room, message):
+        """Relays a broadcast by one of this server's clients to every peer"""
+
+        room = str.encode(room, 'utf-8')
+        self.send_all(protocol.PEER_BROADCAST, protocol.PEER_ROOM.pack(len(room)) + room + message)
+
+    def announce(self, action, nickname, room, claimed_at, peers=None):
+        """Tells peers about a change to one of this server's clients"""
+
+        nickname = str.encode(nickname, 'utf-8')
+        payload = protocol.PEER_MEMBER_UPDATE.pack(action, claimed_at, len(nickname)) + nickname + \
+            str.encode(room, 'utf-8')
+
+        self.send_all(protocol.PEER_MEMBER, payload, peers)
+
+    def send_all(self, message_type, payload, peers=None):
+        """Sends a message through the channel of every peer which is up"""
+
+        now = time.monotonic()
+
+        for peer in self.peers.values() if peers is None else peers:
+            if not peer.up:
+                continue
+
+            datagram = peer.sending.send(message_type, payload, now)
+            if datagram is not None:
+                self.sendto(datagram, peer.address)
+
+    def sendto(self, datagram, address):
+        try:
+            self.socket.sendto(datagram, address)
+        except OSError:
+            # The channel retransmits it, or the peer is taken to be down
+            pass
+
+    def hello(self, peer):
+        """Says hello to a peer, along with the epoch of its messages last received"""
+
+        self.sendto(protocol.encode(protocol.PEER_HELLO, peer.epoch, self.name,
+                                    protocol.PEER_HELLO_BODY.pack(peer.remote_epoch)), peer.address)
+
+    def restart(self, peer, now):
+        """Starts the messages sent to a peer over, telling it about every client
+        of this server again"""
+
+        peer.restart_sending(now)
+        self.hello(peer)
+
+        for nickname, (room, owner, claimed_at) in list(self.table.items()):
+            if owner == self.name:
+                self.announce(protocol.MEMBER_JOINED, nickname, room, claimed_at, [peer])
+
+    # Receiving from peers
+
+    def receive(self, data, address):
+        """Handles a datagram from a peer, returning the (room, message) of each
+        broadcast it relayed which can now be delivered, in order"""
+
+        peer = self.peers.get(address)
+        if peer is None:
+            return []
+
+        try:
+            message = protocol.decode(data)
+        except (protocol.ProtocolError, UnicodeDecodeError):
+            return []
+
+        now = time.monotonic()
+
+        if message.type == protocol.PEER_HELLO:
+            self.handle_hello(peer, message, now)
+            return []
+
+        if not peer.up:
+            return []
+
+        # ACKs name the epoch they acknowledge, which must be the current one
+        if message.type == protocol.ACK:
+            if message.session_id == peer.epoch:
+                for datagram in peer.sending.acknowledge(message, now):
+                    self.sendto(datagram, address)
+            return []
+
+        # Drop messages from any other epoch than the peer's current one
+        if not message.sequence or message.session_id != peer.remote_epoch:
+            return []
+
+        delivered = peer.receiving.receive(message)
+        self.sendto(peer.receiving.ack(), address)
+
+        broadcasts = []
+        for message in delivered:
+            if message.type == protocol.PEER_BROADCAST:
+                length = message.payload[0] if message.payload else 0
+                start = protocol.PEER_ROOM.size + length
+                broadcasts.append((message.payload[protocol.PEER_ROOM.size:start].decode('utf-8', 'replace'),
+                                   message.payload[start:]))
+            elif message.type == protocol.PEER_MEMBER:
+                self.update(peer, message.payload)
+
+        return broadcasts
+
+    def handle_hello(self, peer, message, now):
+        """Keeps the two halves of the channel to a peer in step"""
+
+        try:
+            (known_epoch,) = protocol.PEER_HELLO_BODY.unpack(message.payload)
+        except struct.error:
+            return
+
+        # Never federate with ourselves, should a peer's address lead back here
+        if message.nickname == self.name:
+            return
+
+        peer.last_heard = now
+        replied = False
+
+        # The peer has started its messages over, so start receiving them afresh,
+        # forgetting its clients, which it tells us about again
+        if message.session_id not in (0, peer.remote_epoch, peer.retired_epoch):
+            self.forget(peer)
+            peer.name = message.nickname
+            peer.restart_receiving(message.session_id)
+
+        if not peer.up:
+            logger.info("[+] Peer %s (%s, %s) is up", message.nickname, peer.address[0], peer.address[1],
+                        extra=dict(event='peer_up', peer=message.nickname))
+
+            peer.up = True
+            peer.name = message.nickname
+            self.restart(peer, now)
+            replied = True
+        elif known_epoch != peer.epoch and now - peer.started >= HELLO_INTERVAL:
+            # The peer has lost track of our messages (e.g. it has restarted)
+            self.restart(peer, now)
+            replied = True
+
+        # Let the peer know its new epoch has been picked up
+        if not replied and message.session_id == peer.remote_epoch and known_epoch != peer.epoch:
+            self.hello(peer)
+
+    def forget(self, peer):
+        """Forgets every client of a peer"""
+
+        if peer.name is None:
+            return
+
+        for nickname in [nickname for nickname, entry in self.table.items() if entry[1] == peer.name]:
+            del self.table[nickname]
+
+    def update(self, peer, payload):
+        """Applies a change to one of a peer's clients"""
+
+        try:
+            action, claimed_at, length = protocol.PEER_MEMBER_UPDATE.unpack_from(payload)
+        except struct.error:
+            return
+
+        offset = protocol.PEER_MEMBER_UPDATE.size
+        nickname = payload[offset:offset + length].decode('utf-8', 'replace')
+        room = payload[offset + length:].decode('utf-8', 'replace')
+
+        entry = self.table.get(nickname)
+
+        if action == protocol.MEMBER_JOINED:
+            if entry is not None and entry[1] != peer.name:
+                # Two servers let in the same nickname. The earliest claim (or, on a tie,
+                # the lowest server name) wins, which every server works out the same way
+                if (entry[2], entry[1]) <= (claimed_at, peer.name):
+                    return
+
+                if entry[1] == self.name:
+                    self.collisions.append(nickname)
+
+            self.table[nickname] = (room, peer.name, claimed_at)
+        elif entry is not None and entry[1] == peer.name:
+            if action == protocol.MEMBER_MOVED:
+                self.table[nickname] = (room, peer.name, entry[2])
+            elif action == protocol.MEMBER_LEFT:
+                del self.table[nickname]
+
+    def poll(self, now=None):
+        """Retransmits, says hello, and gives up on peers which have gone quiet"""
+
+        now = time.monotonic() if now is None else now
+
+        for peer in self.peers.values():
+            if not peer.up:
+                continue
+
+            for datagram in peer.sending.poll(now):
+                self.sendto(datagram, peer.address)
+
+            if peer.sending.lost or now - peer.last_heard >= PEER_TIMEOUT:
+                logger.info("[-] Peer %s (%s, %s) is down", peer.name, peer.address[0], peer.address[1],
+                            extra=dict(event='peer_down', peer=peer.name))
+
+                # Forget its clients, and only pick its messages up again once it has started them over
+                self.forget(peer)
+                peer.up = False
+                peer.retired_epoch = peer.remote_epoch
+                peer.remote_epoch = 0
+
+        if now >= self.next_hello:
+            self.next_hello = now + HELLO_INTERVAL
+
+            for peer in self.peers.values():
+                self.hello(peer)
+
+    def deadline(self):
+        """When poll() should next be called"""
+
+        deadlines = [peer.sending.deadline for peer in self.peers.values()
+                     if peer.up and peer.sending.deadline is not None]
+
+        return min(deadlines + [self.next_hello])
+
+
+def parse_address(text):
+    """Parses a 'host:port' address"""
+
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def bind(address):
+    """Binds the socket a server speaks the federation on"""
+
+    federation_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    federation_socket.bind(address)
+
+    return federation_socket
@@ -0,0 +1,123 @@
+from collections import OrderedDict
+
+import compression
+import protocol
+
+
+class ReassemblyError(protocol.ProtocolError):
+    """Raised when the fragments of a message cannot be put back together, and
+    whatever had arrived of it is dropped"""
+
+
+class Reassembler:
+    """Puts the fragments of messages too large for one datagram back together.
+
+    Fragments arrive through a reliable channel, so in order: each peer has at
+    most one message in pieces at a time, kept under its key (e.g. its session
+    id). A message may be no larger than max_size, the pieces of every message
+    held at once no larger than budget, and a message whose pieces stop coming
+    is dropped after timeout seconds, so nobody can tie up the memory of the
+    process putting them together"""
+
+    def __init__(self, max_size=protocol.MAX_MESSAGE_SIZE, budget=None, timeout=10.0):
+        self.max_size = max_size
+        self.budget = max_size if budget is None else budget
+        self.timeout = timeout
+
+        # The key -> [message type, number of pieces, pieces, size, started] table
+        # of the messages in pieces, the longest started first
+        self.partial = OrderedDict()
+
+        # The bytes held in the pieces, across every message
+        self.size = 0
+
+    def __len__(self):
+        return len(self.partial)
+
+    def add(self, key, message, now):
+        """Adds a FRAGMENT from a peer, returning its whole Message once every
+        piece has arrived, or None until then. Raises ReassemblyError, having
+        dropped the message, if it breaks any of the limits"""
+
+        if len(message.payload) < protocol.FRAGMENT_HEADER.size:
+            self.discard(key)
+            raise ReassemblyError('fragment is shorter than its header')
+
+        message_type, index, count = protocol.FRAGMENT_HEADER.unpack_from(message.payload)
+        piece = bytes(message.payload[protocol.FRAGMENT_HEADER.size:])
+
+        entry = self.partial.get(key)
+        if index == 0:
+            # A new message replaces one which never finished
+            self.discard(key)
+
+            if message_type & compression.TYPE_MASK in (protocol.FRAGMENT, protocol.BATCH) or count < 2:
+                raise ReassemblyError('fragment does not start a message which can be fragmented')
+
+            entry = self.partial[key] = [message_type, count, [], 0, now]
+        elif entry is None or index != len(entry[2]) or (message_type, count) != (entry[0], entry[1]):
+            self.discard(key)
+            raise ReassemblyError('fragment %d of %d is out of place' % (index, count))
+
+        if entry[3] + len(piece) > self.max_size:
+            self.discard(key)
+            raise ReassemblyError('message is larger than %d bytes' % self.max_size)
+
+        if self.size + len(piece) > self.budget:
+            self.discard(key)
+            raise ReassemblyError('the messages in pieces would take more than %d bytes' % self.budget)
+
+        entry[2].append(piece)
+        entry[3] = entry[3] + len(piece)
+        self.size = self.size + len(piece)
+
+        if len(entry[2]) < count:
+            return None
+
+        self.discard(key)
+        payload = b''.join(entry[2])
+
+        # The whole payload was compressed before it was split, so is decompressed now
+        codec = message_type >> compression.CODEC_SHIFT
+        if codec:
+            message_type = message_type & compression.TYPE_MASK
+
+            try:
+                payload = compression.decompress(codec, payload)
+            except ValueError as e:
+                raise ReassemblyError('payload cannot be decompressed: %s' % e)
+
+            if len(payload) > self.max_size:
+                raise ReassemblyError('message is larger than %d bytes' % self.max_size)
+
+        return protocol.Message(message_type, message.session_id, message.sequence, message.nickname, payload)
+
+    def restore(self, key, entry):
+        """Puts back a message in pieces handed over by another Reassembler, as the
+        [message type, number of pieces, pieces, size, started] it kept it as"""
+
+        self.discard(key)
+        self.partial[key] = entry
+        self.size = self.size + entry[3]
+
+    def discard(self, key):
+        """Drops whatever has arrived of a peer's message"""
+
+        entry = self.partial.pop(key, None)
+        if entry is not None:
+            self.size = self.size - entry[3]
+
+    def expire(self, now):
+        """Drops the messages whose pieces have stopped coming, returning their keys"""
+
+        expired = []
+
+        while self.partial:
+            key, entry = next(iter(self.partial.items()))
+            if now - entry[4] < self.timeout:
+                break
+
+            self.discard(key)
+            expired.append(key)
+
+        return expired
@@ -0,0 +1,290 @@
+import math
+import os
+import socket
+import struct
+from collections import deque
+
+from protocol import Message
+from reliability import Channel
+from sessions import Session
+
+# The header of a snapshot: its format version, the session id to issue next, the number of sessions,
+# the number of rooms' multicast streams, which follow the sessions, and the number of messages in
+# pieces, which follow the streams
+SNAPSHOT = struct.Struct('!BIIHI')
+SNAPSHOT_VERSION = 3
+
+# Each session: its session id, join request id, whether it is legacy, whether it has a channel, whether
+# it receives from the multicast group, when it was last seen, its port and the lengths of its host,
+# nickname and room, which follow in that order
+SESSION = struct.Struct('!IIBBBdHBBB')
+
+# Each room's multicast stream: the sequence number of its next message and the length of the room,
+# which follows
+STREAM = struct.Struct('!IB')
+
+# The channel of a session: its codec (0 for none), the sequence numbers of the next outgoing and
+# incoming messages, its round trip time estimate (NaN for none), variation and retransmission timeout,
+# when its next retransmission is due (NaN for none), and the number of messages in flight, in the
+# backlog and received out of order, which follow
+CHANNEL = struct.Struct('!BIIddddHHH')
+
+# A message in flight: its sequence number, retransmits, when it was last sent and its length
+IN_FLIGHT = struct.Struct('!IBdH')
+
+# A message in the backlog, or received out of order: its type, sequence number (0 in the backlog)
+# and payload length
+QUEUED = struct.Struct('!BII')
+
+# A message in pieces: the session id of its sender, the type of the whole message, its number of
+# pieces, when its first piece arrived and the number of pieces which have, each of which follows as
+# a PIECE and the piece itself
+PARTIAL = struct.Struct('!IBHdH')
+PIECE = struct.Struct('!H')
+
+# What a server hands its successor ahead of the snapshot: the length of the snapshot, and whether
+# the stats and federation sockets follow the server socket
+HANDOFF = struct.Struct('!IBB')
+
+HANDOFF_TIMEOUT = 5.0  # How long, in seconds, a server waits on its successor to take what it hands over
+
+# The most file descriptors handed over: the server, stats and federation sockets
+MAX_SOCKETS = 3
+
+
+def dump(sessions, streams=None, partial=None):
+    """Packs every session in a SessionTable, along with the state of its
+    reliable channel, the room -> next sequence number table of the rooms'
+    multicast streams, and the session id -> messages in pieces table of a
+    Reassembler, into a snapshot. The pieces have already been acknowledged,
+    so would otherwise never be sent again"""
+
+    streams = streams or {}
+    partial = partial or {}
+    parts = [SNAPSHOT.pack(SNAPSHOT_VERSION, sessions.next_id, len(sessions), len(streams), len(partial))]
+
+    for session in sessions:
+        host = str.encode(session.address[0], 'utf-8')
+        nickname = str.encode(session.nickname, 'utf-8')
+        room = str.encode(session.room, 'utf-8')
+        channel = session.channel
+
+        parts.append(SESSION.pack(session.id, session.request_id, session.legacy, channel is not None,
+                                  session.multicast, session.last_seen, session.address[1],
+                                  len(host), len(nickname), len(room)))
+        parts.extend((host, nickname, room))
+
+        if channel is None:
+            continue
+
+        backlog = channel.backlog or ()
+        parts.append(CHANNEL.pack(channel.codec or 0, channel.next_sequence, channel.expected,
+                                  math.nan if channel.srtt is None else channel.srtt, channel.rttvar, channel.rto,
+                                  math.nan if channel.deadline is None else channel.deadline,
+                                  len(channel.in_flight), len(backlog), len(channel.out_of_order)))
+
+        for sequence, (datagram, sent_at, retransmits) in channel.in_flight.items():
+            parts.append(IN_FLIGHT.pack(sequence, retransmits, sent_at, len(datagram)))
+            parts.append(datagram)
+
+        for message_type, payload in backlog:
+            parts.append(QUEUED.pack(message_type, 0, len(payload)))
+            parts.append(payload)
+
+        for sequence, message in channel.out_of_order.items():
+            parts.append(QUEUED.pack(message.type, sequence, len(message.payload)))
+            parts.append(message.payload)
+
+    for room, sequence in streams.items():
+        room = str.encode(room, 'utf-8')
+        parts.append(STREAM.pack(sequence, len(room)))
+        parts.append(room)
+
+    for session_id, (message_type, count, pieces, size, started) in partial.items():
+        parts.append(PARTIAL.pack(session_id, message_type, count, started, len(pieces)))
+
+        for piece in pieces:
+            parts.append(PIECE.pack(len(piece)))
+            parts.append(piece)
+
+    return b''.join(parts)
+
+
+def load(snapshot):
+    """Unpacks a snapshot, returning the session id to issue next, the
+    restored Sessions, the rooms' multicast streams and the messages in pieces"""
+
+    version, next_id, count, stream_count, partial_count = SNAPSHOT.unpack_from(snapshot)
+    if version != SNAPSHOT_VERSION:
+        raise ValueError('unknown snapshot version %d' % version)
+
+    view = memoryview(snapshot)
+    offset = SNAPSHOT.size
+    sessions = []
+
+    def take(length):
+        nonlocal offset
+        offset = offset + length
+        return bytes(view[offset - length:offset])
+
+    for _ in range(count):
+        session_id, request_id, legacy, has_channel, multicast, last_seen, port, \
+            host_length, nickname_length, room_length = SESSION.unpack_from(view, offset)
+        offset = offset + SESSION.size
+
+        address = (take(host_length).decode('utf-8'), port)
+        nickname = take(nickname_length).decode('utf-8')
+        room = take(room_length).decode('utf-8')
+
+        channel = None
+        if has_channel:
+            channel = Channel(address, session_id=session_id)
+
+            codec, channel.next_sequence, channel.expected, srtt, channel.rttvar, channel.rto, \
+                deadline, in_flight, backlog, out_of_order = CHANNEL.unpack_from(view, offset)
+            offset = offset + CHANNEL.size
+
+            channel.codec = codec or None
+            channel.srtt = None if math.isnan(srtt) else srtt
+            channel.deadline = None if math.isnan(deadline) else deadline
+
+            for _ in range(in_flight):
+                sequence, retransmits, sent_at, length = IN_FLIGHT.unpack_from(view, offset)
+                offset = offset + IN_FLIGHT.size
+                channel.in_flight[sequence] = [take(length), sent_at, retransmits]
+
+            if backlog:
+                channel.backlog = deque()
+
+            for _ in range(backlog + out_of_order):
+                message_type, sequence, length = QUEUED.unpack_from(view, offset)
+                offset = offset + QUEUED.size
+                payload = take(length)
+
+                if sequence:
+                    channel.out_of_order[sequence] = Message(message_type, session_id, sequence, nickname, payload)
+                else:
+                    channel.backlog.append((message_type, payload))
+
+        session = Session(session_id, nickname, address, room, channel, last_seen, request_id)
+        session.multicast = bool(multicast)
+        sessions.append(session)
+
+    streams = {}
+    for _ in range(stream_count):
+        sequence, room_length = STREAM.unpack_from(view, offset)
+        offset = offset + STREAM.size
+        streams[take(room_length).decode('utf-8')] = sequence
+
+    partial = {}
+    for _ in range(partial_count):
+        session_id, message_type, piece_count, started, length = PARTIAL.unpack_from(view, offset)
+        offset = offset + PARTIAL.size
+
+        pieces = []
+        for _ in range(length):
+            (piece_length,) = PIECE.unpack_from(view, offset)
+            offset = offset + PIECE.size
+            pieces.append(take(piece_length))
+
+        partial[session_id] = [message_type, piece_count, pieces, sum(map(len, pieces)), started]
+
+    return next_id, sessions, streams, partial
+
+
+class Takeover:
+    """What a server hands its successor: its bound sockets, and a snapshot of
+    its sessions"""
+
+    def __init__(self, server_socket, stats_socket, federation_socket, snapshot):
+        self.server_socket = server_socket
+        self.stats_socket = stats_socket  # None if the server had no stats port
+        self.federation_socket = federation_socket  # None if the server was not federated
+        self.snapshot = snapshot
+
+
+def listen(path):
+    """Listens on a Unix socket for the server which is to take over from this one"""
+
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    # A socket file left behind by a server which did not exit cleanly is of no more use
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+    listener.bind(path)
+    listener.listen(1)
+    listener.setblocking(False)
+
+    return listener
+
+
+def close(listener, path):
+    """Stops listening for a successor, and removes the socket file"""
+
+    listener.close()
+
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def hand_over(connection, server_socket, stats_socket, federation_socket, snapshot):
+    """Passes a server's sockets, and the snapshot of its sessions, to the
+    server which has connected to take over from it"""
+
+    # Give up on a successor which stops reading, rather than hold up the chat
+    connection.settimeout(HANDOFF_TIMEOUT)
+
+    sockets = [sock.fileno() for sock in (server_socket, stats_socket, federation_socket) if sock is not None]
+    header = HANDOFF.pack(len(snapshot), stats_socket is not None, federation_socket is not None)
+
+    socket.send_fds(connection, [header], sockets)
+    connection.sendall(snapshot)
+    connection.close()
+
+
+def take_over(path):
+    """Takes over from the server listening on a Unix socket, returning its
+    Takeover, or None if no server is listening there"""
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+    try:
+        connection.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        connection.close()
+        return None
+
+    with connection:
+        header, fds, _, _ = socket.recv_fds(connection, HANDOFF.size, MAX_SOCKETS)
+        if len(header) < HANDOFF.size:
+            # The server exited before handing anything over
+            for fd in fds:
+                os.close(fd)
+            return None
+
+        length, has_stats, has_federation = HANDOFF.unpack(header)
+
+        # The sockets are put back in blocking mode, as freshly bound sockets would be, in
+        # case the asyncio engine of the server handing over made them non-blocking
+        sockets = [socket.socket(fileno=fd) for fd in fds]
+        for sock in sockets:
+            sock.setblocking(True)
+
+        sockets = iter(sockets)
+        server_socket = next(sockets)
+        stats_socket = next(sockets) if has_stats else None
+        federation_socket = next(sockets) if has_federation else None
+
+        snapshot = bytearray()
+        while len(snapshot) < length:
+            data = connection.recv(length - len(snapshot))
+            if not data:
+                raise ConnectionError('the server handing over exited partway through its snapshot')
+            snapshot.extend(data)
+
+    return Takeover(server_socket, stats_socket, federation_socket, bytes(snapshot))
@@ -0,0 +1,106 @@
+import os
+import re
+from array import array
+
+# The words a line is indexed under, and a query is split into
+WORD_PATTERN = re.compile(r'\w+')
+
+
+class History:
+    """An append-only file of every line shown in the chat feed, so the feed
+    itself only needs to hold the lines on screen.
+
+    The offset of each line is kept, so any range of lines can be read back
+    with a single seek, along with an index of the lines each word appears in,
+    so searches never read the file"""
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        # The history file, appended to and read back from
+        self.file = open(path, 'a+b')
+
+        # The offset of the start of each line, and the end of the file
+        self.offsets = array('Q')
+        self.size = 0
+
+        # The word -> line numbers index, in the order the lines were added
+        self.index = {}
+
+        # Index the lines kept from earlier sessions
+        self.file.seek(0)
+        for line in self.file:
+            self.add(line)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def add(self, line):
+        """Indexes a line which has been written at the end of the file"""
+
+        number = len(self.offsets)
+        self.offsets.append(self.size)
+        self.size = self.size + len(line)
+
+        for word in set(WORD_PATTERN.findall(line.decode('utf-8', 'replace').lower())):
+            lines = self.index.get(word)
+            if lines is None:
+                lines = self.index[word] = array('I')
+            lines.append(number)
+
+    def append(self, lines):
+        """Adds lines of text to the end of the history"""
+
+        for line in lines:
+            # Lines never contain newlines of their own, so each takes one line of the file
+            line = str.encode(line.replace('\n', ' '), 'utf-8') + b'\n'
+
+            self.file.write(line)
+            self.add(line)
+
+        self.file.flush()
+
+    def read(self, start, stop):
+        """Reads back the lines numbered from start up to stop"""
+
+        start = max(start, 0)
+        stop = min(stop, len(self.offsets))
+        if start >= stop:
+            return []
+
+        end = self.offsets[stop] if stop < len(self.offsets) else self.size
+
+        self.file.seek(self.offsets[start])
+        data = self.file.read(end - self.offsets[start])
+
+        return data.decode('utf-8', 'replace').split('\n')[:stop - start]
+
+    def search(self, query, limit=100):
+        """The numbers of the lines containing every word of the query, newest first"""
+
+        words = set(WORD_PATTERN.findall(query.lower()))
+        if not words:
+            return []
+
+        postings = [self.index.get(word) for word in words]
+        if not all(postings):
+            return []
+
+        # Walk the rarest word's lines, newest first, checking the other words
+        postings.sort(key=len)
+        others = [set(lines) for lines in postings[1:]]
+
+        matches = []
+        for number in reversed(postings[0]):
+            if all(number in lines for lines in others):
+                matches.append(number)
+
+                if len(matches) == limit:
+                    break
+
+        return matches
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,92 @@
+import json
+import logging
+import queue
+import sys
+from logging.handlers import QueueHandler, QueueListener
+
+# The levels that can be chosen, by name
+LEVELS = ('debug', 'info', 'warning', 'error')
+
+# The attributes every log record has, which are left out of its JSON fields
+RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', None, None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats each record as a line of JSON, along with any fields passed to
+    the logger as extra"""
+
+    def format(self, record):
+        line = dict(time=round(record.created, 6), level=record.levelname.lower(), logger=record.name,
+                    message=record.getMessage())
+
+        for name, value in vars(record).items():
+            if name not in RECORD_ATTRIBUTES:
+                line[name] = value
+
+        return json.dumps(line, default=str, ensure_ascii=False)
+
+
+class Sampler:
+    """Decides which of a stream of per-message events are logged: one in every
+    `every`, and only while the logger is enabled for the level. Checking is a
+    comparison and an addition, so it is cheap enough for every message"""
+
+    def __init__(self, logger, level=logging.DEBUG, every=1):
+        self.logger = logger
+        self.level = level
+        self.every = max(every, 1)
+
+        # The events seen since the last one logged
+        self.count = 0
+
+    def __call__(self):
+        """Whether the next event should be logged"""
+
+        if not self.logger.isEnabledFor(self.level):
+            return False
+
+        self.count = self.count + 1
+        if self.count < self.every:
+            return False
+
+        self.count = 0
+        return True
+
+
+def setup(level='info', json_lines=False, stream=None):
+    """Routes every log record through a queue to a background thread, which
+    writes it to the stream (standard output, by default), so logging never
+    blocks the caller on I/O. Returns the QueueListener, which must be
+    stopped to write out whatever is still queued"""
+
+    handler = logging.StreamHandler(sys.stdout if stream is None else stream)
+    handler.setFormatter(JsonFormatter() if json_lines else logging.Formatter('%(message)s'))
+
+    # SimpleQueue's put() never blocks, and takes no lock in Python code
+    records = queue.SimpleQueue()
+    listener = QueueListener(records, handler, respect_handler_level=True)
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(QueueHandler(records))
+    root.setLevel(getattr(logging, level.upper()))
+
+    listener.start()
+
+    return listener
+
+
+def add_arguments(parser):
+    """Adds the logging options to an argument parser"""
+
+    parser.add_argument('--log-level', choices=LEVELS, default='info', help='the least severe level logged')
+    parser.add_argument('--log-json', action='store_true', help='log structured JSON lines, instead of plain text')
+    parser.add_argument('--log-sample', type=int, default=100,
+                        help='log one in every this many per-message events, at the debug level')
+
+
+def options(args):
+    """The settings for setup() from the parsed logging options"""
+
+    return dict(level=args.log_level, json_lines=args.log_json)
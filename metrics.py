@@ -0,0 +1,171 @@
+import argparse
+import json
+import socket
+import time
+from collections import Counter
+
+import protocol
+
+# The names the counters of each message type are reported under
+TYPE_NAMES = {
+    protocol.JOIN: 'join', protocol.QUIT: 'quit', protocol.CHAT: 'chat', protocol.ROOM_JOIN: 'room_join',
+    protocol.ROOM_LEAVE: 'room_leave', protocol.ROOM_LIST: 'room_list', protocol.HEARTBEAT: 'heartbeat',
+    protocol.REPLAY: 'replay', protocol.ACK: 'ack', protocol.FRAGMENT: 'fragment', protocol.TEXT: 'text',
+    protocol.WELCOME: 'welcome', protocol.NICKNAME_TAKEN: 'nickname_taken', protocol.BATCH: 'batch',
+    protocol.COMPRESSION: 'compression', protocol.HISTORY: 'history', protocol.RELAY: 'relay',
+    protocol.PEER_HELLO: 'peer_hello', protocol.PEER_BROADCAST: 'peer_broadcast', protocol.PEER_MEMBER: 'peer_member',
+    protocol.MULTICAST_ACCEPT: 'multicast_accept', protocol.MULTICAST_REPAIR: 'multicast_repair',
+    protocol.MULTICAST_INVITE: 'multicast_invite', protocol.MULTICAST: 'multicast',
+}
+
+# The number of power-of-two buckets of microseconds a histogram has, the last
+# of which holds every duration of 2 ** (BUCKETS - 2) microseconds (~4s) or more
+BUCKETS = 24
+
+# The largest stats reply, which always fits within a single datagram
+MAX_REPLY_SIZE = 65507
+
+
+class Histogram:
+    """Counts of durations in power-of-two buckets of microseconds, cheap
+    enough to record for every message"""
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds):
+        """Records a duration, in seconds"""
+
+        bucket = int(seconds * 1000000).bit_length()
+        self.buckets[bucket if bucket < BUCKETS else BUCKETS - 1] += 1
+        self.count = self.count + 1
+        self.total = self.total + seconds
+
+    def percentile(self, fraction):
+        """The upper bound, in microseconds, of the bucket holding the given
+        fraction of the durations, or None if there are none"""
+
+        if not self.count:
+            return None
+
+        rank = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.buckets):
+            seen = seen + count
+            if seen >= rank:
+                return 1 << bucket
+
+        return 1 << (BUCKETS - 1)
+
+    def snapshot(self):
+        return dict(count=self.count,
+                    mean_us=round(self.total / self.count * 1000000, 1) if self.count else None,
+                    p50_us=self.percentile(0.5),
+                    p99_us=self.percentile(0.99),
+                    p999_us=self.percentile(0.999),
+                    # Each bucket by the upper bound of the durations in it, in microseconds
+                    buckets={1 << bucket: count for bucket, count in enumerate(self.buckets) if count})
+
+
+class Metrics:
+    """The counters and histograms a chat server keeps about itself. Recording
+    is a few additions per message; everything else is only worked out when
+    a snapshot is asked for"""
+
+    def __init__(self):
+        self.started = time.time()
+
+        # The number of messages received of each message type
+        self.received = Counter()
+
+        # The number of times something noteworthy happened, e.g. 'malformed'
+        # datagrams, 'send_errors' or clients which 'timed_out'
+        self.events = Counter()
+
+        # How long the receive loop spends decoding each datagram, handling each
+        # decoded message, and fanning each broadcast out to its recipients
+        self.decode = Histogram()
+        self.dispatch = Histogram()
+        self.broadcast = Histogram()
+
+    def snapshot(self, **gauges):
+        """Everything recorded so far, along with the current value of any gauges"""
+
+        snapshot = dict(
+            uptime=round(time.time() - self.started, 3),
+            received={TYPE_NAMES.get(message_type, str(message_type)): count
+                      for message_type, count in sorted(self.received.items())},
+            events=dict(sorted(self.events.items())),
+            decode=self.decode.snapshot(),
+            dispatch=self.dispatch.snapshot(),
+            broadcast=self.broadcast.snapshot(),
+        )
+        snapshot.update(gauges)
+
+        return snapshot
+
+
+class Sender:
+    """Hands datagrams to a blocking socket, counting those the socket refuses
+    instead of letting one failed send stop the server.
+
+    It is handed to the server in place of the socket, so it also exposes the
+    parts of the asyncio transport interface the fan-out looks for"""
+
+    def __init__(self, sock, metrics):
+        self.socket = sock
+        self.metrics = metrics
+
+    def sendto(self, data, address):
+        try:
+            self.socket.sendto(data, address)
+        except OSError:
+            # e.g. a full buffer, or an unreachable client
+            self.metrics.events['send_errors'] += 1
+
+    @staticmethod
+    def get_write_buffer_size():
+        return 0
+
+    def get_extra_info(self, name, default=None):
+        return self.socket if name == 'socket' else default
+
+
+def encode_stats(snapshot):
+    """Encodes a stats snapshot as the JSON reply to a scrape"""
+
+    data = str.encode(json.dumps(snapshot, separators=(',', ':')), 'utf-8')
+
+    # Leave out the buckets, should the reply ever grow too large for a datagram
+    if len(data) > MAX_REPLY_SIZE:
+        for name in ('decode', 'dispatch', 'broadcast'):
+            snapshot[name].pop('buckets', None)
+        data = str.encode(json.dumps(snapshot, separators=(',', ':')), 'utf-8')
+
+    return data
+
+
+def scrape(address, timeout=1.0):
+    """Asks the stats endpoint of a chat server for its snapshot"""
+
+    stats_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    stats_socket.settimeout(timeout)
+
+    try:
+        stats_socket.sendto(b'stats', address)
+        data, _ = stats_socket.recvfrom(MAX_REPLY_SIZE)
+    finally:
+        stats_socket.close()
+
+    return json.loads(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Print the stats of a running chat server')
+    parser.add_argument('--host', default='127.0.0.1', help='the address of the stats endpoint')
+    parser.add_argument('--port', type=int, default=4097, help='the port of the stats endpoint')
+    args = parser.parse_args()
+
+    print(json.dumps(scrape((args.host, args.port)), indent=2))
@@ -0,0 +1,256 @@
+import socket
+from collections import deque
+
+import protocol
+
+REPAIR_SIZE = 256  # The most recent multicast messages of each room kept, to be sent again to clients which missed them
+MAX_HELD = 256  # The most multicast messages a client holds while waiting for the ones it missed
+GAP_TIMEOUT = 2.0  # How long, in seconds, a client waits for the messages it missed before skipping them
+REORDER_DELAY = 0.05  # How long, in seconds, a client waits on a gap, which is usually just reordering, before asking
+
+
+def parse_group(group):
+    """Splits a 'group:port' string into a (group, port) tuple, checking the
+    group is an IPv4 multicast address"""
+
+    host, _, port = group.rpartition(':')
+
+    address = socket.inet_aton(host)
+    if not 224 <= address[0] <= 239:
+        raise ValueError('%s is not a multicast address' % host)
+
+    return host, int(port)
+
+
+def encode_entry(sequence, room, text):
+    """Encodes a room's multicast message, as a MULTICAST_ENTRY followed by the room and text"""
+
+    room = str.encode(room, 'utf-8')
+    return protocol.MULTICAST_ENTRY.pack(sequence, len(room)) + room + text
+
+
+def decode_entry(payload):
+    """Decodes the (sequence, room, text) of a room's multicast message"""
+
+    header = protocol.MULTICAST_ENTRY
+    if len(payload) < header.size:
+        raise protocol.ProtocolError('multicast message is shorter than its header')
+
+    sequence, room_length = header.unpack_from(payload)
+    start = header.size + room_length
+
+    if start > len(payload):
+        raise protocol.ProtocolError('multicast message is shorter than its room name')
+
+    return sequence, str(payload[header.size:start], 'utf-8'), bytes(payload[start:])
+
+
+class MulticastGroup:
+    """The server's end of a multicast group. Each room's broadcasts are
+    published to the group once, whatever the number of clients receiving
+    them, and numbered per room, so clients can tell which they missed and
+    ask for them again"""
+
+    def __init__(self, address, repair_size=REPAIR_SIZE):
+        # The (group, port) tuple of the multicast group
+        self.address = address
+
+        # The room -> sequence number of its next message table
+        self.streams = {}
+
+        # The room -> deque of its latest (encoded) messages, oldest first
+        self.recent = {}
+        self.repair_size = repair_size
+
+    @staticmethod
+    def configure(server_socket, interface, ttl):
+        """Sets up the server's socket to publish to multicast groups through an
+        interface (given by its address), reaching ttl hops away"""
+
+        server_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface))
+        server_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+
+        # Clients on the server's own host receive the group too
+        server_socket.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1)
+
+    def next_sequence(self, room):
+        """The sequence number the room's next message will have"""
+
+        return self.streams.get(room, 1)
+
+    def invitation(self, room, publishing):
+        """An invitation to receive a room's messages from the group, starting
+        with its next message"""
+
+        group, port = self.address
+        name = str.encode(room, 'utf-8')
+
+        return protocol.MULTICAST_INVITATION.pack(socket.inet_aton(group), port, self.next_sequence(room),
+                                                  publishing, len(name)) + name
+
+    def publish(self, room, text):
+        """Numbers a message to a room, keeping it to be sent again, and returns
+        its MULTICAST payload"""
+
+        sequence = self.next_sequence(room)
+        self.streams[room] = sequence + 1
+
+        entry = encode_entry(sequence, room, text)
+
+        recent = self.recent.get(room)
+        if recent is None:
+            recent = self.recent[room] = deque(maxlen=self.repair_size)
+        recent.append(entry)
+
+        return entry
+
+    def repair(self, room, first, last):
+        """The MULTICAST payloads of a room's messages first to last which are
+        still kept"""
+
+        recent = self.recent.get(room)
+        if not recent:
+            return []
+
+        # The kept messages are numbered consecutively, up to the room's latest
+        oldest = self.next_sequence(room) - len(recent)
+        first = max(first, oldest)
+        last = min(last, oldest + len(recent) - 1)
+
+        return [recent[sequence - oldest] for sequence in range(first, last + 1)]
+
+    def forget(self, room):
+        """Forgets a room which has emptied, along with its messages"""
+
+        self.streams.pop(room, None)
+        self.recent.pop(room, None)
+
+
+def join(group, interface):
+    """Makes a socket receiving a multicast group's datagrams, through the
+    interface with the given address. Any number of clients on a host can
+    join the same group, as they share its port"""
+
+    host, port = group
+
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    try:
+        receiver.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if hasattr(socket, 'SO_REUSEPORT'):
+            receiver.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        receiver.bind(('', port))
+        receiver.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP,
+                            socket.inet_aton(host) + socket.inet_aton(interface))
+    except OSError:
+        receiver.close()
+        raise
+
+    return receiver
+
+
+class Stream:
+    """A client's end of its room's multicast messages, which puts them in
+    order, holding on to those which arrive ahead of a missed one. A gap is
+    only asked for again once it has lasted REORDER_DELAY, as it usually
+    fills itself, and is skipped once GAP_TIMEOUT has passed since"""
+
+    def __init__(self, room, expected):
+        self.room = room
+
+        # The sequence number of the next message to deliver
+        self.expected = expected
+
+        # The sequence number -> text table of the messages which arrived ahead of a missed one
+        self.held = {}
+
+        # The last sequence number asked for again, so each missed message is only asked for once
+        self.requested = expected - 1
+
+        # When the messages missed so far are asked for again, and when the oldest
+        # of those asked for is given up on, while there are any
+        self.repair_at = None
+        self.give_up = None
+
+    @property
+    def deadline(self):
+        """When poll() next has something to do, or None"""
+
+        if self.repair_at is None or self.give_up is None:
+            return self.give_up if self.repair_at is None else self.repair_at
+
+        return min(self.repair_at, self.give_up)
+
+    def receive(self, sequence, room, text, now):
+        """Accepts a room's message, returning the texts now ready to be shown
+        in order"""
+
+        if room != self.room or sequence < self.expected or sequence in self.held:
+            return []
+
+        if sequence != self.expected:
+            if len(self.held) < MAX_HELD:
+                self.held[sequence] = text
+                self.wait(now)
+
+            return []
+
+        self.held[sequence] = text
+        return self.release(now)
+
+    def release(self, now):
+        """Delivers the messages which are now in order"""
+
+        delivered = []
+
+        while self.expected in self.held:
+            delivered.append(self.held.pop(self.expected))
+            self.expected = self.expected + 1
+
+        self.requested = max(self.requested, self.expected - 1)
+        self.wait(now)
+
+        return delivered
+
+    def wait(self, now):
+        """Times the gaps left ahead of the messages held"""
+
+        if not self.held:
+            self.repair_at = None
+            self.give_up = None
+        elif max(self.held) - 1 > self.requested:
+            # A gap which has not been asked for yet
+            if self.repair_at is None:
+                self.repair_at = now + REORDER_DELAY
+        elif self.give_up is None:
+            self.give_up = now + GAP_TIMEOUT
+
+    def poll(self, now):
+        """Returns the texts which were held behind missed messages given up on,
+        and the (first, last) sequence numbers of the messages to ask for
+        again, if a gap has lasted long enough"""
+
+        delivered = []
+        missing = None
+
+        # Skip the missed messages which have not arrived in time
+        if self.give_up is not None and now >= self.give_up:
+            self.give_up = None
+            if self.held:
+                self.expected = min(self.held)
+                delivered = self.release(now)
+
+        if self.repair_at is not None and now >= self.repair_at:
+            self.repair_at = None
+            if self.held and max(self.held) - 1 > self.requested:
+                # Up to the last message missing, leaving out those held just ahead of the newest
+                last = max(self.held) - 1
+                while last in self.held:
+                    last = last - 1
+
+                missing = (max(self.expected, self.requested + 1), last)
+                self.requested = max(self.held) - 1
+                self.wait(now)
+
+        return delivered, missing
@@ -0,0 +1,376 @@
+import re
+import struct
+from collections import namedtuple
+
+import compression
+
+# The version of the binary wire protocol. Nicknames are alphanumeric, so a
+# legacy text datagram never starts with a byte below FIRST_LEGACY_BYTE
+VERSION = 2
+FIRST_LEGACY_BYTE = 0x20
+
+# The fixed header in front of every datagram: version, message type, session id,
+# sequence number, nickname length, payload length. Messages with a sequence
+# number of 0 are not delivered reliably. The top two bits of the message type
+# name the codec a compressed payload uses
+HEADER = struct.Struct('!BBIIBH')
+
+# Types of messages sent by the client. A JOIN's session id is a join request id the client picks, which
+# stays the same while it retries, so the server can tell a retry from a new join (0 for none)
+JOIN = 1  # Used to indicate a new client is connecting to the server, offering its compression codecs as the payload
+QUIT = 2  # Used to indicate a client is leaving the chat
+CHAT = 3  # Used to send a chat message
+ROOM_JOIN = 4  # Used to move the client into the room named by the payload
+ROOM_LEAVE = 5  # Used to move the client back into the default room
+ROOM_LIST = 6  # Used to ask for the list of rooms
+HEARTBEAT = 8  # Used to show the client is still there, while it has nothing else to send
+REPLAY = 9  # Used to ask for the messages logged in the client's room, as a REPLAY_REQUEST
+MULTICAST_ACCEPT = 11  # Used to show the client has joined the multicast group it was invited to
+MULTICAST_REPAIR = 12  # Used to ask for the room's multicast messages the client missed, as a MULTICAST_RANGE
+
+# Types of messages sent by either side
+ACK = 7  # Acknowledges messages received, carrying selective acknowledgements as its payload
+FRAGMENT = 10  # Carries a piece of a message too large for one datagram, as a FRAGMENT_HEADER followed by the piece
+
+# Types of messages sent by the server
+TEXT = 16  # A line of text to display in the chat feed
+WELCOME = 17  # Used to accept a new client, carrying its session id
+NICKNAME_TAKEN = 18  # Used to indicate that the nickname already exists
+BATCH = 19  # Carries several whole datagrams for the same client, each prefixed with its length
+COMPRESSION = 20  # Used to accept one of the compression codecs the client offered, named by the payload
+HISTORY = 21  # A message replayed from the room's log, as a HISTORY_ENTRY followed by the text
+MULTICAST_INVITE = 22  # Used to invite a client to receive its room's broadcasts by multicast (a MULTICAST_INVITATION)
+MULTICAST = 23  # A broadcast to a room, published to the multicast group, as a MULTICAST_ENTRY followed by the text
+
+# Types of messages sent between server processes
+RELAY = 32  # A broadcast relayed to another worker through a reliable channel, as a PEER_ROOM followed by the text
+
+# Types of messages sent between federated servers, each stamped with the sending server's name. The
+# session id is the receiving server's incarnation, so messages meant for an earlier one are dropped
+PEER_HELLO = 33  # Introduces a server to a peer, and shows it is still there, carrying a PEER_HELLO_BODY
+PEER_BROADCAST = 34  # A broadcast by one of the sending server's clients, as a PEER_ROOM followed by the text
+PEER_MEMBER = 35  # A client of the sending server joining, moving or leaving, as a PEER_MEMBER_UPDATE
+
+# Messages of the legacy comma separated text format
+LEGACY_NEW_CLIENT_MESSAGE = '{NEW CLIENT REQUEST}'
+LEGACY_QUIT_MESSAGE = '{QUIT}'
+LEGACY_HEARTBEAT_MESSAGE = '{HEARTBEAT}'
+LEGACY_NICKNAME_ALREADY_EXISTS_MESSAGE = '{NICKNAME ALREADY EXISTS}'
+
+# The room every client starts in
+DEFAULT_ROOM = 'lobby'
+
+# The commands a client can type into the chat, e.g. '{join games}', and those which take an argument
+COMMAND_PATTERN = re.compile(r'^\{(quit|join|leave|rooms|history)(?:\s+(\S+))?\}$', re.IGNORECASE)
+COMMAND_TYPES = {'quit': QUIT, 'join': ROOM_JOIN, 'leave': ROOM_LEAVE, 'rooms': ROOM_LIST, 'history': REPLAY}
+COMMAND_ARGUMENTS = {'join', 'history'}
+
+# How a legacy client types each kind of message it can send besides chat, the payload filling in any argument
+LEGACY_COMMANDS = {QUIT: LEGACY_QUIT_MESSAGE, ROOM_JOIN: '{join %s}', ROOM_LEAVE: '{leave}', ROOM_LIST: '{rooms}',
+                   HEARTBEAT: LEGACY_HEARTBEAT_MESSAGE}
+
+# The largest payload a message may have, once its fragments have been put back together
+MAX_MESSAGE_SIZE = 32 * 1024
+
+# In front of each piece of a fragmented message: the type of the whole message (naming the codec its
+# payload was compressed with, before it was split), the index of the piece and the number of pieces
+FRAGMENT_HEADER = struct.Struct('!BHH')
+
+# A request to replay either the last count messages, or those since a sequence number, which is
+# as wide as the HISTORY_ENTRY sequence numbers it refers to
+REPLAY_REQUEST = struct.Struct('!BQ')
+REPLAY_LAST = 1
+REPLAY_SINCE = 2
+REPLAY_ALL = 0xFFFFFFFFFFFFFFFF  # The most a REPLAY_REQUEST has room to ask for
+
+# The sequence number, within the room's log, of a replayed message
+HISTORY_ENTRY = struct.Struct('!Q')
+
+# The length in front of each datagram within a BATCH
+BATCH_ITEM = struct.Struct('!H')
+
+# An invitation to receive a room's broadcasts from a multicast group: the group's IPv4 address and
+# port, the sequence number of the room's next multicast message, whether the server has started
+# publishing to the client (rather than asking it to join the group) and the length of the room
+# name, which follows
+MULTICAST_INVITATION = struct.Struct('!4sHIBB')
+
+# The sequence number of a room's multicast message, and the length of the room name, which
+# comes before the text
+MULTICAST_ENTRY = struct.Struct('!IB')
+
+# The first and last sequence numbers of the room's multicast messages a client missed
+MULTICAST_RANGE = struct.Struct('!II')
+
+# The incarnation of a federated server, chosen afresh each time it starts
+PEER_HELLO_BODY = struct.Struct('!I')
+
+# The length of the room name which follows, within a PEER_BROADCAST
+PEER_ROOM = struct.Struct('!B')
+
+# The change to a client's membership, when the client claimed its nickname, and the length
+# of the nickname, which is followed by the nickname and then the room
+PEER_MEMBER_UPDATE = struct.Struct('!BdB')
+MEMBER_JOINED = 1
+MEMBER_MOVED = 2
+MEMBER_LEFT = 3
+
+# A decoded datagram
+Message = namedtuple('Message', 'type session_id sequence nickname payload')
+
+
+class ProtocolError(ValueError):
+    """Raised when a datagram cannot be decoded"""
+
+
+def encode(message_type, session_id=0, nickname=b'', payload=b'', sequence=0):
+    """Encodes a message as a header followed by the nickname and payload"""
+
+    # Encode the nickname and payload as utf-8 byte streams, if they are not already
+    if type(nickname) is not bytes:
+        nickname = str.encode(nickname, 'utf-8')
+    if type(payload) is not bytes:
+        payload = str.encode(payload, 'utf-8')
+
+    header = HEADER.pack(VERSION, message_type, session_id, sequence, len(nickname), len(payload))
+
+    return b''.join((header, nickname, payload))
+
+
+def decode(data):
+    """Decodes a datagram into a Message, with a str nickname and a bytes payload"""
+
+    if len(data) < HEADER.size:
+        raise ProtocolError('datagram is shorter than the header')
+
+    version, message_type, session_id, sequence, nickname_length, payload_length = HEADER.unpack_from(data)
+
+    if version != VERSION:
+        raise ProtocolError('unsupported protocol version %d' % version)
+
+    codec = message_type >> compression.CODEC_SHIFT
+
+    # The nickname and payload follow the header
+    start = HEADER.size + nickname_length
+    end = start + payload_length
+
+    if end > len(data):
+        raise ProtocolError('datagram is shorter than its header claims')
+
+    nickname = bytes(data[HEADER.size:start]).decode('utf-8')
+    payload = bytes(data[start:end])
+
+    # Decompress the payload, if it has been compressed
+    if codec:
+        message_type = message_type & compression.TYPE_MASK
+
+        try:
+            payload = compression.decompress(codec, payload)
+        except ValueError as e:
+            raise ProtocolError('payload cannot be decompressed: %s' % e)
+
+    return Message(message_type, session_id, sequence, nickname, payload)
+
+
+def decode_view(view):
+    """Decodes a datagram held in a reusable buffer into a Message, without
+    copying it: the payload is a memoryview into the buffer (unless it was
+    compressed), which must be copied before the buffer is reused"""
+
+    if len(view) < HEADER.size:
+        raise ProtocolError('datagram is shorter than the header')
+
+    version, message_type, session_id, sequence, nickname_length, payload_length = HEADER.unpack_from(view)
+
+    if version != VERSION:
+        raise ProtocolError('unsupported protocol version %d' % version)
+
+    start = HEADER.size + nickname_length
+    end = start + payload_length
+
+    if end > len(view):
+        raise ProtocolError('datagram is shorter than its header claims')
+
+    # The nickname is decoded straight out of the buffer, as it is looked up by name
+    nickname = str(view[HEADER.size:start], 'utf-8')
+    payload = view[start:end]
+
+    codec = message_type >> compression.CODEC_SHIFT
+    if codec:
+        message_type = message_type & compression.TYPE_MASK
+
+        try:
+            payload = compression.decompress(codec, payload)
+        except ValueError as e:
+            raise ProtocolError('payload cannot be decompressed: %s' % e)
+
+    return Message(message_type, session_id, sequence, nickname, payload)
+
+
+def compress(message_type, payload, codec):
+    """Compresses a payload with the codec agreed with its recipient, if there is
+    one and it helps, returning the message type (naming the codec) and payload"""
+
+    if codec is None:
+        return message_type, payload
+
+    compressed = compression.compress(codec, payload)
+    if compressed is None:
+        return message_type, payload
+
+    return message_type | codec << compression.CODEC_SHIFT, compressed
+
+
+def fragment(message_type, payload, size):
+    """Splits a payload larger than size bytes into the payloads of FRAGMENT
+    messages, each carrying size bytes of it at most, returning the (message
+    type, payload) of each message to send"""
+
+    if len(payload) <= size:
+        return [(message_type, payload)]
+
+    count = -(-len(payload) // size)
+    if count > 0xFFFF:
+        raise ValueError('payload is too large to fragment')
+
+    return [(FRAGMENT, FRAGMENT_HEADER.pack(message_type, index, count) + payload[index * size:(index + 1) * size])
+            for index in range(count)]
+
+
+def encode_batch(datagrams):
+    """Packs already encoded datagrams into a single BATCH datagram"""
+
+    return encode(BATCH, payload=b''.join(BATCH_ITEM.pack(len(datagram)) + datagram for datagram in datagrams))
+
+
+def unbatch(message):
+    """Unpacks a decoded BATCH into the Messages within it, or returns any
+    other Message on its own"""
+
+    if message.type != BATCH:
+        return [message]
+
+    payload = message.payload
+    messages = []
+    position = 0
+
+    while position < len(payload):
+        if position + BATCH_ITEM.size > len(payload):
+            raise ProtocolError('batch is shorter than its item header claims')
+
+        (length,) = BATCH_ITEM.unpack_from(payload, position)
+        position = position + BATCH_ITEM.size
+
+        if position + length > len(payload):
+            raise ProtocolError('batch is shorter than its item claims')
+
+        messages.append(decode(payload[position:position + length]))
+        position = position + length
+
+    return messages
+
+
+def parse_command(message):
+    """Determines the type and payload of a message typed into the chat"""
+
+    match = COMMAND_PATTERN.match(message)
+    command = match.group(1).lower() if match is not None else None
+
+    # Anything which is not a command is a chat message
+    if match is None or (command in COMMAND_ARGUMENTS) != (match.group(2) is not None):
+        return CHAT, str.encode(message, 'utf-8')
+
+    # Ask for the last messages logged in the room, e.g. '{history 20}'
+    if command == 'history':
+        if not match.group(2).isdigit():
+            return CHAT, str.encode(message, 'utf-8')
+
+        return REPLAY, REPLAY_REQUEST.pack(REPLAY_LAST, min(int(match.group(2)), REPLAY_ALL))
+
+    return COMMAND_TYPES[command], str.encode(match.group(2) or '', 'utf-8')
+
+
+def is_legacy(data):
+    """Determines if a datagram uses the legacy text format"""
+
+    return not data or data[0] >= FIRST_LEGACY_BYTE
+
+
+def encode_legacy(nickname, message):
+    """Encodes a message as a comma separated list to be sent to the chat server"""
+
+    # Construct the payload
+    payload = '%s,%s' % (nickname, message)
+
+    # Encode the payload as utf-8 byte stream, so it can be sent to the chat server
+    return str.encode(payload, 'utf-8')
+
+
+def format_legacy(message_type, payload=b''):
+    """Types out a message as a legacy client would, the reverse of
+    parse_command. Raises ProtocolError for messages the legacy format has no
+    way of sending"""
+
+    if type(payload) is not bytes:
+        payload = bytes(payload)
+
+    if message_type == CHAT:
+        return payload.decode('utf-8')
+
+    if message_type == REPLAY and len(payload) == REPLAY_REQUEST.size:
+        mode, number = REPLAY_REQUEST.unpack(payload)
+        if mode == REPLAY_LAST:
+            return '{history %d}' % number
+
+    command = LEGACY_COMMANDS.get(message_type)
+    if command is None:
+        raise ProtocolError('message type %d cannot be sent in the legacy format' % message_type)
+
+    return command % payload.decode('utf-8') if '%s' in command else command
+
+
+def decode_legacy(data):
+    """Decodes a comma separated message from a legacy client into a Message"""
+
+    # Split off the nickname only, so messages may contain commas
+    data = bytes(data).decode('utf-8').split(',', 1)
+
+    if len(data) != 2:
+        raise ProtocolError('legacy message is missing a nickname')
+
+    nickname, message = data
+
+    # Map the control messages onto their message types once, here
+    if message.lower() == LEGACY_NEW_CLIENT_MESSAGE.lower():
+        return Message(JOIN, 0, 0, nickname, b'')
+    if message.lower() == LEGACY_HEARTBEAT_MESSAGE.lower():
+        return Message(HEARTBEAT, 0, 0, nickname, b'')
+
+    message_type, payload = parse_command(message)
+
+    return Message(message_type, 0, 0, nickname, payload)
+
+
+def encode_legacy_reply(message_type, payload=b''):
+    """Encodes a message from the server for a legacy client"""
+
+    if message_type == NICKNAME_TAKEN:
+        return str.encode(LEGACY_NICKNAME_ALREADY_EXISTS_MESSAGE, 'utf-8')
+
+    if type(payload) is not bytes:
+        payload = str.encode(payload, 'utf-8')
+
+    return payload
+
+
+def decode_reply(data):
+    """Decodes a message from the server, in either format, into a Message"""
+
+    if not is_legacy(data):
+        return decode(data)
+
+    # Legacy replies are plain text, apart from the nickname-taken message
+    if bytes(data).decode('utf-8') == LEGACY_NICKNAME_ALREADY_EXISTS_MESSAGE:
+        return Message(NICKNAME_TAKEN, 0, 0, '', b'')
+
+    return Message(TEXT, 0, 0, '', bytes(data))
@@ -0,0 +1,86 @@
+class RateLimiter:
+    """Token buckets, one for each key (e.g. each client's address), which
+    refill at rate tokens a second up to burst tokens.
+
+    Each bucket is a [tokens, last refilled] list, refilled only when it is
+    next used, so idle buckets cost nothing until they are pruned"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(burst, 1)
+
+        # The key -> [tokens, last refilled] table of buckets
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def allow(self, key, now, cost=1):
+        """Takes cost tokens from a key's bucket, returning False if there are
+        not enough, in which case none are taken"""
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            # A new key starts with a full bucket
+            self.buckets[key] = [self.burst - cost, now]
+            return cost <= self.burst
+
+        tokens = bucket[0] + (now - bucket[1]) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        bucket[1] = now
+
+        if tokens < cost:
+            bucket[0] = tokens
+            return False
+
+        bucket[0] = tokens - cost
+        return True
+
+    def discard(self, key):
+        """Forgets a key's bucket"""
+
+        self.buckets.pop(key, None)
+
+    def prune(self, now):
+        """Forgets the buckets which have refilled completely, as a new bucket
+        would be just the same"""
+
+        full = [key for key, (tokens, refilled) in self.buckets.items()
+                if tokens + (now - refilled) * self.rate >= self.burst]
+
+        for key in full:
+            del self.buckets[key]
+
+
+class LoadMonitor:
+    """Tracks the fraction of each window of time spent handling messages, to
+    tell when the server is overloaded"""
+
+    def __init__(self, threshold, window, now):
+        # The fraction of the time spent busy at which the server is overloaded
+        self.threshold = threshold
+        self.window = window
+
+        # The seconds spent busy since the window started
+        self.busy = 0.0
+        self.started = now
+
+        # The fraction of the last window spent busy, and whether that was too much
+        self.load = 0.0
+        self.overloaded = False
+
+    def update(self, now):
+        """Starts a new window once the current one is over, returning True if it did"""
+
+        elapsed = now - self.started
+        if elapsed < self.window:
+            return False
+
+        self.load = self.busy / elapsed
+        self.overloaded = self.load >= self.threshold
+
+        self.busy = 0.0
+        self.started = now
+
+        return True
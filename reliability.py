@@ -0,0 +1,265 @@
+import struct
+from collections import OrderedDict, deque
+
+import protocol
+
+WINDOW_SIZE = 64  # The most messages in flight to a peer, before further messages wait in the backlog
+BACKLOG_SIZE = 1024  # The most messages waiting for room in the window, before the peer is given up on
+MAX_RETRANSMITS = 8  # The most times a message is retransmitted, before the peer is given up on
+MAX_SACKS = 16  # The most selective acknowledgements carried by a single ACK
+
+# Retransmission timeouts, in seconds
+INITIAL_RTO = 1.0
+MIN_RTO = 0.2
+MAX_RTO = 10.0
+
+# A selective acknowledgement within the payload of an ACK
+SACK = struct.Struct('!I')
+
+
+class Channel:
+    """Reliable, in-order delivery of the messages exchanged with one peer.
+
+    Outgoing messages are numbered and kept until acknowledged, with at most
+    WINDOW_SIZE of them in flight. ACKs carry the highest sequence number
+    received in order (cumulative), along with any received beyond it
+    (selective). Retransmission timeouts are estimated from the round trip
+    times of messages which were not retransmitted. Incoming messages are
+    held back until every message before them has arrived.
+
+    A channel has no timer of its own: whoever owns it calls poll() once
+    deadline has passed.
+
+    A server keeps a channel for every client, so channels use __slots__,
+    and only make a backlog once their window first fills up"""
+
+    __slots__ = ('address', 'nickname', 'session_id', 'codec', 'next_sequence', 'in_flight', 'backlog', 'srtt',
+                 'rttvar', 'rto', 'deadline', 'scheduled', 'lost', 'expected', 'out_of_order')
+
+    def __init__(self, address, nickname='', session_id=0):
+        # The (address, port) tuple of the peer
+        self.address = address
+
+        # The nickname and session id stamped on outgoing messages
+        self.nickname = str.encode(nickname, 'utf-8')
+        self.session_id = session_id
+
+        # The compression codec agreed with the peer, or None. The channel's owner
+        # compresses payloads before handing them to the channel
+        self.codec = None
+
+        # The sequence number of the next outgoing message
+        self.next_sequence = 1
+
+        # The sequence # -> [datagram, sent at, retransmits] of each unacknowledged message
+        self.in_flight = OrderedDict()
+
+        # The (message type, payload) of each message waiting for room in the
+        # window, or None until a message has first had to wait
+        self.backlog = None
+
+        # The smoothed round trip time, its variation and the retransmission timeout
+        self.srtt = None
+        self.rttvar = 0.0
+        self.rto = INITIAL_RTO
+
+        # When poll() should next be called, or None if nothing is in flight,
+        # and the deadline the channel's owner has last set a timer for
+        self.deadline = None
+        self.scheduled = None
+
+        # Set once the peer has stopped acknowledging messages
+        self.lost = False
+
+        # The sequence number of the next incoming message to deliver, and
+        # the messages which arrived ahead of it
+        self.expected = 1
+        self.out_of_order = {}
+
+    def send(self, message_type, payload, now):
+        """Queues a message, returning the datagram to send now, or None if the
+        window is full"""
+
+        if len(self.in_flight) >= WINDOW_SIZE:
+            # Give up on peers which have fallen too far behind
+            if self.backlog is None:
+                self.backlog = deque()
+
+            if len(self.backlog) >= BACKLOG_SIZE:
+                self.lost = True
+            else:
+                self.backlog.append((message_type, payload))
+
+            return None
+
+        return self.transmit(message_type, payload, now)
+
+    def ready(self):
+        """Whether a message sent now would go straight out, rather than wait in the backlog"""
+
+        return len(self.in_flight) < WINDOW_SIZE and not self.backlog
+
+    def transmit(self, message_type, payload, now):
+        """Numbers and frames a message, keeping it until it is acknowledged"""
+
+        sequence = self.next_sequence
+        self.next_sequence = sequence + 1
+
+        datagram = protocol.encode(message_type, self.session_id, self.nickname, payload, sequence)
+        self.in_flight[sequence] = [datagram, now, 0]
+
+        if self.deadline is None:
+            self.deadline = now + self.rto
+
+        return datagram
+
+    def process(self, message, now):
+        """Processes a message from the peer, returning the messages now ready to
+        be delivered and the datagrams to send back"""
+
+        # Check if the message acknowledges messages sent to the peer
+        if message.type == protocol.ACK:
+            return [], self.acknowledge(message, now)
+
+        # Unsequenced messages are delivered as they arrive
+        if not message.sequence:
+            return [message], []
+
+        return self.receive(message), [self.ack()]
+
+    def process_batch(self, messages, now):
+        """Processes several messages from the peer which arrived together, with a
+        single ACK covering all of them"""
+
+        delivered = []
+        replies = []
+        received = False
+
+        for message in messages:
+            if message.type == protocol.ACK:
+                replies.extend(self.acknowledge(message, now))
+            elif not message.sequence:
+                delivered.append(message)
+            else:
+                delivered.extend(self.receive(message))
+                received = True
+
+        if received:
+            replies.append(self.ack())
+
+        return delivered, replies
+
+    def acknowledge(self, ack, now):
+        """Forgets the messages an ACK covers, returning the datagrams which
+        were waiting in the backlog for room in the window"""
+
+        cumulative = ack.sequence
+        sacks = [sequence for (sequence,) in SACK.iter_unpack(ack.payload[:MAX_SACKS * SACK.size])]
+
+        # Messages are in flight in sequence order, so stop at the first one not covered
+        while self.in_flight:
+            sequence = next(iter(self.in_flight))
+            if sequence > cumulative:
+                break
+
+            self.sample(self.in_flight.pop(sequence), now)
+
+        for sequence in sacks:
+            entry = self.in_flight.pop(sequence, None)
+            if entry is not None:
+                self.sample(entry, now)
+
+        # Let waiting messages into the window
+        released = []
+        while self.backlog and len(self.in_flight) < WINDOW_SIZE:
+            message_type, payload = self.backlog.popleft()
+            released.append(self.transmit(message_type, payload, now))
+
+        if not self.in_flight:
+            self.deadline = None
+
+        return released
+
+    def sample(self, entry, now):
+        """Updates the round trip time estimate from an acknowledged message"""
+
+        # Retransmitted messages are ambiguous, so are not sampled (Karn's algorithm)
+        if entry[2]:
+            return
+
+        rtt = now - entry[1]
+
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+
+    def poll(self, now):
+        """Returns the datagrams due for retransmission"""
+
+        if self.deadline is None or now < self.deadline:
+            return []
+
+        due = []
+        for entry in self.in_flight.values():
+            if entry[1] + self.rto <= now:
+                entry[2] = entry[2] + 1
+
+                # Give up on peers which have stopped acknowledging messages
+                if entry[2] > MAX_RETRANSMITS:
+                    self.lost = True
+                    return []
+
+                entry[1] = now
+                due.append(entry[0])
+
+        # Back off while messages are being lost
+        if due:
+            self.rto = min(self.rto * 2, MAX_RTO)
+
+        # The next deadline belongs to the oldest message still in flight
+        if self.in_flight:
+            self.deadline = min(entry[1] for entry in self.in_flight.values()) + self.rto
+        else:
+            self.deadline = None
+
+        return due
+
+    def receive(self, message):
+        """Accepts a sequenced message, returning the messages now ready to be
+        delivered in order"""
+
+        sequence = message.sequence
+
+        # Drop duplicates, and messages too far ahead to hold on to
+        if sequence < self.expected or sequence >= self.expected + WINDOW_SIZE:
+            return []
+
+        if sequence != self.expected:
+            # Keep a copy of the payload, which may be a view into a buffer about to be reused
+            if type(message.payload) is not bytes:
+                message = message._replace(payload=bytes(message.payload))
+
+            self.out_of_order[sequence] = message
+            return []
+
+        delivered = [message]
+        self.expected = sequence + 1
+
+        # Deliver any messages which were waiting on this one
+        while self.expected in self.out_of_order:
+            delivered.append(self.out_of_order.pop(self.expected))
+            self.expected = self.expected + 1
+
+        return delivered
+
+    def ack(self):
+        """The ACK for every message received so far"""
+
+        sacks = b''.join(SACK.pack(sequence) for sequence in sorted(self.out_of_order)[:MAX_SACKS])
+
+        return protocol.encode(protocol.ACK, self.session_id, self.nickname, sacks, self.expected - 1)
@@ -1,163 +1,1538 @@
+import argparse
+import asyncio
+import heapq
+import logging
+import re
+import selectors
 import socket
+import struct
+import time
+from collections import OrderedDict
+
+import compression
+import handoff
+import logs
+import protocol
+from chatlog import ChatLog
+from coalesce import Coalescer
+from fanout import FanOut
+from fragments import Reassembler, ReassemblyError
+from logs import Sampler
+from bufferpool import BufferPool
+from metrics import TYPE_NAMES, Metrics, Sender, encode_stats
+from multicast import MulticastGroup, parse_group
+from ratelimit import LoadMonitor, RateLimiter
+from reliability import Channel
+from sessions import SessionTable
+from timerwheel import TimerWheel
+
+try:
+    # Use uvloop's faster event loop when it has been installed
+    import uvloop
+except ImportError:
+    uvloop = None
+
+logger = logging.getLogger('server')
 
 
 class Server:
     BUFFER_SIZE = 4096  # The size of the buffer to receive data from chat server
+    MAX_DATAGRAM_SIZE = 65535  # The size of the buffer to receive whole messages from other workers and servers
+    BUFFER_COUNT = 64  # The most datagrams received into the buffer pool after each select()
+    RECEIVE_BUFFER_SIZE = 4 * 1024 * 1024  # The size of the kernel receive buffer requested for the socket
+    TICK_INTERVAL = 0.05  # How often, in seconds, the asyncio engine checks for retransmissions
+    SESSION_TIMEOUT = 30.0  # How long, in seconds, a client may go without sending anything before it is removed
+    TIMEOUT_RESOLUTION = 0.5  # How precisely, in seconds, session timeouts are kept
+    MTU = 1472  # The largest datagram, in bytes, coalesced messages are packed into (Ethernet less IP/UDP headers)
+    MAX_REPLAY = 1000  # The most logged messages replayed for a single request
+    REPLAY_BATCH = 32  # The most logged messages replayed each time around the loop, across every client
+    LOG_SAMPLE = 100  # Log one in every this many messages received, at the debug level
+    SESSION_RATE = 20.0  # The messages a second each client may send, besides acknowledgements and heartbeats
+    SESSION_BURST = 40  # The most messages a client may send at once, above its rate
+    OVERLOAD_THRESHOLD = 0.9  # The fraction of the time spent handling messages at which the server is overloaded
+    OVERLOAD_COST = 4  # How many messages each message counts as against a client's rate, while overloaded
+    LOAD_WINDOW = 1.0  # How often, in seconds, the load is measured
+    REASSEMBLY_BUDGET = 4 * 1024 * 1024  # The most memory, in bytes, held in the pieces of fragmented messages
+    REASSEMBLY_TIMEOUT = 10.0  # How long, in seconds, the pieces of a fragmented message may take to arrive
+    MULTICAST_TTL = 1  # How many hops multicast datagrams reach (1 keeps them on the local network)
     server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # The UDP server socket
 
-    # Types of messages sent by the client
-    NEW_CLIENT_MESSAGE = '{NEW CLIENT REQUEST}'  # Used to indicated a new client is connecting to the server
-    QUIT_MESSAGE = '{QUIT}'  # Used to indicate a client is leaving the chat
-    NICKNAME_ALREADY_EXISTS_MESSAGE = '{NICKNAME ALREADY EXISTS}'  # Used to indicate that the nickname already exists
+    # The message types which cost the server little, and are never rate limited
+    UNLIMITED_TYPES = frozenset((protocol.ACK, protocol.HEARTBEAT, protocol.QUIT))
+
+    # The rules a room name must follow: letters and numbers only, and not too long
+    ROOM_NAME_PATTERN = re.compile('^[a-zA-Z0-9]{1,32}$')
+
+    # Engines that can be used to run the server
+    BLOCKING_ENGINE = 'blocking'  # A blocking select() loop
+    ASYNCIO_ENGINE = 'asyncio'  # An asyncio (or uvloop) datagram endpoint
+    ENGINES = (BLOCKING_ENGINE, ASYNCIO_ENGINE)
+
+    def __init__(self, address, port, engine=BLOCKING_ENGINE, registry=None, relay=None, reuse_port=False,
+                 legacy=True, session_timeout=SESSION_TIMEOUT, mtu=MTU, coalesce_delay=0, compress=True,
+                 log_directory=None, stats_port=None, log_sample=LOG_SAMPLE, address_rate=0, address_burst=0,
+                 session_rate=SESSION_RATE, session_burst=SESSION_BURST, overload_threshold=OVERLOAD_THRESHOLD,
+                 federation=None, handoff_path=None, takeover=None, reassembly_budget=REASSEMBLY_BUDGET,
+                 multicast=None, multicast_interface=None, multicast_ttl=MULTICAST_TTL):
+        # Whether clients using the legacy comma separated text format are accepted
+        self.legacy = legacy
+
+        # The session of every client in the chat, which broadcasts are sent to.
+        # Worker processes pass in a registry of the nicknames taken across every
+        # worker, and federated servers check nicknames across the federation
+        # A session id is held back for a session timeout once its session ends, so
+        # that anything its client sent meanwhile is not taken for a new client's
+        self.membership = Membership(registry if federation is None else federation, session_timeout)
+
+        # Worker processes pass in a relay, which carries broadcasts between them
+        self.relay = relay
+
+        # Federated servers pass in the federation, which carries broadcasts
+        # between servers, wherever they are
+        self.federation = federation
+
+        # The (deadline, (address, port)) heap of retransmission timers, across every channel
+        self.timers = []
+
+        # The wheel of session timeouts, by session id, which only checks when a
+        # client last sent anything once its timeout comes up
+        self.session_timeout = session_timeout
+        self.timeouts = TimerWheel(self.TIMEOUT_RESOLUTION, session_timeout, time.monotonic())
+
+        # With a coalescing delay, the datagrams for each client speaking the binary
+        # protocol are held back for up to that long, to be packed together
+        self.coalescer = Coalescer(min(mtu, self.BUFFER_SIZE), coalesce_delay) if coalesce_delay > 0 else None
+
+        # The asyncio engine's pending call to flush the coalesced datagrams
+        self.flush_handle = None
+
+        # Messages too large for a datagram of mtu bytes are sent in pieces of
+        # this many bytes, and the pieces of those clients send are put back
+        # together within the reassembly budget
+        self.mtu = mtu
+        self.fragment_size = mtu - protocol.HEADER.size - protocol.FRAGMENT_HEADER.size
+        self.reassembler = Reassembler(protocol.MAX_MESSAGE_SIZE, reassembly_budget, self.REASSEMBLY_TIMEOUT)
+
+        # Whether payloads are compressed for clients offering a codec we support,
+        # and the number of bytes that has saved
+        self.compress = compress
+        self.bytes_saved = 0
+
+        # With a log directory, every message broadcast to a room is logged there,
+        # and the session id -> session, messages iterator of each client's replay
+        # of the log, which is sent a few messages at a time
+        self.log = ChatLog(log_directory) if log_directory else None
+        self.replays = OrderedDict()
+
+        # With a handoff path, the server listens there for a restarted server to
+        # hand its sockets and sessions over to, and keeps serving once the chat
+        # empties, as it is meant to stay up. A server which has taken over from
+        # another is passed the Takeover it was handed
+        self.handoff_path = handoff_path
+        self.handoff_listener = None
+        self.handed_over = False
+
+        # The counters and histograms kept about the server, and with a stats
+        # port, the local socket a snapshot of them is sent back on when asked
+        self.metrics = Metrics()
+        self.stats_socket = None
+        if takeover is not None and takeover.stats_socket is not None:
+            self.stats_socket = takeover.stats_socket
+        elif stats_port is not None:
+            self.stats_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.stats_socket.bind(('127.0.0.1', stats_port))
+
+        # Decides which of the messages received are logged, at the debug level
+        self.sample = Sampler(logger, logging.DEBUG, log_sample)
+
+        # The token buckets of every host, which every datagram is taken from, and
+        # of every client, which the messages that make work for the server are
+        # taken from. A rate of 0 turns either off
+        self.address_limiter = RateLimiter(address_rate, address_burst or address_rate) if address_rate > 0 else None
+        self.session_limiter = RateLimiter(session_rate, session_burst or session_rate) if session_rate > 0 else None
 
-    def __init__(self, address, port):
-        # List of connected clients
-        self.clients = {}
+        # With a (group, port) multicast group, the broadcasts to each room are
+        # published to the group once, for every client which has joined it,
+        # rather than sent to each client in turn
+        self.multicast = MulticastGroup(multicast) if multicast is not None else None
+
+        # Measures how busy the server is, so it can shed load once it is too busy
+        self.load = LoadMonitor(overload_threshold, self.LOAD_WINDOW, time.monotonic()) \
+            if overload_threshold > 0 else None
 
         self.addr = address  # The address of the server
         self.port = port  # The port of the server
 
-        # Bind the server to this (address, port) tuple
-        self.server_socket.bind((self.addr, self.port))
+        # Carry on with the socket of the server taken over from, which is already bound
+        if takeover is not None:
+            self.server_socket = takeover.server_socket
+        # Check if several processes will be bound to the same port
+        elif reuse_port:
+            # Each worker process needs a socket of its own, with
+            # SO_REUSEPORT set before binding it
+            self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+        if takeover is None:
+            # Ask the kernel for a larger receive buffer, so bursts of datagrams
+            # are queued rather than dropped while the server is busy
+            try:
+                self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RECEIVE_BUFFER_SIZE)
+            except OSError:
+                # If the kernel refuses the request, keep the default buffer
+                pass
+
+            # Bind the server to this (address, port) tuple
+            self.server_socket.bind((self.addr, self.port))
+
+            # Acknowledge that the server is running and listening
+            # for incoming connections
+            logger.info("[*] Waiting for Someone to Join the Chat")
+            logger.info("[*] Chat Server listening on ('%s', %s)", self.addr, self.port,
+                        extra=dict(event='listening', host=self.addr, port=self.port))
+        else:
+            # Carry on routing for the clients of the server taken over from, which
+            # never notice it has gone
+            self.restore(takeover.snapshot)
+
+        # Publish through the interface clients reach the server on, unless told otherwise
+        if self.multicast is not None:
+            if multicast_interface is None:
+                multicast_interface = self.addr if self.addr not in ('', '0.0.0.0') else '0.0.0.0'
 
-        # Acknowledge that the server is running and listening
-        # for incoming connections
-        print("[*] Waiting for Someone to Join the Chat")
-        print("[*] Chat Server listening on ('%s', %s)" % (self.addr, self.port))
+            MulticastGroup.configure(self.server_socket, multicast_interface, multicast_ttl)
+            logger.info("[*] Publishing room broadcasts to the multicast group ('%s', %s)", *self.multicast.address,
+                        extra=dict(event='multicast', group=self.multicast.address[0],
+                                   port=self.multicast.address[1]))
 
-        # Accept and handle all incoming connections
-        self.accept_incoming_connections(self.server_socket)
+        # Listen for the next server to take over from this one, only once
+        # everything has been handed over to this one
+        if handoff_path is not None:
+            self.handoff_listener = handoff.listen(handoff_path)
+
+        # Accept and handle all incoming connections using the chosen engine
+        if engine == self.ASYNCIO_ENGINE:
+            self.serve_asyncio(self.server_socket)
+        else:
+            self.accept_incoming_connections(self.server_socket)
+
+        # Show how much bandwidth compression has saved
+        if self.compress:
+            logger.info("[*] Compression saved %d bytes", self.bytes_saved,
+                        extra=dict(event='compression', bytes_saved=self.bytes_saved))
+
+        if self.log is not None:
+            self.log.close()
+
+        if self.stats_socket is not None:
+            self.stats_socket.close()
+
+        # The path belongs to the server which has taken over, if there is one
+        if self.handoff_listener is not None:
+            if self.handed_over:
+                self.handoff_listener.close()
+            else:
+                handoff.close(self.handoff_listener, self.handoff_path)
 
     def accept_incoming_connections(self, server_socket):
         """Handle all incoming connections"""
 
-        # Store the current sequence #
-        current_sequence_num = 0
+        selector = selectors.DefaultSelector()
+        selector.register(server_socket, selectors.EVENT_READ)
 
-        while 1:
-            # Receive a message from the client
-            data, address = server_socket.recvfrom(self.BUFFER_SIZE)
+        # Also listen for broadcasts relayed from the other workers, and requests for stats
+        if self.relay is not None:
+            selector.register(self.relay.socket, selectors.EVENT_READ)
+        if self.stats_socket is not None:
+            selector.register(self.stats_socket, selectors.EVENT_READ)
+        if self.federation is not None:
+            selector.register(self.federation.socket, selectors.EVENT_READ)
 
-            # Decode the data sent by the client
-            # and obtain the nickname and message sent by client
-            nickname, message = Server.decode_message(data)
+        # And for the next server to take over from this one
+        if self.handoff_listener is not None:
+            selector.register(self.handoff_listener, selectors.EVENT_READ)
 
-            # The address of the client
-            addr = address[0]
-            # The port used by the client
-            port = address[1]
+        # Messages are sent through a Sender, so a failed send is counted rather than fatal
+        sender = Sender(server_socket, self.metrics)
 
-            # Check if the received message indicates that
-            # a new client is connecting to the server
-            if message.lower() == self.NEW_CLIENT_MESSAGE.lower():
-                # Check if the client already exists
-                if nickname not in self.clients:
-                    # Add the client to the connected clients list
-                    self.clients[nickname] = [address, current_sequence_num]
+        # Datagrams from clients are received straight into preallocated buffers
+        pool = BufferPool(self.BUFFER_COUNT, self.BUFFER_SIZE)
 
-                    # Show that this client has connected
-                    print("[+] 🖥️ Client (%s, '%s', %s): has connected" % (nickname, address[0], address[1]))
+        while 1:
+            # Wait for a message, or until the next retransmission, session timeout
+            # or batch of coalesced datagrams is due
+            deadlines = [self.timers[0][0]] if self.timers else []
+            if self.timeouts:
+                deadlines.append(self.timeouts.next_tick())
+            if self.coalescer:
+                deadlines.append(self.coalescer.deadline)
+            if self.replays:
+                deadlines.append(time.monotonic() + self.TICK_INTERVAL)
+            if self.federation is not None:
+                deadlines.append(self.federation.deadline())
+            if self.relay is not None and self.relay.deadline() is not None:
+                deadlines.append(self.relay.deadline())
+            timeout = max(min(deadlines) - time.monotonic(), 0) if deadlines else None
 
-                    # Broadcast a message showing that this client has joined the chat
-                    self.broadcast(server_socket, "%s has joined the chat!" % nickname)
+            for key, events in selector.select(timeout):
+                if key.fileobj is server_socket:
+                    # Handle every message waiting from the clients, and stop once the
+                    # last client has left the chat
+                    for data, address in pool.receive(server_socket):
+                        if not self.handle_message(sender, data, address):
+                            selector.close()
+                            return
+                    continue
 
-                    # Construct welcome message to send back to this specific client
-                    message = str.encode('Welcome %s! '
-                                         'If you ever want to quit, type \'{quit}\' within the chat client to exit.' % nickname)
+                # Stop serving once the sockets and sessions have been handed over
+                if key.fileobj is self.handoff_listener:
+                    if not self.hand_over(sender):
+                        selector.close()
+                        return
+                    continue
 
-                    # Send welcome message to this specific client
-                    server_socket.sendto(message, address)
+                # Receive a message from the relay, federation or a stats request
+                data, address = key.fileobj.recvfrom(self.MAX_DATAGRAM_SIZE)
 
-                    # Continue iterating, after adding the client
-                    continue
+                if key.fileobj is self.stats_socket:
+                    self.handle_stats(self.stats_socket, address)
+                elif self.federation is not None and key.fileobj is self.federation.socket:
+                    self.handle_federation(sender, data, address)
                 else:
-                    # If nickname already exists within the list of connected clients,
-                    # then someone is already using that name
+                    self.handle_relay(sender, data, address)
 
-                    # Send a message back to the client indicating that this
-                    # nickname is already taken and to choose another one
-                    server_socket.sendto(str.encode(self.NICKNAME_ALREADY_EXISTS_MESSAGE, 'utf-8'), address)
+            # Retransmit any messages which have not been acknowledged in time,
+            # and remove clients which have gone quiet
+            self.poll_timers(sender)
+            self.expire_sessions()
+            self.monitor()
+            self.poll_relay()
+            self.poll_federation(sender)
 
-                    # Continue iterating, after rejecting nickname
-                    continue
+            # Carry on replaying the log to the clients which asked for it
+            self.replay(sender)
+
+            # Send the batches of coalesced datagrams which are due
+            self.flush(sender)
+
+    def serve_asyncio(self, server_socket):
+        """Handle all incoming connections using an asyncio datagram endpoint"""
+
+        # Prefer uvloop's event loop, if it is available
+        if uvloop is not None:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+        asyncio.run(self.run_asyncio(server_socket))
+
+    async def run_asyncio(self, server_socket):
+        """Serve the chat over the already bound socket until the last client leaves"""
+
+        loop = asyncio.get_running_loop()
+
+        # Resolved once the transport has been closed
+        closed = loop.create_future()
+
+        # Wrap the bound socket in a datagram transport
+        transport, _ = await loop.create_datagram_endpoint(
+            lambda: ServerProtocol(self, closed), sock=server_socket)
+
+        # Also listen for broadcasts relayed from the other workers
+        relay_transport = None
+        if self.relay is not None:
+            relay_transport, _ = await loop.create_datagram_endpoint(
+                lambda: RelayProtocol(self, transport), sock=self.relay.socket)
+
+        # And for the other servers of the federation
+        federation_transport = None
+        if self.federation is not None:
+            federation_transport, _ = await loop.create_datagram_endpoint(
+                lambda: FederationProtocol(self, transport), sock=self.federation.socket)
+
+        # And for requests for stats
+        stats_transport = None
+        if self.stats_socket is not None:
+            stats_transport, _ = await loop.create_datagram_endpoint(
+                lambda: StatsProtocol(self), sock=self.stats_socket)
+
+        # And for the next server to take over from this one, stopping once the
+        # sockets and sessions have been handed over
+        def on_handoff():
+            if not self.hand_over(transport):
+                transport.close()
+
+        if self.handoff_listener is not None:
+            loop.add_reader(self.handoff_listener, on_handoff)
+
+        try:
+            # Retransmit any messages which have not been acknowledged in time,
+            # and remove clients which have gone quiet
+            while not closed.done():
+                await asyncio.wait([closed], timeout=self.TICK_INTERVAL)
+                self.poll_timers(transport)
+                self.expire_sessions()
+                self.monitor()
+                self.poll_relay()
+                self.poll_federation(transport)
+                self.replay(transport)
+                self.arm_flush(transport)
+        finally:
+            transport.close()
+            if relay_transport is not None:
+                relay_transport.close()
+            if stats_transport is not None:
+                stats_transport.close()
+            if federation_transport is not None:
+                federation_transport.close()
+            if self.handoff_listener is not None:
+                loop.remove_reader(self.handoff_listener)
+
+    def handle_message(self, server_socket, data, address):
+        """Handle a single message from a client, returning False once the
+        last client has left the chat"""
+
+        metrics = self.metrics
+        started = time.perf_counter()
+
+        # Check which format the client is speaking
+        legacy = protocol.is_legacy(data)
+
+        # Drop floods, and shed load, before anything is decoded
+        if self.limited(data, address, legacy):
+            return True
+
+        # Decode the data sent by the client
+        try:
+            if legacy:
+                # Drop legacy clients, unless running in compatibility mode
+                if not self.legacy:
+                    metrics.events['rejected_legacy'] += 1
+                    return True
+
+                message = protocol.decode_legacy(data)
             else:
-                # The last sequence # associated with this client
-                last_sequence_num = self.clients[nickname][1]
+                # The payload is only copied out of the datagram when it has to be
+                message = protocol.decode_view(data)
+        except (protocol.ProtocolError, UnicodeDecodeError):
+            # Drop datagrams which cannot be decoded
+            metrics.events['malformed'] += 1
+            return True
+
+        decoded = time.perf_counter()
+        metrics.decode.observe(decoded - started)
+        metrics.received[message.type] += 1
+
+        if self.sample():
+            logger.debug("[*] [RECEIVED] %s (%d bytes) from %s", TYPE_NAMES.get(message.type, message.type),
+                         len(data), message.nickname, extra=dict(event='received', sampled=self.sample.every))
+
+        try:
+            return self.route(server_socket, message, address, legacy)
+        finally:
+            finished = time.perf_counter()
+            metrics.dispatch.observe(finished - decoded)
+
+            if self.load is not None:
+                self.load.busy = self.load.busy + finished - started
+
+    def limited(self, data, address, legacy):
+        """Whether a datagram should be dropped, going by no more than where it
+        came from and its message type, so floods are dropped cheaply"""
+
+        if self.address_limiter is None and self.session_limiter is None and self.load is None:
+            return False
+
+        now = time.monotonic()
+
+        # Every datagram from a host counts against its rate
+        if self.address_limiter is not None and not self.address_limiter.allow(address[0], now):
+            self.metrics.events['rate_limited_address'] += 1
+            return True
+
+        # Peek at the message type, which is all a legacy client's datagrams need
+        message_type = None
+        if not legacy and len(data) > 1:
+            message_type = data[1] & compression.TYPE_MASK
+
+            if message_type in self.UNLIMITED_TYPES:
+                return False
+
+        overloaded = self.load is not None and self.load.overloaded
+
+        # While overloaded, turn away new clients, and count each message from the
+        # clients already in the chat as several, so the busiest are slowed most
+        if overloaded and message_type == protocol.JOIN:
+            self.metrics.events['shed'] += 1
+            return True
+
+        if self.session_limiter is not None and \
+                not self.session_limiter.allow(address, now, self.OVERLOAD_COST if overloaded else 1):
+            self.metrics.events['shed' if overloaded else 'rate_limited_session'] += 1
+            return True
+
+        return False
+
+    def monitor(self):
+        """Measures the load once each window is over, forgetting the buckets of
+        hosts and clients which have gone quiet"""
+
+        if self.load is None:
+            return
+
+        now = time.monotonic()
+        if not self.load.update(now):
+            return
+
+        if self.load.overloaded:
+            logger.warning("[!] Overloaded: %d%% busy", self.load.load * 100,
+                           extra=dict(event='overloaded', load=round(self.load.load, 3)))
+
+        for limiter in (self.address_limiter, self.session_limiter):
+            if limiter is not None:
+                limiter.prune(now)
+
+    def route(self, server_socket, message, address, legacy):
+        """Handle a decoded message from a client, returning False once the
+        last client has left the chat"""
+
+        # Check if the received message indicates that
+        # a new client is connecting to the server
+        if message.type == protocol.JOIN:
+            self.join(server_socket, message.nickname, address, legacy, message.payload, message.session_id)
 
-                # Check if this client has timed-out, if he or she
-                # hasn't acknowledged the last 3 or more messages sent
-                # to the server
-                if (current_sequence_num - last_sequence_num) >= 3:
-                    # Show that the server is dropping this client
-                    print("[-] 🖥 Client (%s, '%s', %s): has disconnected" % (nickname, addr, port))
+            # Keep serving, after adding or rejecting the client
+            return True
 
-                    # If the client has timed-out, remove them from the chat
-                    del self.clients[nickname]
+        # Find the sender's session by the session id it was issued, which must have
+        # been issued to its address. The nickname it sends is never trusted, so no
+        # client can speak for another
+        sessions = self.membership.sessions
+        session = sessions.get(message.session_id) if message.session_id else sessions.at(address)
 
-                    # Continue iterating, after removing the client
+        # Drop messages from clients which are not in the chat
+        if session is None:
+            self.metrics.events['unknown_sender'] += 1
+            return True
+
+        if session.address != address:
+            self.metrics.events['spoofed'] += 1
+            return True
+
+        channel = session.channel
+
+        # Any message, including a heartbeat or an ACK, shows the client is still there
+        now = time.monotonic()
+        session.last_seen = now
+
+        # Messages from legacy clients are delivered as they arrive, while
+        # messages from other clients go through their reliable channel
+        if channel is None:
+            delivered = [message]
+        else:
+            # The channel drops any sequence number it has already had, so a datagram
+            # the network duplicated, or the client sent again, is only acknowledged
+            delivered, replies = channel.process(message, now)
+
+            # Send the acknowledgement, along with any messages let out of the backlog
+            for reply in replies:
+                self.transmit(server_socket, reply, address)
+            self.schedule(channel)
+
+        # Handle the messages which are now in order, until the client leaves
+        for message in delivered:
+            if session not in sessions:
+                break
+
+            # Put messages sent in pieces back together, once every piece has arrived
+            if message.type == protocol.FRAGMENT:
+                message = self.reassemble(session, message, now)
+                if message is None:
                     continue
 
-                # Update the current sequence number
-                current_sequence_num = current_sequence_num + 1
+            if not self.dispatch(server_socket, session, message):
+                return False
 
-                # Check if the client has left the chat
-                if message.lower() != self.QUIT_MESSAGE.lower():
-                    # Construct the message to send to the client
-                    message = '%s > %s' % (nickname, message)
+        return True
 
-                    # If client has not left chat, broadcast the received message
-                    self.broadcast(server_socket, message)
-                else:
-                    # If client has left chat, because he or she has entered '{quit}':
+    def reassemble(self, session, message, now):
+        """Adds a piece of a message from a client, returning the whole message
+        once every piece has arrived, or None"""
+
+        try:
+            return self.reassembler.add(session.id, message, now)
+        except ReassemblyError as e:
+            self.metrics.events['reassembly_dropped'] += 1
+            logger.debug("[!] Dropped a fragmented message from %s: %s", session.nickname, e,
+                         extra=dict(event='reassembly_dropped', nickname=session.nickname))
+            return None
+
+    def join(self, server_socket, nickname, address, legacy, offered=b'', request_id=0):
+        """Adds a new client to the chat, unless the nickname is already taken.
+        Joining is idempotent: a retry of the join which let the client in is
+        answered again, rather than adding the client twice"""
 
-                    # Show that the client has disconnected
-                    print("[-] 🖥 Client (%s, '%s', %s): has disconnected" % (nickname, addr, port))
+        # Check if the client at this address is already in the chat
+        existing = self.membership.sessions.at(address)
+        if existing is not None:
+            if existing.nickname == nickname and existing.request_id == request_id:
+                # The client has not heard back yet. The welcome is retransmitted to
+                # clients speaking the binary protocol anyway, so is only sent again
+                # to legacy clients
+                self.metrics.events['duplicate_joins'] += 1
+                if existing.channel is None:
+                    self.send(server_socket, existing, protocol.WELCOME, self.welcome(nickname))
+                return
 
-                    # Remove the client from the client's list
-                    del self.clients[nickname]
+            # A new join request from the same address means the client has started
+            # over, so its old session is of no more use
+            if request_id:
+                self.metrics.events['rejoined'] += 1
+                self.remove(existing)
 
-                    if len(self.clients) > 0:
-                        # Continue iterating, after removing the client
-                        continue
-                    else:
-                        # If there aren't any clients connected, break and exit
-                        break
+        # Each client speaking the binary protocol gets a reliable channel, and
+        # every client gets a session id
+        now = time.monotonic()
+        channel = None if legacy else Channel(address)
 
-                # Update the client's last sequence number
-                self.clients[nickname] = [address, current_sequence_num]
+        # Add the client to the chat, if the nickname is not already taken
+        session = self.membership.add(nickname, address, legacy, channel, now, request_id)
+        if session is None:
+            # If nickname already exists within the list of connected clients
+            # (or the address is already in the chat under another nickname),
+            # then someone is already using that name
+
+            # Send a message back to the client indicating that this
+            # nickname is already taken and to choose another one
+            self.metrics.events['nickname_taken'] += 1
+            server_socket.sendto(self.reply(protocol.NICKNAME_TAKEN, b'', legacy), address)
+            return
+
+        # Start the client's session timeout
+        self.timeouts.schedule(session.id, self.session_timeout, now)
+
+        # Agree on one of the compression codecs the client offered, if any
+        codec = compression.negotiate(offered) if self.compress and channel is not None else None
+        if codec is not None:
+            self.send(server_socket, session, protocol.COMPRESSION, codec)
+            channel.codec = compression.NAMES[codec]
+
+        # Show that this client has connected
+        logger.info("[+] 🖥️ Client (%s, '%s', %s): has connected", nickname, address[0], address[1],
+                    extra=dict(event='connected', nickname=nickname, address=address[0], port=address[1]))
+
+        # Broadcast a message showing that this client has joined the chat
+        self.broadcast(server_socket, "%s has joined the chat!" % nickname, protocol.DEFAULT_ROOM)
+
+        # Send welcome message, along with its session id, to this specific client
+        self.send(server_socket, session, protocol.WELCOME, self.welcome(nickname))
+
+        # Invite clients speaking the binary protocol to join the multicast group
+        if self.multicast is not None and channel is not None:
+            self.send(server_socket, session, protocol.MULTICAST_INVITE,
+                      self.multicast.invitation(protocol.DEFAULT_ROOM, False))
 
     @staticmethod
-    def decode_message(data):
-        """Decodes a message from the client"""
+    def welcome(nickname):
+        """Constructs the welcome message sent back to a client joining the chat"""
+
+        return ('Welcome %s! You are in the \'%s\' room. '
+                'Type \'{join <room>}\' to switch rooms, \'{leave}\' to return here, '
+                '\'{rooms}\' to list them and \'{history <n>}\' to see the last messages. '
+                'If you ever want to quit, type \'{quit}\' within the chat client to exit.'
+                % (nickname, protocol.DEFAULT_ROOM))
+
+    def dispatch(self, server_socket, session, message):
+        """Handle a message from a client in the chat, returning False once the
+        last client has left the chat"""
+
+        # Check if the client has left the chat
+        if message.type == protocol.CHAT:
+            # Construct the message to send to the client
+            text = b'%s > %s' % (str.encode(session.nickname, 'utf-8'), message.payload)
+
+            # If client has not left chat, broadcast the received message to his or her room
+            self.broadcast(server_socket, text, session.room)
+        elif message.type == protocol.ROOM_JOIN:
+            # Move the client into the room he or she asked for
+            self.switch_room(server_socket, session, str(message.payload, 'utf-8', 'replace'))
+        elif message.type == protocol.ROOM_LEAVE:
+            # Move the client back into the default room
+            self.switch_room(server_socket, session, protocol.DEFAULT_ROOM)
+        elif message.type == protocol.ROOM_LIST:
+            # List every room, along with how many clients are in it
+            rooms = ', '.join('%s (%d)' % (room, count) for room, count in sorted(self.membership.rooms().items()))
+
+            self.send(server_socket, session, protocol.TEXT, 'Rooms: %s' % rooms)
+        elif message.type == protocol.REPLAY:
+            # Replay messages from the log of the client's room
+            self.start_replay(server_socket, session, message.payload)
+        elif message.type == protocol.MULTICAST_ACCEPT:
+            # Publish the client's room to it through the multicast group from now on
+            self.accept_multicast(server_socket, session)
+        elif message.type == protocol.MULTICAST_REPAIR:
+            # Send the multicast messages the client missed again, through its channel
+            self.repair_multicast(server_socket, session, message.payload)
+        elif message.type == protocol.QUIT:
+            # If client has left chat, because he or she has entered '{quit}':
+            self.remove(session)
+
+            # If there aren't any clients connected, stop serving, unless the server
+            # is meant to stay up until it hands over to another
+            return self.handoff_path is not None or len(self.membership) > 0
+
+        # Ignore heartbeats, which have already done their job, and message
+        # types which are only sent by the server
+        return True
+
+    def remove(self, session):
+        """Removes a client from the chat"""
+
+        nickname, address = session.nickname, session.address
+
+        # Show that the client has disconnected
+        logger.info("[-] 🖥 Client (%s, '%s', %s): has disconnected", nickname, address[0], address[1],
+                    extra=dict(event='disconnected', nickname=nickname, address=address[0], port=address[1]))
+
+        # Remove the client from the client's list
+        self.membership.remove(session, time.monotonic())
+        self.timeouts.cancel(session.id)
+
+        if self.coalescer is not None:
+            self.coalescer.discard(address)
+
+        self.replays.pop(session.id, None)
+        self.reassembler.discard(session.id)
+        self.forget_room(session.room)
+
+        if self.session_limiter is not None:
+            self.session_limiter.discard(address)
+
+    def switch_room(self, server_socket, session, room):
+        """Moves a client from his or her current room into another room"""
+
+        # Room names follow the same rules as nicknames
+        if not self.ROOM_NAME_PATTERN.match(room):
+            self.send(server_socket, session, protocol.TEXT, 'Room names must only contain letters and numbers.')
+            return
+
+        old_room = session.room
+        if room == old_room:
+            return
+
+        # Let the old room know the client has left, before moving him or her
+        self.membership.move(session, room)
+        self.broadcast(server_socket, "%s has left the room." % session.nickname, old_room)
+        self.forget_room(old_room)
+
+        # Clients receiving from the multicast group are told where the new room's messages start
+        if session.multicast:
+            self.send(server_socket, session, protocol.MULTICAST_INVITE, self.multicast.invitation(room, True))
+
+        # Let the new room, including the client, know the client has arrived
+        self.broadcast(server_socket, "%s has joined the room '%s'." % (session.nickname, room), room)
+
+    def send(self, server_socket, session, message_type, payload):
+        """Sends a message to a single client in the chat"""
+
+        channel = session.channel
+
+        # Legacy clients are sent plain text
+        if channel is None:
+            server_socket.sendto(self.reply(message_type, payload, True), session.address)
+            return
+
+        if type(payload) is not bytes:
+            payload = str.encode(payload, 'utf-8')
+
+        # Compress the payload, if the client has agreed to it
+        compressed_type, compressed = protocol.compress(message_type, payload, channel.codec)
+        self.bytes_saved = self.bytes_saved + len(payload) - len(compressed)
+
+        # Send it in pieces, if it is too large for one datagram
+        now = time.monotonic()
+        for fragment_type, fragment in protocol.fragment(compressed_type, compressed, self.fragment_size):
+            datagram = channel.send(fragment_type, fragment, now)
+            if datagram is not None:
+                self.transmit(server_socket, datagram, session.address)
+        self.schedule(channel)
+
+    def transmit(self, server_socket, datagram, address):
+        """Sends a datagram to a client speaking the binary protocol, through the
+        coalescer when there is one"""
+
+        if self.coalescer is None:
+            server_socket.sendto(datagram, address)
+            return
+
+        for ready in self.coalescer.add(address, datagram, time.monotonic()):
+            server_socket.sendto(ready, address)
+
+    def coalesce(self, server_socket, now):
+        """A sendto(datagram, address) which adds the datagram to its client's
+        batch instead, sending whatever the coalescer hands back"""
+
+        add = self.coalescer.add
+
+        def sendto(datagram, address):
+            for ready in add(address, datagram, now):
+                server_socket.sendto(ready, address)
+
+        return sendto
+
+    def flush(self, server_socket, now=None):
+        """Sends the batches of coalesced datagrams which are due"""
+
+        if self.coalescer is None:
+            return
+
+        for address, datagram in self.coalescer.flush(time.monotonic() if now is None else now):
+            server_socket.sendto(datagram, address)
+
+    def arm_flush(self, transport):
+        """Makes sure the asyncio engine flushes the oldest batch of coalesced
+        datagrams once it is due"""
+
+        if self.coalescer is None or not self.coalescer or self.flush_handle is not None:
+            return
+
+        def on_flush():
+            self.flush_handle = None
+            self.flush(transport)
+            self.arm_flush(transport)
+
+        delay = max(self.coalescer.deadline - time.monotonic(), 0)
+        self.flush_handle = asyncio.get_running_loop().call_later(delay, on_flush)
+
+    @staticmethod
+    def reply(message_type, payload, legacy):
+        """Encodes an unsequenced message from the server in the client's format"""
+
+        if legacy:
+            return protocol.encode_legacy_reply(message_type, payload)
+
+        return protocol.encode(message_type, payload=payload)
+
+    def broadcast(self, server_socket, message, room):
+        """Broadcast a message to all clients in a room, across every worker"""
+
+        # Check if the message is not already a byte-stream
+        if type(message) is not bytes:
+            # If the message is not a byte-stream, then
+            # encode the message
+            message = str.encode(message, 'utf-8')
+
+        self.deliver(server_socket, message, room)
+
+        # Hand the message to the other workers, for their clients in the room
+        if self.relay is not None:
+            dropped = self.relay.publish(room, message)
+            if dropped:
+                self.metrics.events['relay_dropped'] += dropped
+
+        # And to the other servers of the federation
+        if self.federation is not None:
+            self.federation.publish(room, message)
+
+    def deliver(self, server_socket, message, room):
+        """Sends a message to this process' clients in a room"""
+
+        # Log the message, whether it was broadcast here or by another worker
+        if self.log is not None:
+            self.log.append(room, message)
+
+        # Only the members of the room are sent the message
+        recipients = self.membership.recipients(room)
+        if not recipients:
+            return
+
+        started = time.perf_counter()
+
+        # Legacy clients all receive the same plain text, sent in batches
+        if recipients.legacy_clients:
+            recipients.legacy_clients.send(server_socket, message)
+
+        # Clients receiving from the multicast group are all sent the message at once
+        if recipients.multicast_clients:
+            self.publish(server_socket, message, room, recipients.multicast_clients)
+
+        # Every other client is sent the message through its own channel, which
+        # numbers it, so only the small header differs between recipients. The
+        # payload is compressed (and split into pieces, if it is too large for one
+        # datagram) once for each codec the recipients have agreed to
+        now = time.monotonic()
+        lost = []
+        frames = {}
+        sendto = server_socket.sendto if self.coalescer is None else self.coalesce(server_socket, now)
+        for address, channel in zip(recipients.clients.addresses, recipients.clients.peers):
+            frame = frames.get(channel.codec)
+            if frame is None:
+                message_type, payload = protocol.compress(protocol.TEXT, message, channel.codec)
+                frame = frames[channel.codec] = (protocol.fragment(message_type, payload, self.fragment_size),
+                                                 len(message) - len(payload))
+
+            self.bytes_saved = self.bytes_saved + frame[1]
+
+            for fragment_type, fragment in frame[0]:
+                datagram = channel.send(fragment_type, fragment, now)
+                if datagram is not None:
+                    sendto(datagram, address)
+                elif channel.lost:
+                    lost.append(channel)
+                    break
+
+            if channel.deadline != channel.scheduled:
+                self.schedule(channel)
+
+        # Drop clients which have fallen too far behind to catch up
+        for channel in lost:
+            self.drop(channel)
 
-        # Split the message into a ',' separated list
-        data = str(data.decode('utf-8')).split(',')
+        self.metrics.broadcast.observe(time.perf_counter() - started)
 
-        # Parse the message to obtain:
+    def publish(self, server_socket, message, room, addresses):
+        """Publishes a message to a room's clients receiving from the multicast group"""
 
-        # The client's nickname
-        nickname = data[0]
-        # The client's message
-        message = data[1]
+        entry = self.multicast.publish(room, message)
 
-        return nickname, message
+        # Every client can decompress zlib, whichever codecs it offered
+        message_type, payload = protocol.compress(protocol.MULTICAST, entry,
+                                                  compression.ZLIB if self.compress else None)
+        datagram = protocol.encode(message_type, payload=payload)
 
-    def broadcast(self, server_socket, message):
-        """Broadcast a message to all connected clients"""
+        if len(datagram) <= self.mtu:
+            server_socket.sendto(datagram, self.multicast.address)
+            return
 
-        for nickname in self.clients:
-            # Obtain (address, port) tuple of the client
-            client = self.clients[nickname][0]
+        # Messages too large for one datagram are sent to each client through its
+        # channel instead, in pieces, where they still take their place in the room's order
+        for address in addresses:
+            self.send(server_socket, self.membership.sessions.at(address), protocol.MULTICAST, entry)
 
-            # Check if the message is not already a byte-stream
-            if type(message) is not bytes:
-                # If the message is not a byte-stream, then
-                # encode the message
-                message = str.encode(message, 'utf-8')
+    def accept_multicast(self, server_socket, session):
+        """Starts publishing a client's room to it through the multicast group,
+        once the client has joined the group"""
 
-            # Send message to client
-            server_socket.sendto(message, client)
+        if self.multicast is None or session.channel is None or session.multicast:
+            return
+
+        self.membership.start_multicast(session)
+
+        # The messages sent through the client's channel so far end where the room's multicast messages start
+        self.send(server_socket, session, protocol.MULTICAST_INVITE, self.multicast.invitation(session.room, True))
+
+    def repair_multicast(self, server_socket, session, request):
+        """Sends the room's multicast messages a client missed again, through its
+        channel, as far as they are still kept"""
+
+        if not session.multicast or len(request) < protocol.MULTICAST_RANGE.size:
+            return
+
+        first, last = protocol.MULTICAST_RANGE.unpack_from(request)
+
+        for entry in self.multicast.repair(session.room, first, last):
+            self.metrics.events['multicast_repaired'] += 1
+            self.send(server_socket, session, protocol.MULTICAST, entry)
+
+    def forget_room(self, room):
+        """Forgets the multicast messages of a room which has emptied"""
+
+        if self.multicast is not None and self.membership.recipients(room) is None:
+            self.multicast.forget(room)
+
+    def start_replay(self, server_socket, session, request):
+        """Starts replaying the messages a client asked for from the log of its room"""
+
+        if self.log is None:
+            self.send(server_socket, session, protocol.TEXT, 'This chat server does not keep a log.')
+            return
+
+        try:
+            mode, number = protocol.REPLAY_REQUEST.unpack(request)
+        except struct.error:
+            # Drop requests which cannot be decoded
+            return
+
+        log = self.log.room(session.room)
+
+        # Never replay more than MAX_REPLAY messages at once
+        if mode == protocol.REPLAY_SINCE:
+            messages = log.read(max(number + 1, log.head - self.MAX_REPLAY + 1))
+        else:
+            messages = log.last(min(number, self.MAX_REPLAY))
+
+        # A new request replaces any replay still going
+        self.replays.pop(session.id, None)
+        self.replays[session.id] = (session, messages)
+
+    def replay(self, server_socket):
+        """Sends the next few logged messages of each replay, taking turns, and
+        only while the client's channel has room, so a replay never holds up
+        the loop or floods the client"""
+
+        budget = self.REPLAY_BATCH
+        sessions = self.membership.sessions
+
+        while self.replays and budget > 0:
+            progress = False
+
+            for session_id, (session, messages) in list(self.replays.items()):
+                if session not in sessions:
+                    del self.replays[session_id]
+                    continue
+
+                channel = session.channel
+                if channel is not None and not channel.ready():
+                    continue
+
+                try:
+                    entry = next(messages, None)
+                except (ValueError, OSError) as e:
+                    # The log could not be read any further, so the replay ends there
+                    logger.warning("[!] Could not replay the log of the room '%s': %s", session.room, e,
+                                   extra=dict(event='replay_failed', room=session.room))
+                    entry = None
+
+                if entry is None:
+                    del self.replays[session_id]
+                    continue
+
+                sequence, message = entry
+
+                # Legacy clients are sent the text alone
+                if channel is None:
+                    self.send(server_socket, session, protocol.TEXT, bytes(message))
+                else:
+                    self.send(server_socket, session, protocol.HISTORY, protocol.HISTORY_ENTRY.pack(sequence) + message)
+
+                progress = True
+                budget = budget - 1
+                if budget == 0:
+                    break
+
+            # Stop once every client left replaying has a full window
+            if not progress:
+                break
+
+    def schedule(self, channel):
+        """Makes sure a channel's next retransmission deadline is on the timer heap"""
+
+        if channel.deadline is not None and channel.scheduled != channel.deadline:
+            heapq.heappush(self.timers, (channel.deadline, channel.address))
+            channel.scheduled = channel.deadline
+
+    def poll_timers(self, server_socket):
+        """Retransmits the messages whose retransmission timeouts have passed"""
+
+        now = time.monotonic()
+
+        while self.timers and self.timers[0][0] <= now:
+            deadline, address = heapq.heappop(self.timers)
+
+            # Skip timers of clients which have left, or which have since been rescheduled
+            session = self.membership.sessions.at(address)
+            channel = session.channel if session is not None else None
+            if channel is None or channel.scheduled != deadline:
+                continue
+
+            channel.scheduled = None
+
+            for datagram in channel.poll(now):
+                self.transmit(server_socket, datagram, channel.address)
+
+            # Drop clients which have stopped acknowledging messages
+            if channel.lost:
+                self.drop(channel)
+            else:
+                self.schedule(channel)
+
+    def expire_sessions(self):
+        """Removes the clients which have not sent anything within the session timeout"""
+
+        now = time.monotonic()
+
+        # Drop the messages whose pieces have stopped coming
+        for _ in self.reassembler.expire(now):
+            self.metrics.events['reassembly_expired'] += 1
+
+        for session_id in self.timeouts.advance(now):
+            session = self.membership.sessions.get(session_id)
+            if session is None:
+                continue
+
+            # Clients which have been heard from since are given the rest of their timeout
+            idle = now - session.last_seen
+            if idle < self.session_timeout:
+                self.timeouts.schedule(session_id, self.session_timeout - idle, now)
+                continue
+
+            nickname, address = session.nickname, session.address
+            logger.info("[-] 🖥 Client (%s, '%s', %s): has timed out", nickname, address[0], address[1],
+                        extra=dict(event='timed_out', nickname=nickname, address=address[0], port=address[1]))
+            self.metrics.events['timed_out'] += 1
+
+            self.remove(session)
+
+    def drop(self, channel):
+        """Removes a client whose channel has been given up on"""
+
+        session = self.membership.sessions.at(channel.address)
+        if session is not None and session.channel is channel:
+            self.metrics.events['dropped'] += 1
+            self.remove(session)
+
+    def handle_relay(self, server_socket, data, address):
+        """Delivers a broadcast relayed from another worker to this process' clients"""
+
+        for room, message in self.relay.receive(data, address):
+            self.metrics.received[protocol.RELAY] += 1
+            self.deliver(server_socket, message, room)
+
+    def poll_relay(self):
+        """Keeps the relay's channels to the other workers going"""
+
+        if self.relay is not None:
+            self.relay.poll()
+
+    def handle_federation(self, server_socket, data, address):
+        """Delivers the broadcasts relayed by another server of the federation to
+        this server's clients"""
+
+        for room, message in self.federation.receive(data, address):
+            self.metrics.received[protocol.PEER_BROADCAST] += 1
+            self.deliver(server_socket, message, room)
+
+        self.resolve_collisions(server_socket)
+
+    def poll_federation(self, server_socket):
+        """Keeps the federation's channels to the other servers going"""
+
+        if self.federation is None:
+            return
+
+        self.federation.poll()
+        self.resolve_collisions(server_socket)
+
+    def resolve_collisions(self, server_socket):
+        """Turns away the clients whose nicknames were claimed first on another server"""
+
+        while self.federation.collisions:
+            nickname = self.federation.collisions.pop()
+            session = self.membership.sessions.named(nickname)
+            if session is None:
+                continue
+
+            address = session.address
+            logger.info("[-] 🖥 Client (%s, '%s', %s): has lost its nickname to another server",
+                        nickname, address[0], address[1],
+                        extra=dict(event='collision', nickname=nickname, address=address[0], port=address[1]))
+            self.metrics.events['collisions'] += 1
+
+            self.send(server_socket, session, protocol.TEXT,
+                      'The nickname %s was taken on another server at the same time. '
+                      'Please join again with another.' % nickname)
+            self.remove(session)
+
+    def hand_over(self, server_socket):
+        """Hands the server's sockets and sessions over to the server which has
+        connected to take over from it, returning False once it has, so this
+        server stops serving"""
+
+        try:
+            connection, _ = self.handoff_listener.accept()
+        except BlockingIOError:
+            return True
+
+        # Send the batches being held back, as the server taking over starts without them
+        if self.coalescer is not None:
+            for address, datagram in self.coalescer.flush():
+                server_socket.sendto(datagram, address)
+
+        streams = self.multicast.streams if self.multicast is not None else None
+        snapshot = handoff.dump(self.membership.sessions, streams, self.reassembler.partial)
+        federation_socket = self.federation.socket if self.federation is not None else None
+
+        try:
+            handoff.hand_over(connection, self.server_socket, self.stats_socket, federation_socket, snapshot)
+        except OSError as error:
+            # Keep serving, should the server taking over have gone away
+            logger.warning("[!] Could not hand over to the server taking over: %s", error,
+                           extra=dict(event='handoff_failed'))
+            connection.close()
+            return True
+
+        logger.info("[*] Handed %d clients over to the server taking over (%d byte snapshot)",
+                    len(self.membership.sessions), len(snapshot),
+                    extra=dict(event='handed_over', sessions=len(self.membership.sessions), size=len(snapshot)))
+
+        self.handed_over = True
+        return False
+
+    def restore(self, snapshot):
+        """Puts back the sessions of the server taken over from, along with their
+        session timeouts and retransmission timers, and the messages they were
+        partway through sending in pieces, and carries on numbering the rooms'
+        multicast messages where it left off"""
+
+        next_id, sessions, streams, partial = handoff.load(snapshot)
+        now = time.monotonic()
+
+        for session in sessions:
+            # Without a multicast group, every client is sent its room's broadcasts through its channel
+            if self.multicast is None:
+                session.multicast = False
+
+            self.membership.restore(session)
+
+            # Give each client the rest of its timeout. Monotonic time is shared by
+            # every process on the host, so the times in the snapshot still hold
+            self.timeouts.schedule(session.id, max(self.session_timeout - (now - session.last_seen), 0), now)
+
+            if session.channel is not None:
+                self.schedule(session.channel)
+
+        self.membership.sessions.resume(next_id, now)
+
+        # The pieces already acknowledged are not sent again, so carry on from them.
+        # Oldest first, as the snapshot has them, so they still expire in order
+        for session_id, entry in partial.items():
+            if self.membership.sessions.get(session_id) is not None:
+                self.reassembler.restore(session_id, entry)
+
+        if self.multicast is not None:
+            self.multicast.streams.update(streams)
+
+        logger.info("[*] Took over %d clients on ('%s', %s)", len(sessions), self.addr, self.port,
+                    extra=dict(event='took_over', sessions=len(sessions), host=self.addr, port=self.port))
+
+    def stats(self):
+        """A snapshot of the server's metrics, along with its current state"""
+
+        return self.metrics.snapshot(
+            sessions=len(self.membership.sessions),
+            rooms=len(self.membership.fanouts),
+            timers=len(self.timers),
+            replays=len(self.replays),
+            reassembling=len(self.reassembler),
+            multicast_clients=sum(len(fanout.multicast_clients) for fanout in self.membership.fanouts.values()),
+            reassembly_bytes=self.reassembler.size,
+            pending_batches=len(self.coalescer.pending) if self.coalescer is not None else 0,
+            bytes_saved=self.bytes_saved,
+            load=round(self.load.load, 3) if self.load is not None else None,
+            overloaded=self.load.overloaded if self.load is not None else False,
+            peers=sum(peer.up for peer in self.federation.peers.values()) if self.federation is not None else None,
+        )
+
+    def handle_stats(self, stats_socket, address):
+        """Answers a request for stats with a JSON snapshot"""
+
+        stats_socket.sendto(encode_stats(self.stats()), address)
+
+
+class Membership:
+    """The session of every client in the chat, along with an index of the
+    members of each room.
+
+    Worker processes each keep a table of their own clients, and pass in a
+    registry of the nicknames and rooms of the clients across every worker"""
+
+    def __init__(self, registry=None, reuse_delay=0.0):
+        # The session id -> Session table, indexed by (address, port) and nickname
+        self.sessions = SessionTable(reuse_delay)
+
+        # The recipients of each room's broadcasts, kept up to date as clients
+        # join, leave and switch rooms. Empty rooms are removed
+        self.fanouts = {}
+
+        # The nicknames taken across every worker, if there are several
+        self.registry = registry
+
+    def __len__(self):
+        if self.registry is not None:
+            return len(self.registry)
+
+        return len(self.sessions)
+
+    def add(self, nickname, address, legacy=False, channel=None, now=0.0, request_id=0):
+        """Adds a client to the default room, returning its new Session, or None
+        if the nickname is already taken"""
+
+        if self.sessions.named(nickname) is not None or self.sessions.at(address) is not None:
+            return None
+
+        # Claim the nickname across every worker
+        if self.registry is not None and not self.registry.claim(nickname, protocol.DEFAULT_ROOM):
+            return None
+
+        session = self.sessions.add(nickname, address, protocol.DEFAULT_ROOM, channel, now, request_id)
+        self.fanouts.setdefault(protocol.DEFAULT_ROOM, FanOut()).add(address, legacy, channel)
+
+        return session
+
+    def restore(self, session):
+        """Puts back a client handed over by the server this one took over from,
+        in the room it was in"""
+
+        if self.registry is not None:
+            self.registry.claim(session.nickname, session.room)
+
+        self.sessions.restore(session)
+        self.fanouts.setdefault(session.room, FanOut()).add(session.address, session.legacy, session.channel,
+                                                            session.multicast)
+
+    def remove(self, session, now):
+        """Removes a client from the chat"""
+
+        if not self.sessions.remove(session, now):
+            return
+
+        self.leave_room(session.address, session.room)
+
+        if self.registry is not None:
+            self.registry.release(session.nickname)
+
+    def move(self, session, room):
+        """Moves a client into another room"""
+
+        self.leave_room(session.address, session.room)
+
+        session.room = room
+        self.fanouts.setdefault(room, FanOut()).add(session.address, session.legacy, session.channel,
+                                                    session.multicast)
+
+        if self.registry is not None:
+            self.registry.move(session.nickname, room)
+
+    def start_multicast(self, session):
+        """Has a client receive its room's broadcasts from the multicast group,
+        rather than through its own channel"""
+
+        session.multicast = True
+
+        fanout = self.fanouts[session.room]
+        fanout.remove(session.address)
+        fanout.add(session.address, multicast=True)
+
+    def leave_room(self, address, room):
+        """Removes an address from a room's recipients"""
+
+        fanout = self.fanouts[room]
+        fanout.remove(address)
+
+        if not fanout:
+            del self.fanouts[room]
+
+    def rooms(self):
+        """The room -> number of clients table of every room in use"""
+
+        if self.registry is not None:
+            return self.registry.rooms()
+
+        return {room: len(fanout) for room, fanout in self.fanouts.items()}
+
+    def recipients(self, room):
+        """The FanOut of every client in a room, or None if the room is empty"""
+
+        return self.fanouts.get(room)
+
+
+class FederationProtocol(asyncio.DatagramProtocol):
+    """Feeds datagrams from the other servers of the federation into a chat server"""
+
+    def __init__(self, server, transport):
+        # The chat server handling the datagrams
+        self.server = server
+
+        # The transport of the server's own socket, which broadcasts are sent from
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        self.server.handle_federation(self.transport, data, address)
+        self.server.arm_flush(self.transport)
+
+    def error_received(self, exc):
+        # A peer is not listening yet, keep serving
+        pass
+
+
+class RelayProtocol(asyncio.DatagramProtocol):
+    """Feeds broadcasts relayed from other workers into a chat server"""
+
+    def __init__(self, server, transport):
+        # The chat server handling the broadcasts
+        self.server = server
+
+        # The transport of the server's own socket, which the broadcasts are sent from
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        self.server.handle_relay(self.transport, data, address)
+        self.server.arm_flush(self.transport)
+
+
+class StatsProtocol(asyncio.DatagramProtocol):
+    """Answers requests for a chat server's stats"""
+
+    def __init__(self, server):
+        # The chat server the stats are of
+        self.server = server
+
+        # The datagram transport, set once the endpoint is created
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        self.server.handle_stats(self.transport, address)
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    """Feeds datagrams received by an asyncio transport into a chat server"""
+
+    def __init__(self, server, closed):
+        # The chat server handling the messages
+        self.server = server
+
+        # The future resolved when the transport is closed
+        self.closed = closed
+
+        # The datagram transport, set once the endpoint is created
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        # The transport exposes sendto(data, address), so it is handed to
+        # the server in place of the socket
+        # A memoryview lets the payload be sliced out without copying it
+        if not self.server.handle_message(self.transport, memoryview(data), address):
+            # If there aren't any clients connected, close and exit
+            self.transport.close()
+        else:
+            self.server.arm_flush(self.transport)
+
+    def error_received(self, exc):
+        # A send to a client failed (e.g. ICMP port unreachable), keep serving
+        self.server.metrics.events['send_errors'] += 1
+
+    def connection_lost(self, exc):
+        if not self.closed.done():
+            self.closed.set_result(None)
 
 
 if __name__ == '__main__':
-    Server('127.0.0.1', 4096)
+    parser = argparse.ArgumentParser(description='UDP chat server')
+    parser.add_argument('--host', default='127.0.0.1', help='the address to listen on')
+    parser.add_argument('--port', type=int, default=4096, help='the port to listen on')
+    parser.add_argument('--engine', choices=Server.ENGINES, default=Server.BLOCKING_ENGINE,
+                        help='the engine used to receive and dispatch datagrams')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='the number of worker processes sharing the port through SO_REUSEPORT')
+    parser.add_argument('--no-legacy', dest='legacy', action='store_false',
+                        help='reject clients using the legacy comma separated text format')
+    parser.add_argument('--session-timeout', type=float, default=Server.SESSION_TIMEOUT,
+                        help='the seconds a client may go without sending anything before it is removed')
+    parser.add_argument('--coalesce-delay', type=float, default=0,
+                        help='the seconds messages to the same client may be held back to be packed '
+                             'into one datagram (0 sends each message straight away)')
+    parser.add_argument('--mtu', type=int, default=Server.MTU,
+                        help='the largest datagram coalesced messages are packed into')
+    parser.add_argument('--no-compression', dest='compress', action='store_false',
+                        help='never compress payloads, even for clients which offer to')
+    parser.add_argument('--log-directory',
+                        help='the directory every message broadcast is logged in, to be replayed to clients')
+    parser.add_argument('--stats-port', type=int,
+                        help='the local port a JSON snapshot of the server\'s metrics is sent back from, '
+                             'to any datagram (each worker uses the next port along)')
+    parser.add_argument('--address-rate', type=float, default=0,
+                        help='the datagrams a second each host may send (0, the default, has no limit)')
+    parser.add_argument('--address-burst', type=int, default=0,
+                        help='the most datagrams a host may send at once, above its rate (defaults to the rate)')
+    parser.add_argument('--session-rate', type=float, default=Server.SESSION_RATE,
+                        help='the messages a second each client may send, besides acknowledgements and '
+                             'heartbeats (0 has no limit)')
+    parser.add_argument('--session-burst', type=int, default=Server.SESSION_BURST,
+                        help='the most messages a client may send at once, above its rate')
+    parser.add_argument('--overload-threshold', type=float, default=Server.OVERLOAD_THRESHOLD,
+                        help='the fraction of the time spent handling messages at which the server starts '
+                             'shedding load (0 never sheds)')
+    parser.add_argument('--reassembly-budget', type=int, default=Server.REASSEMBLY_BUDGET,
+                        help='the most bytes held in the pieces of large messages clients send, '
+                             'across every client')
+    parser.add_argument('--multicast', metavar='GROUP:PORT',
+                        help='the IPv4 multicast group room broadcasts are published to once, for the clients '
+                             'which join it, rather than sent to each client')
+    parser.add_argument('--multicast-interface',
+                        help='the address of the interface multicast datagrams are sent through '
+                             '(defaults to the address listened on)')
+    parser.add_argument('--multicast-ttl', type=int, default=Server.MULTICAST_TTL,
+                        help='how many hops multicast datagrams reach')
+    parser.add_argument('--federation',
+                        help='the host:port this server speaks to the other servers of a federation on')
+    parser.add_argument('--peer', dest='peers', action='append', default=[],
+                        help='the federation host:port of another server (repeat for each)')
+    parser.add_argument('--handoff', metavar='PATH',
+                        help='the Unix socket a restarted server takes over this one\'s port and clients '
+                             'through, without the clients noticing. Start the new server with the same '
+                             'options, and the old one hands over and exits')
+    parser.add_argument('--federation-name',
+                        help='the unique name the server introduces itself to its peers by '
+                             '(defaults to its federation host:port)')
+    logs.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.federation and args.workers > 1:
+        parser.error('a federated server runs a single worker')
+    if args.handoff and args.workers > 1:
+        parser.error('a server handing over to its successor runs a single worker')
+    if args.multicast and args.workers > 1:
+        parser.error('a server publishing to a multicast group runs a single worker')
+
+    multicast = None
+    if args.multicast:
+        try:
+            multicast = parse_group(args.multicast)
+        except (OSError, ValueError) as e:
+            parser.error('--multicast: %s' % e)
+
+    # Log through a background thread, so the loop never waits on the terminal
+    listener = logs.setup(**logs.options(args))
+
+    # The options shared by every server process
+    options = dict(engine=args.engine, legacy=args.legacy, session_timeout=args.session_timeout,
+                   mtu=args.mtu, coalesce_delay=args.coalesce_delay, compress=args.compress,
+                   log_directory=args.log_directory, stats_port=args.stats_port, log_sample=args.log_sample,
+                   address_rate=args.address_rate, address_burst=args.address_burst,
+                   session_rate=args.session_rate, session_burst=args.session_burst,
+                   overload_threshold=args.overload_threshold, reassembly_budget=args.reassembly_budget)
+
+    # The options only a server running a single worker takes
+    single = dict(handoff_path=args.handoff, multicast=multicast, multicast_interface=args.multicast_interface,
+                  multicast_ttl=args.multicast_ttl)
+
+    try:
+        # Take over from the server already running, if there is one
+        takeover = handoff.take_over(args.handoff) if args.handoff else None
+
+        if args.workers > 1:
+            # Imported here, as workers imports this module
+            from workers import run_workers
+
+            run_workers(args.host, args.port, args.workers, log_options=logs.options(args), **options)
+        elif args.federation:
+            from federation import Federation, bind, parse_address
+
+            peers = [parse_address(peer) for peer in args.peers]
+
+            # The federation state starts over, and the peers learn this server's clients again
+            federation_socket = takeover.federation_socket if takeover is not None else None
+            if federation_socket is None:
+                federation_socket = bind(parse_address(args.federation))
+
+            Server(args.host, args.port, federation=Federation(federation_socket,
+                                                               args.federation_name or args.federation, peers),
+                   takeover=takeover, **single, **options)
+        else:
+            Server(args.host, args.port, takeover=takeover, **single, **options)
+    finally:
+        listener.stop()
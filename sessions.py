@@ -0,0 +1,164 @@
+from collections import deque
+
+
+class Session:
+    """One client in the chat. Sessions use __slots__, so each costs a few
+    pointers rather than a dictionary of its own"""
+
+    __slots__ = ('id', 'nickname', 'address', 'room', 'channel', 'last_seen', 'request_id', 'multicast')
+
+    def __init__(self, session_id, nickname, address, room, channel, last_seen, request_id=0):
+        # The id the server issued the client when it joined, which the client
+        # stamps on every message it sends from then on
+        self.id = session_id
+
+        # The join request id the client joined with (0 for none), which its retries carry too
+        self.request_id = request_id
+
+        self.nickname = nickname
+        self.address = address  # The (address, port) tuple of the client
+        self.room = room  # The room the client is in
+
+        # The reliable channel of a client speaking the binary protocol (legacy clients have None)
+        self.channel = channel
+
+        # When the client last sent anything
+        self.last_seen = last_seen
+
+        # Whether the client receives its room's broadcasts from the multicast group
+        self.multicast = False
+
+    @property
+    def legacy(self):
+        """Whether the client speaks the legacy text format, and so has no channel"""
+
+        return self.channel is None
+
+
+class SessionTable:
+    """Every client in the chat, in a list indexed by session id, with
+    (address, port) and nickname indexes, so whichever a datagram is looked
+    up by takes a single list or dictionary lookup.
+
+    Session ids are issued densely, the ids of sessions which have ended
+    being issued again oldest first, so the list stays as long as the most
+    clients there have been at once. An id is only issued again once it has
+    been free for reuse_delay seconds, by when the datagrams stamped with it
+    by the client whose session ended have long since stopped arriving"""
+
+    MAX_SESSION_ID = 0xFFFFFFFF  # The largest session id the header has room for
+
+    def __init__(self, reuse_delay=0.0):
+        # The sessions, indexed by session id, with None for the ids not in use
+        # (0 is never issued, as it is what clients send before they have been welcomed)
+        self.sessions = [None]
+
+        # The (time freed, session id) of the sessions which have ended, oldest
+        # first, to be issued again once reuse_delay has gone by
+        self.free = deque()
+        self.reuse_delay = reuse_delay
+
+        # The number of sessions
+        self.count = 0
+
+        # The (address, port) -> Session and nickname -> Session indexes
+        self.addresses = {}
+        self.nicknames = {}
+
+    @property
+    def next_id(self):
+        """The session id issued next, once the ids of ended sessions run out"""
+
+        return len(self.sessions)
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        return iter([session for session in self.sessions if session is not None])
+
+    def __contains__(self, session):
+        return self.get(session.id) is session
+
+    def add(self, nickname, address, room, channel, now, request_id=0):
+        """Issues a new session, or returns None if the nickname is taken, the
+        address already has a session, or every session id is in use"""
+
+        if nickname in self.nicknames or address in self.addresses:
+            return None
+
+        if self.free and now - self.free[0][0] >= self.reuse_delay:
+            session_id = self.free.popleft()[1]
+        elif len(self.sessions) <= self.MAX_SESSION_ID:
+            session_id = len(self.sessions)
+            self.sessions.append(None)
+        else:
+            return None
+
+        if channel is not None:
+            channel.session_id = session_id
+
+        session = Session(session_id, nickname, address, room, channel, now, request_id)
+        self.insert(session)
+
+        return session
+
+    def restore(self, session):
+        """Puts back a session handed over by the server this one took over from,
+        keeping the session id its client already stamps on its messages"""
+
+        # Make room for the id, the ids skipped over being freed by resume()
+        while len(self.sessions) <= session.id:
+            self.sessions.append(None)
+
+        self.insert(session)
+
+    def resume(self, next_id, now):
+        """Once every session handed over has been restored, carries on issuing
+        session ids where the server taken over from left off"""
+
+        while len(self.sessions) < next_id:
+            self.sessions.append(None)
+
+        # When the ids not in use were freed was not handed over, so they are held back as if freed now
+        self.free = deque((now, session_id) for session_id in range(1, len(self.sessions))
+                          if self.sessions[session_id] is None)
+
+    def insert(self, session):
+        self.sessions[session.id] = session
+        self.addresses[session.address] = session
+        self.nicknames[session.nickname] = session
+        self.count = self.count + 1
+
+    def remove(self, session, now):
+        """Removes a session, returning False if it had already been removed"""
+
+        if self.get(session.id) is not session:
+            return False
+
+        self.sessions[session.id] = None
+        del self.addresses[session.address]
+        del self.nicknames[session.nickname]
+
+        self.free.append((now, session.id))
+        self.count = self.count - 1
+
+        return True
+
+    def get(self, session_id):
+        """The session with an id, or None"""
+
+        if session_id < len(self.sessions):
+            return self.sessions[session_id]
+
+        return None
+
+    def at(self, address):
+        """The session of the client at an (address, port), or None"""
+
+        return self.addresses.get(address)
+
+    def named(self, nickname):
+        """The session of the client with a nickname, or None"""
+
+        return self.nicknames.get(nickname)
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+import chatclient
+import protocol
+
+SERVER = ('127.0.0.1', 4096)
+
+
+class Transport:
+    """Keeps the datagrams a client sends"""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address=None):
+        self.sent.append(data)
+
+    def close(self):
+        pass
+
+
+def sent_by(legacy, *messages):
+    """The datagrams a client sends for each (message type, payload)"""
+
+    async def send():
+        client = chatclient.ChatClient(SERVER, 'alice', legacy=legacy, compress=False)
+        client.connection_made(Transport())
+
+        for message in messages:
+            client.send_message(*message)
+
+        client.abort()
+        return client.transport.sent
+
+    return asyncio.run(send())
+
+
+def test_send_message_through_the_channel():
+    sent = sent_by(False, (protocol.CHAT, b'hello'), (protocol.ROOM_JOIN, b'games'))
+
+    messages = [protocol.decode(datagram) for datagram in sent]
+    assert [(message.type, message.sequence, message.payload) for message in messages] == \
+        [(protocol.CHAT, 1, b'hello'), (protocol.ROOM_JOIN, 2, b'games')]
+
+
+def test_send_message_in_the_legacy_format():
+    sent = sent_by(True, (protocol.CHAT, b'hello'), (protocol.ROOM_JOIN, b'games'), (protocol.ROOM_LIST,),
+                   (protocol.REPLAY, protocol.REPLAY_REQUEST.pack(protocol.REPLAY_LAST, 20)))
+
+    assert sent == [b'alice,hello', b'alice,{join games}', b'alice,{rooms}', b'alice,{history 20}']
+
+    # The server reads each back as the message it was sent as
+    assert [protocol.decode_legacy(datagram).type for datagram in sent] == \
+        [protocol.CHAT, protocol.ROOM_JOIN, protocol.ROOM_LIST, protocol.REPLAY]
+
+
+def test_send_message_the_legacy_format_cannot_carry():
+    with pytest.raises(protocol.ProtocolError):
+        sent_by(True, (protocol.MULTICAST_ACCEPT,))
+
+
+def test_request_history():
+    async def request():
+        client = chatclient.ChatClient(SERVER, 'alice', compress=False)
+        client.connection_made(Transport())
+
+        client.request_history(20)
+        client.request_history(since=client.last_logged)
+
+        # Replayed messages move on where the next catch up starts from
+        client.datagram_received(protocol.encode(protocol.HISTORY, payload=protocol.HISTORY_ENTRY.pack(42) + b'hi'),
+                                 SERVER)
+        client.request_history(since=client.last_logged)
+
+        # Log sequence numbers carry on past 32 bits
+        entry = protocol.HISTORY_ENTRY.pack(1 << 40)
+        client.datagram_received(protocol.encode(protocol.HISTORY, payload=entry + b'hi'), SERVER)
+        client.request_history(since=client.last_logged)
+        client.request_history()
+
+        client.abort()
+        return client.transport.sent
+
+    requests = [protocol.decode(datagram) for datagram in asyncio.run(request())]
+    replays = [protocol.REPLAY_REQUEST.unpack(message.payload) for message in requests
+               if message.type == protocol.REPLAY]
+    assert replays == [(protocol.REPLAY_LAST, 20), (protocol.REPLAY_SINCE, 0), (protocol.REPLAY_SINCE, 42),
+                       (protocol.REPLAY_SINCE, 1 << 40), (protocol.REPLAY_LAST, protocol.REPLAY_ALL)]
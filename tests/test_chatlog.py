@@ -0,0 +1,49 @@
+import os
+
+import chatlog
+
+
+def test_rotating_during_a_replay(tmp_path, monkeypatch):
+    # Every record starts a new segment, and only two are kept
+    monkeypatch.setattr(chatlog, 'SEGMENT_SIZE', 1)
+    monkeypatch.setattr(chatlog, 'MAX_SEGMENTS', 2)
+
+    log = chatlog.RoomLog(str(tmp_path))
+    for number in range(3):
+        log.append(b'message %d' % number)
+
+    replay = log.read(2)
+    assert next(replay) == (2, b'message 1')
+
+    # Rotate the segment being replayed out of the log
+    for number in range(3, 6):
+        log.append(b'message %d' % number)
+
+    assert log.firsts == [5, 6]
+
+    # The replay carries on with the segments it started with
+    assert list(replay) == [(3, b'message 2')]
+
+    # which are deleted once it has finished
+    assert sorted(os.listdir(str(tmp_path))) == ['%020d.log' % 5, '%020d.log' % 6]
+    log.close()
+
+
+def test_abandoned_replay_lets_go_of_its_segments(tmp_path, monkeypatch):
+    monkeypatch.setattr(chatlog, 'SEGMENT_SIZE', 1)
+    monkeypatch.setattr(chatlog, 'MAX_SEGMENTS', 2)
+
+    log = chatlog.RoomLog(str(tmp_path))
+    log.append(b'first')
+    log.append(b'second')
+
+    replay = log.read(1)
+    next(replay)
+
+    log.append(b'third')
+    assert len(os.listdir(str(tmp_path))) == 3
+
+    replay.close()
+    assert len(os.listdir(str(tmp_path))) == 2
+    assert list(log.read(1)) == [(2, b'second'), (3, b'third')]
+    log.close()
@@ -0,0 +1,28 @@
+import ctypes
+
+from fanout import AddressArray, FanOut, RecipientList, sockaddr_in
+
+
+def test_removing_moves_the_last_recipient_into_place():
+    for recipients in (RecipientList(), AddressArray()):
+        for port in range(4):
+            recipients.add(('127.0.0.1', port), peer=port)
+
+        recipients.remove(('127.0.0.1', 1))
+        recipients.remove(('127.0.0.1', 3))
+        recipients.remove(('127.0.0.1', 9))
+
+        assert list(recipients) == [('127.0.0.1', 0), ('127.0.0.1', 2)] and recipients.peers == [0, 2]
+        assert all(recipients.positions[address] == position for position, address in enumerate(recipients))
+
+    # Each header still points at its own recipient's sockaddr_in
+    for position, address in enumerate(recipients):
+        header = recipients.headers[position].msg_hdr
+        assert ctypes.string_at(header.msg_name, header.msg_namelen) == sockaddr_in(address).raw
+
+
+def test_only_legacy_recipients_are_kept_for_batches():
+    recipients = FanOut([(('127.0.0.1', 1), False), (('127.0.0.1', 2), True)])
+
+    assert type(recipients.clients) is RecipientList and list(recipients.clients) == [('127.0.0.1', 1)]
+    assert list(recipients.legacy_clients) == [('127.0.0.1', 2)] and len(recipients) == 2
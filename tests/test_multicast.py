@@ -0,0 +1,45 @@
+import multicast
+from multicast import GAP_TIMEOUT, REORDER_DELAY, MulticastGroup, Stream
+
+
+def test_reordered_messages_are_not_asked_for_again():
+    stream = Stream('lobby', 1)
+
+    assert stream.receive(2, 'lobby', b'two', 0.0) == []
+    assert stream.deadline == REORDER_DELAY
+
+    # The missing message turns up before the reorder delay is over
+    assert stream.receive(1, 'lobby', b'one', 0.01) == [b'one', b'two']
+    assert stream.deadline is None
+    assert stream.poll(1.0) == ([], None)
+
+
+def test_gaps_which_last_are_asked_for_once_then_skipped():
+    stream = Stream('lobby', 1)
+    stream.receive(3, 'lobby', b'three', 0.0)
+    stream.receive(4, 'lobby', b'four', 0.01)
+
+    assert stream.poll(0.01) == ([], None)
+    assert stream.poll(REORDER_DELAY) == ([], (1, 2))
+    assert stream.poll(REORDER_DELAY + 0.01) == ([], None)
+
+    # One of the two missing messages is sent again, the other never is
+    assert stream.receive(1, 'lobby', b'one', 0.1) == [b'one']
+    assert stream.poll(REORDER_DELAY + GAP_TIMEOUT) == ([b'three', b'four'], None)
+    assert stream.deadline is None
+
+
+def test_other_rooms_are_ignored():
+    stream = Stream('lobby', 1)
+
+    assert stream.receive(2, 'games', b'two', 0.0) == []
+    assert stream.deadline is None
+
+
+def test_repairs_come_from_the_latest_messages():
+    group = MulticastGroup(('239.255.42.99', 5000), repair_size=2)
+    entries = [group.publish('lobby', b'message %d' % number) for number in range(3)]
+
+    assert group.repair('lobby', 1, 3) == entries[1:]
+    assert multicast.decode_entry(entries[2]) == (3, 'lobby', b'message 2')
+    assert group.invitation('lobby', True)[6:10] == (4).to_bytes(4, 'big')
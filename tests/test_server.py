@@ -0,0 +1,103 @@
+import socket
+import time
+
+import handoff
+import protocol
+from reliability import Channel
+from server import Server
+
+
+class Socket:
+    """Keeps the datagrams the server sends, by address"""
+
+    def __init__(self):
+        self.sent = []
+
+    def sendto(self, data, address):
+        self.sent.append((bytes(data), address))
+
+
+class Client:
+    """A client speaking the binary protocol, straight to the server"""
+
+    def __init__(self, server, sock, nickname, port):
+        self.server = server
+        self.socket = sock
+        self.nickname = nickname
+        self.address = ('127.0.0.1', port)
+        self.channel = Channel(('127.0.0.1', 4096), nickname=nickname)
+
+        self.handle(protocol.encode(protocol.JOIN, nickname=nickname))
+        welcome = [message for message in self.received() if message.type == protocol.WELCOME]
+        self.channel.session_id = welcome[-1].session_id
+
+    def handle(self, datagram):
+        return self.server.handle_message(self.socket, datagram, self.address)
+
+    def send(self, message_type, payload=b''):
+        return self.handle(self.channel.send(message_type, payload, time.monotonic()))
+
+    def received(self):
+        messages = []
+        for message in (protocol.decode(data) for data, address in self.socket.sent if address == self.address):
+            messages.extend(protocol.unbatch(message))
+        return messages
+
+    def texts(self):
+        return [bytes(message.payload) for message in self.received() if message.type == protocol.TEXT]
+
+
+class Unstarted(Server):
+    """A server which is driven by the test, one datagram at a time, rather
+    than serving its socket"""
+
+    def __init__(self, *args, **options):
+        # Server.server_socket is shared by the class, so give each server its own
+        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        super().__init__(*args, **options)
+
+    def accept_incoming_connections(self, server_socket):
+        server_socket.close()
+
+
+def make_server(**options):
+    return Unstarted('127.0.0.1', 0, session_rate=0, **options)
+
+
+def test_a_new_client_after_one_has_left_is_heard():
+    server = make_server()
+    sock = Socket()
+
+    keeper = Client(server, sock, 'keeper', 5001)
+    alice = Client(server, sock, 'alice', 5002)
+    alice.send(protocol.CHAT, b'hello')
+    alice.send(protocol.QUIT)
+
+    bob = Client(server, sock, 'bob', 5003)
+    assert bob.channel.session_id != alice.channel.session_id
+
+    bob.send(protocol.CHAT, b'hi')
+    assert b'bob > hi' in keeper.texts()
+    assert b'alice > hello' in keeper.texts()
+
+
+def test_a_message_in_pieces_is_put_together_across_a_handoff():
+    server = make_server()
+    sock = Socket()
+
+    keeper = Client(server, sock, 'keeper', 5001)
+    alice = Client(server, sock, 'alice', 5002)
+
+    text = b'x' * 1200
+    first, second, third = protocol.fragment(protocol.CHAT, text, 500)
+    alice.send(*first)
+    alice.send(*second)
+
+    # The pieces already acknowledged are handed over along with the sessions
+    successor = make_server()
+    successor.restore(handoff.dump(server.membership.sessions, None, server.reassembler.partial))
+    assert len(successor.reassembler) == 1 and successor.reassembler.size == 1000
+
+    keeper.server = alice.server = successor
+    alice.send(*third)
+    assert b'alice > ' + text in keeper.texts()
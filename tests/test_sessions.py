@@ -0,0 +1,57 @@
+from reliability import Channel
+from sessions import SessionTable
+
+
+def test_lookups():
+    sessions = SessionTable()
+    channel = Channel(('10.0.0.1', 4000))
+
+    alice = sessions.add('alice', ('10.0.0.1', 4000), 'lobby', channel, 0.0)
+    bob = sessions.add('bob', ('10.0.0.2', 4000), 'lobby', None, 0.0)
+
+    assert (alice.id, bob.id) == (1, 2)
+    assert channel.session_id == alice.id
+    assert not alice.legacy and bob.legacy
+
+    assert sessions.get(alice.id) is alice
+    assert sessions.get(0) is None and sessions.get(99) is None
+    assert sessions.at(('10.0.0.2', 4000)) is bob
+    assert sessions.named('alice') is alice
+    assert len(sessions) == 2 and bob in sessions
+
+    # Nicknames and addresses are only ever in one session
+    assert sessions.add('alice', ('10.0.0.3', 4000), 'lobby', None, 0.0) is None
+    assert sessions.add('carol', ('10.0.0.1', 4000), 'lobby', None, 0.0) is None
+
+
+def test_ended_sessions_ids_are_issued_again_oldest_first_once_held_back():
+    sessions = SessionTable(reuse_delay=30.0)
+    first, second, third = (sessions.add('client%d' % number, ('10.0.0.1', number), 'lobby', None, 0.0)
+                            for number in range(3))
+
+    assert sessions.remove(second, 10.0) and sessions.remove(first, 20.0)
+    assert not sessions.remove(first, 20.0)
+    assert second not in sessions and list(sessions) == [third]
+
+    # Until an ended session's id has been held back long enough, new ids are issued instead
+    assert sessions.add('soon', ('10.0.0.2', 0), 'lobby', None, 39.0).id == 4
+
+    assert sessions.add('again', ('10.0.0.2', 1), 'lobby', None, 50.0).id == second.id
+    assert sessions.add('early', ('10.0.0.2', 2), 'lobby', None, 49.0).id == 5
+    assert sessions.add('later', ('10.0.0.2', 3), 'lobby', None, 50.0).id == first.id
+
+
+def test_resuming_after_a_handover():
+    handed_over = SessionTable()
+    for number in range(5):
+        handed_over.add('client%d' % number, ('10.0.0.1', number), 'lobby', None, 0.0)
+    handed_over.remove(handed_over.get(2), 0.0)
+
+    sessions = SessionTable(reuse_delay=30.0)
+    for session in handed_over:
+        sessions.restore(session)
+    sessions.resume(handed_over.next_id, 100.0)
+
+    assert len(sessions) == 4 and sessions.get(5).nickname == 'client4'
+    assert sessions.add('new', ('10.0.0.2', 0), 'lobby', None, 100.0).id == 6
+    assert sessions.add('newer', ('10.0.0.2', 1), 'lobby', None, 130.0).id == 2
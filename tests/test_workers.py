@@ -0,0 +1,45 @@
+from workers import Relay
+
+A, B = ('127.0.0.1', 7001), ('127.0.0.1', 7002)
+
+
+class Socket:
+    """Keeps the datagrams a relay sends, by address"""
+
+    def __init__(self, address):
+        self.address = address
+        self.sent = []
+
+    def getsockname(self):
+        return self.address
+
+    def sendto(self, data, address):
+        self.sent.append((bytes(data), address))
+
+    def take(self):
+        sent, self.sent = self.sent, []
+        return [data for data, address in sent]
+
+
+def test_a_lost_relayed_broadcast_is_retransmitted_in_order():
+    a, b = Relay(Socket(A), [A, B]), Relay(Socket(B), [A, B])
+
+    a.publish('lobby', b'first', now=0.0)
+    a.socket.take()
+    a.publish('games', b'second', now=0.0)
+
+    # The first broadcast was lost, so the second waits for it
+    assert b.receive(a.socket.take()[0], A) == []
+    assert a.deadline() is not None
+
+    a.poll(now=5.0)
+    assert b.receive(a.socket.take()[0], A) == [('lobby', b'first'), ('games', b'second')]
+
+    # Once acknowledged, nothing is left to retransmit
+    for ack in b.socket.take():
+        assert a.receive(ack, B) == []
+    assert a.deadline() is None
+
+    # Datagrams from anywhere but another worker are not taken for broadcasts
+    a.publish('lobby', b'third', now=6.0)
+    assert b.receive(a.socket.take()[0], ('127.0.0.1', 9999)) == []
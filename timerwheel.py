@@ -0,0 +1,78 @@
+import math
+
+
+class TimerWheel:
+    """A hashed timer wheel: a ring of slots, each holding the timers due on
+    the ticks which hash to it. Scheduling and cancelling a timer are O(1),
+    and each tick only visits its own slot, rather than every timer.
+
+    The wheel is sized to cover span seconds, so any timer up to span away is
+    due the first time its slot comes around. Timers further away stay in
+    their slot for as many laps as they need."""
+
+    def __init__(self, resolution, span, now):
+        # The length of a tick, in seconds
+        self.resolution = resolution
+
+        # Each slot maps the keys of its timers to the tick each one is due on
+        self.slots = [{} for _ in range(math.ceil(span / resolution) + 1)]
+
+        # The slot each key's timer is in
+        self.slot_of = {}
+
+        # The last tick the wheel has advanced to
+        self.current = int(now // resolution)
+
+    def __len__(self):
+        return len(self.slot_of)
+
+    def __contains__(self, key):
+        return key in self.slot_of
+
+    def schedule(self, key, delay, now):
+        """Sets the timer for key to expire delay seconds from now, replacing any
+        timer it already has"""
+
+        self.cancel(key)
+
+        # Round up, so timers never expire early, and never into the past
+        tick = max(math.ceil((now + delay) / self.resolution), self.current + 1)
+
+        slot = self.slots[tick % len(self.slots)]
+        slot[key] = tick
+        self.slot_of[key] = slot
+
+    def cancel(self, key):
+        """Removes the timer for key, if it has one"""
+
+        slot = self.slot_of.pop(key, None)
+        if slot is not None:
+            del slot[key]
+
+    def advance(self, now):
+        """Moves the wheel on to now, returning the keys whose timers expired"""
+
+        target = int(now // self.resolution)
+        if target <= self.current:
+            return []
+
+        expired = []
+
+        # After a long pause, a single lap of the wheel visits every slot
+        for tick in range(self.current + 1, self.current + 1 + min(target - self.current, len(self.slots))):
+            slot = self.slots[tick % len(self.slots)]
+
+            for key, due in list(slot.items()):
+                if due <= target:
+                    del slot[key]
+                    del self.slot_of[key]
+                    expired.append(key)
+
+        self.current = target
+
+        return expired
+
+    def next_tick(self):
+        """The time at which the wheel next needs to advance"""
+
+        return (self.current + 1) * self.resolution
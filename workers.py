@@ -0,0 +1,231 @@
+import logging
+import multiprocessing
+import os
+import socket
+import time
+from collections import Counter
+from multiprocessing.connection import wait
+
+import logs
+import protocol
+from reliability import BACKLOG_SIZE, Channel
+from server import Server
+
+logger = logging.getLogger('workers')
+
+RELAY_BUFFER_SIZE = 4 * 1024 * 1024  # The size of the kernel receive buffer requested for each relay socket
+
+
+class SharedRegistry:
+    """The nicknames and rooms of the clients attached to every worker process,
+    so nicknames stay unique and rooms can be listed across the workers"""
+
+    def __init__(self, manager):
+        # The nickname -> room table, held by the manager process
+        self.table = manager.dict()
+
+        # Makes checking for and claiming a nickname atomic across the workers
+        self.lock = manager.Lock()
+
+    def __len__(self):
+        return len(self.table)
+
+    def claim(self, nickname, room):
+        """Claims a nickname, returning False if it is already taken"""
+
+        with self.lock:
+            if nickname in self.table:
+                return False
+
+            self.table[nickname] = room
+
+        return True
+
+    def release(self, nickname):
+        """Releases a nickname"""
+
+        self.table.pop(nickname, None)
+
+    def move(self, nickname, room):
+        """Records a client moving into another room"""
+
+        self.table[nickname] = room
+
+    def rooms(self):
+        """The room -> number of clients table of every room in use"""
+
+        return dict(Counter(self.table.values()))
+
+
+class Relay:
+    """Carries broadcasts between the worker processes. Each worker only sends
+    to its own clients, whose acknowledgements it receives, so a broadcast
+    handled by one worker is relayed to the others for their clients.
+
+    Broadcasts to each other worker go through a reliable Channel, as they
+    do to clients, so one lost on the loopback interface is retransmitted.
+    The workers start and stop together, so the channels never start over"""
+
+    def __init__(self, relay_socket, addresses):
+        # The loopback socket this worker relays through
+        self.socket = relay_socket
+
+        # The channels broadcasts are sent to and received from each other
+        # worker through, keyed by the (address, port) of its relay socket
+        peers = [address for address in addresses if address != relay_socket.getsockname()]
+        self.sending = {address: Channel(address) for address in peers}
+        self.receiving = {address: Channel(address) for address in peers}
+
+    def publish(self, room, message, now=None):
+        """Relays a broadcast to every other worker, returning the number of
+        workers it was dropped for, as they have fallen too far behind"""
+
+        now = time.monotonic() if now is None else now
+
+        room = str.encode(room, 'utf-8')
+        payload = protocol.PEER_ROOM.pack(len(room)) + room + message
+
+        dropped = 0
+        for address, channel in self.sending.items():
+            # Drop the broadcast rather than let a full backlog give up on the worker
+            if channel.lost or (channel.backlog is not None and len(channel.backlog) >= BACKLOG_SIZE):
+                dropped = dropped + 1
+                continue
+
+            datagram = channel.send(protocol.RELAY, payload, now)
+            if datagram is not None:
+                self.sendto(datagram, address)
+
+        return dropped
+
+    def sendto(self, datagram, address):
+        try:
+            self.socket.sendto(datagram, address)
+        except OSError:
+            # The channel retransmits it
+            pass
+
+    def receive(self, data, address):
+        """Handles a datagram from another worker, returning the (room, message)
+        of each broadcast relayed which can now be delivered, in order"""
+
+        if address not in self.receiving:
+            return []
+
+        try:
+            message = protocol.decode(data)
+        except (protocol.ProtocolError, UnicodeDecodeError):
+            return []
+
+        if message.type == protocol.ACK:
+            for datagram in self.sending[address].acknowledge(message, time.monotonic()):
+                self.sendto(datagram, address)
+            return []
+
+        if message.type != protocol.RELAY or not message.sequence:
+            return []
+
+        channel = self.receiving[address]
+        delivered = channel.receive(message)
+        self.sendto(channel.ack(), address)
+
+        broadcasts = []
+        for message in delivered:
+            length = message.payload[0] if message.payload else 0
+            start = protocol.PEER_ROOM.size + length
+            broadcasts.append((bytes(message.payload[protocol.PEER_ROOM.size:start]).decode('utf-8', 'replace'),
+                               bytes(message.payload[start:])))
+
+        return broadcasts
+
+    def poll(self, now=None):
+        """Retransmits the broadcasts the other workers have not acknowledged in time"""
+
+        now = time.monotonic() if now is None else now
+
+        for address, channel in self.sending.items():
+            if channel.lost:
+                continue
+
+            for datagram in channel.poll(now):
+                self.sendto(datagram, address)
+
+            if channel.lost:
+                logger.warning("[!] Worker relay (%s, %s) has stopped acknowledging broadcasts", address[0],
+                               address[1], extra=dict(event='relay_lost', address=address[0], port=address[1]))
+
+    def deadline(self):
+        """When poll() should next be called, or None if nothing is waiting on an acknowledgement"""
+
+        deadlines = [channel.deadline for channel in self.sending.values()
+                     if not channel.lost and channel.deadline is not None]
+
+        return min(deadlines) if deadlines else None
+
+
+def run_worker(address, port, registry, relay_socket, relay_addresses, options, log_options):
+    """Runs a single chat server worker process"""
+
+    # The background thread writing the log is not carried over into a new process
+    listener = logs.setup(**log_options)
+
+    try:
+        Server(address, port, registry=registry, relay=Relay(relay_socket, relay_addresses), reuse_port=True,
+               **options)
+    finally:
+        listener.stop()
+
+
+def run_workers(address, port, count, log_options=None, **options):
+    """Runs count chat server processes, all bound to the same (address, port)
+    through SO_REUSEPORT and sharing one nickname registry. Each worker logs
+    with the log_options passed to logs.setup(). Any other options are passed
+    on to each Server"""
+
+    with multiprocessing.Manager() as manager:
+        registry = SharedRegistry(manager)
+
+        # Bind each worker's relay socket up front, so every worker knows the others' addresses
+        relay_sockets = []
+        for _ in range(count):
+            relay_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            # A broadcast reaches every worker at once, so give bursts of them room to queue
+            try:
+                relay_socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RELAY_BUFFER_SIZE)
+            except OSError:
+                # If the kernel refuses the request, keep the default buffer
+                pass
+            relay_socket.bind(('127.0.0.1', 0))
+            relay_sockets.append(relay_socket)
+        relay_addresses = [relay_socket.getsockname() for relay_socket in relay_sockets]
+
+        # Every broadcast reaches every worker, so each keeps a complete log of its own,
+        # which its clients' replays are read from
+        worker_options = []
+        for index in range(count):
+            worker_options.append(dict(options))
+            if options.get('log_directory'):
+                worker_options[index]['log_directory'] = os.path.join(options['log_directory'], 'worker-%d' % index)
+
+            # Each worker answers for its own stats, on consecutive ports
+            if options.get('stats_port') is not None:
+                worker_options[index]['stats_port'] = options['stats_port'] + index
+
+        # Start each of the workers
+        workers = [multiprocessing.Process(target=run_worker,
+                                           args=(address, port, registry, relay_socket, relay_addresses,
+                                                 worker_options[index], log_options or {}))
+                   for index, relay_socket in enumerate(relay_sockets)]
+        for worker in workers:
+            worker.start()
+
+        logger.info("[*] Started %d chat server workers", count, extra=dict(event='started', workers=count))
+
+        # A worker exits once the last client has left the chat, at which
+        # point the remaining workers are stopped too
+        try:
+            wait([worker.sentinel for worker in workers])
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.join()